@@ -0,0 +1,291 @@
+"""
+Cache for Analysis Intermediates
+
+Each cache entry is keyed on a hash of the effective configuration of an analysis script plus the
+size and modification time of its input files, so entries for different configurations are kept
+side by side and an entry is never reused after its inputs change. A small JSON file containing the
+configuration and input fingerprints is written next to each entry. Entries are evicted in least
+recently used order. Each entry can be assigned a scope (e.g., the name of the script that created
+it), so that several scripts can share a cache directory without evicting each other's entries.
+
+Cache entries are intermediates that can be evicted at any time. Final products that are read by
+other scripts (e.g., the scripts in fig_code) should be published to a stable path using publish().
+
+These functions are used by compare_NR_real_sfc_stations_perfect_matching.py,
+frequency_histograms.py, and obj_based_mrms_cref_compare.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+import datetime as dt
+import hashlib
+import json
+import glob
+import os
+import pickle
+import shutil
+
+
+#---------------------------------------------------------------------------------------------------
+# Constants
+#---------------------------------------------------------------------------------------------------
+
+# Number of hexadecimal characters from the hash that are used in the cache file names
+key_length = 16
+
+# Extension of the metadata file written next to each cache entry
+meta_ext = '.meta.json'
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def _to_json(obj):
+    """
+    Convert objects that are not natively supported by json (e.g., numpy arrays, datetimes)
+    """
+
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, (dt.datetime, dt.date)):
+        return obj.isoformat()
+    elif isinstance(obj, dt.timedelta):
+        return obj.total_seconds()
+    elif isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    else:
+        raise TypeError('cannot add %s to a cache key' % type(obj))
+
+
+def dir_listing_hash(dname):
+    """
+    Hash of the relative path, size, and mtime of every file in a directory (including 
+    subdirectories). Returns the number of files and the hash
+    """
+
+    listing = []
+    for root, dirs, files in os.walk(dname):
+        dirs.sort()
+        for f in sorted(files):
+            st = os.stat(os.path.join(root, f))
+            listing.append('%s %d %d' % (os.path.relpath(os.path.join(root, f), dname), 
+                                         st.st_size, st.st_mtime_ns))
+
+    return len(listing), hashlib.sha256('\n'.join(listing).encode()).hexdigest()[:key_length]
+
+
+def file_fingerprint(fname):
+    """
+    Fingerprint of an input file or directory: [absolute path, size (bytes), mtime (ns)] for files 
+    and [absolute path, number of files, hash of the file listing] for directories (see 
+    dir_listing_hash), so that files that are added, removed, or modified inside a directory change
+    the fingerprint. The last two entries are None if fname does not exist
+    """
+
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return [os.path.abspath(fname), None, None]
+
+    if os.path.isdir(fname):
+        return [os.path.abspath(fname)] + list(dir_listing_hash(fname))
+
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+
+def cache_key(config, inputs=None):
+    """
+    Compute the cache key for a configuration and set of input files
+
+    Parameters
+    ----------
+    config : dictionary
+        Effective configuration. Values can be any combination of json types, numpy arrays,
+        datetimes, and timedeltas
+    inputs : list of strings, optional
+        Input files or directories. Directories are fingerprinted using the size and mtime of every
+        file they contain
+
+    Returns
+    -------
+    key : string
+        Hexadecimal hash
+    meta : dictionary
+        Configuration and input fingerprints used to compute the key
+
+    """
+
+    if inputs is None:
+        inputs = []
+    meta = {'config':config, 'inputs':[file_fingerprint(f) for f in sorted(set(inputs))]}
+    meta = json.loads(json.dumps(meta, default=_to_json, sort_keys=True))
+    key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:key_length]
+
+    return key, meta
+
+
+def entry_fname(cache_dir, name, config, inputs=None, ext='.pkl', scope=None):
+    """
+    Name of the cache entry for a configuration and set of input files
+
+    The metadata file for the entry is written if it does not exist yet (or if its scope differs).
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory
+    name : string
+        Descriptive prefix for the cache file name
+    config, inputs : See cache_key
+    ext : string, optional
+        Extension of the cache file
+    scope : string, optional
+        Scope of the entry (see evict). Not part of the cache key
+
+    Returns
+    -------
+    fname : string
+        Cache file name ([cache_dir]/[name]_[key][ext])
+
+    """
+
+    key, meta = cache_key(config, inputs=inputs)
+    fname = '%s/%s_%s%s' % (cache_dir, name, key, ext)
+    meta['scope'] = scope
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if (not os.path.isfile(fname + meta_ext)) or (entry_scope(fname) != scope):
+        with open(fname + meta_ext, 'w') as fptr:
+            json.dump(meta, fptr, indent=2, sort_keys=True)
+
+    return fname
+
+
+def entry_scope(fname):
+    """
+    Scope of a cache entry. None if the entry has no scope or its metadata file does not exist
+    """
+
+    try:
+        with open(fname + meta_ext, 'r') as fptr:
+            return json.load(fptr).get('scope', None)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def publish(fname, out_fname):
+    """
+    Publish a cache entry to a stable path (e.g., a file read by the scripts in fig_code)
+
+    The entry is hard linked to out_fname if possible (and copied otherwise), so out_fname is not
+    affected if the entry is evicted later
+    """
+
+    if os.path.abspath(fname) == os.path.abspath(out_fname):
+        return
+    tmp_fname = out_fname + '.tmp'
+    if os.path.lexists(tmp_fname):
+        os.remove(tmp_fname)
+    try:
+        os.link(fname, tmp_fname)
+    except OSError:
+        shutil.copy2(fname, tmp_fname)
+    os.replace(tmp_fname, out_fname)
+    print('published %s' % out_fname)
+
+
+def touch(fname):
+    """
+    Mark a cache entry as recently used (entries are evicted in order of their mtime)
+    """
+
+    if os.path.isfile(fname):
+        os.utime(fname)
+
+
+def read_pickle(fname):
+    """
+    Read a pickled cache entry and mark it as recently used. Raises FileNotFoundError if the entry
+    does not exist
+    """
+
+    with open(fname, 'rb') as handle:
+        obj = pickle.load(handle)
+    touch(fname)
+
+    return obj
+
+
+def write_pickle(obj, fname):
+    """
+    Write a pickled cache entry. The entry is written to a temporary file first so that interrupted
+    writes do not leave a truncated entry behind
+    """
+
+    with open(fname + '.tmp', 'wb') as handle:
+        pickle.dump(obj, handle)
+    os.replace(fname + '.tmp', fname)
+
+
+def evict(cache_dir, max_entries=None, max_gb=None, scope=None):
+    """
+    Remove least recently used entries from a cache directory
+
+    If scope is set, only entries with that scope are counted and removed, so that scripts that 
+    share a cache directory do not evict each other's entries
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory
+    max_entries : integer, optional
+        Maximum number of entries retained. No limit if None
+    max_gb : float, optional
+        Maximum total size of the retained entries (GB). No limit if None. The most recently used
+        entry is always retained
+    scope : string, optional
+        Only consider entries with this scope. All entries are considered if None
+
+    Returns
+    -------
+    removed : list of strings
+        Cache entries that were removed
+
+    """
+
+    entries = [f for f in glob.glob('%s/*' % cache_dir)
+               if os.path.isfile(f + meta_ext) and os.path.isfile(f)]
+    if scope is not None:
+        entries = [f for f in entries if entry_scope(f) == scope]
+    entries = sorted(entries, key=lambda f: os.stat(f).st_mtime_ns, reverse=True)
+
+    kept = []
+    removed = []
+    tot_bytes = 0
+    for f in entries:
+        size = os.stat(f).st_size
+        if (((max_entries is not None) and (len(kept) >= max_entries)) or
+            ((max_gb is not None) and (tot_bytes + size > max_gb * 1e9) and (len(kept) > 0))):
+            print('removing cache entry %s' % f)
+            os.remove(f)
+            os.remove(f + meta_ext)
+            removed.append(f)
+        else:
+            kept.append(f)
+            tot_bytes = tot_bytes + size
+
+    return removed
+
+
+"""
+End analysis_cache.py
+"""
@@ -0,0 +1,83 @@
+"""
+Check Incremental Updates of the Surface Station netCDF File
+
+Runs compare_NR_real_sfc_stations_perfect_matching.py three times using the input parameters in
+that script (without creating any figures):
+    1. A full run using the first ndays_first analysis days
+    2. An incremental update of run 1 using all analysis days
+    3. A fresh full run using all analysis days (in a separate cache directory)
+The netCDF files from runs 2 and 3 must agree. An AssertionError is raised otherwise.
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import os
+import tempfile
+import xarray as xr
+
+
+#---------------------------------------------------------------------------------------------------
+# Input Parameters
+#---------------------------------------------------------------------------------------------------
+
+# Script to check. The input parameters are the code before the "Compare NR to Surface Station Obs"
+# section
+script = 'compare_NR_real_sfc_stations_perfect_matching.py'
+main_section = '# Compare NR to Surface Station Obs'
+
+# Number of analysis days used in the first run (the remaining days are added incrementally)
+ndays_first = 5
+
+# Directory for the cache directories of the incremental and full runs. Set to None to use a
+# temporary directory
+work_dir = None
+
+
+#---------------------------------------------------------------------------------------------------
+# Run Comparisons
+#---------------------------------------------------------------------------------------------------
+
+with open(script, 'r') as fptr:
+    src = fptr.read()
+isplit = src.rfind('#---', 0, src.index(main_section))
+params_code = compile(src[:isplit], script, 'exec')
+main_code = compile(src[isplit:], script, 'exec')
+
+def run(**overrides):
+    g = {'__name__':'__main__'}
+    exec(params_code, g)
+    g.update(make_plots='none', use_saved=True, batch_windows=None, experiments=None,
+             station_chunk_gb=None, cache_max_entries=None, cache_max_gb=None)
+    g.update({k:(v(g) if callable(v) else v) for k, v in overrides.items()})
+    exec(main_code, g)
+    return g['final_fname'] % g['cache_name']
+
+if work_dir is None:
+    work_dir = tempfile.mkdtemp(prefix='sfc_station_check_')
+inc_dir = '%s/incremental' % work_dir
+full_dir = '%s/full' % work_dir
+
+print('full run with %d analysis days' % ndays_first)
+run(cache_dir=inc_dir, final_fname=inc_dir + '/%s.nc', incremental=True,
+    analysis_days=lambda g: g['analysis_days'][:ndays_first])
+print()
+print('incremental update with all analysis days')
+inc_fname = run(cache_dir=inc_dir, final_fname=inc_dir + '/%s.nc', incremental=True)
+print()
+print('fresh full run with all analysis days')
+full_fname = run(cache_dir=full_dir, final_fname=full_dir + '/%s.nc', incremental=False)
+
+with xr.open_dataset(inc_fname) as ds_inc, xr.open_dataset(full_fname) as ds_full:
+    xr.testing.assert_allclose(ds_inc, ds_full)
+print()
+print('incremental update matches full recompute (%s)' % os.path.abspath(work_dir))
+
+
+"""
+End check_sfc_station_incremental.py
+"""
@@ -17,15 +17,13 @@ Date Created: 11 April 2023
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import datetime as dt
-import metpy.constants as const
-import metpy.calc as mc
-from metpy.units import units
-import scipy.stats as ss
-import pickle
+import xarray as xr
 
-import pyDA_utils.bufr as bufr
+import sfc_station_fcts as sfc
+import sfc_station_plots as sfcplt
+import met_conversions as metconv
+import analysis_cache as cache
 
 
 #---------------------------------------------------------------------------------------------------
@@ -39,6 +37,13 @@ with open('station_list.txt', 'r') as fptr:
     for i in range(len(station_ids)):
         station_ids[i] = station_ids[i].strip()
 years = np.arange(1993, 2023)
+
+# Optional: Directory containing the columnar (Parquet) cache of the IEM station archives (see 
+# make_iem_station_cache.py). Stations that are not in the cache are added to it the first time they
+# are read, and stations whose cache does not contain the raw IEM files for real_obs_dir, startdate,
+# and enddate (or was created from older versions of those files) are rebuilt. Set to None to read
+# the raw IEM files
+iem_cache_dir = None
 #years = np.array([2022])
 #startdate = '04290000'
 #enddate = '05070000'
@@ -52,6 +57,15 @@ fake_obs_dir = '/work2/noaa/wrfruc/murdzek/nature_run_winter/obs/eval_sfc_statio
 analysis_days = [dt.datetime(2022, 2, 1) + dt.timedelta(days=i) for i in range(7)]
 analysis_times = [dt.timedelta(hours=i) for i in range(24)]
 
+# Number of hourly fake obs files that are read ahead (on a thread pool) while the current file is
+# processed. Each prefetched file is held in memory, so this also bounds memory usage. Set to 0 to 
+# read the files serially
+fake_obs_prefetch = 4
+
+# Option to check that the NumPy unit conversions (met_conversions.py) agree with MetPy before 
+# running
+verify_conversions = False
+
 # Option to swap fake obs with real obs from a certain year
 swap_obs = False
 swap_year = 2021
@@ -59,6 +73,19 @@ swap_year = 2021
 # Maximum time allowed between analysis_times and either the real or fake ob (sec)
 max_time_allowed = 450.
 
+# Number of processes used to read the real obs (each process reads a subset of the station/year 
+# files). Set to 1 to read the real obs serially
+nprocs_real = 1
+
+# Figures to create:
+#     'all': Figures for each station and a figure with the z-scores from all stations
+#     'summary': Only the figure with the z-scores from all stations
+#     'none': No figures (analysis only, e.g., to create or update the netCDF file)
+make_plots = 'all'
+
+# Number of processes used to plot the figures for each station. Set to 1 to plot serially
+nprocs_plot = 1
+
 # Option to plot ceiling obs as a binary histogram ('binary') or CDF of ceiling height ('hgt')
 ceil_plot = 'hgt'
 
@@ -69,13 +96,19 @@ zscore = 'regular'
 zcutoff = 2
 zscore_min_pts = 24
 
+# Number of days on either side of each analysis day that are pooled into the climatology used for
+# z-scores and ranks (the window is truncated at the first and last analysis days). Set to 0 to only
+# use the same day from each year. The bootstrap null distribution is built from the same day in each
+# year, so climo_pool_days > 0 requires create_bootstrap_null = False
+climo_pool_days = 0
+
 # Option to adjust the fake obs pressure and/or temperature based on elevation differences between
 # the real and fake surface stations
 elv_adjust_prs = True
 elv_adjust_T = True
 
-# Option to create null distribution for bootstrap significance testing
-create_bootstrap_null = False
+# Option to create null distribution for bootstrap significance testing (leave-one-year-out)
+create_bootstrap_null = True
 
 # Option to save the rank of the NR compared to the observations (this can be used to create a rank
 # histogram
@@ -84,470 +117,656 @@ save_rank = True
 # Ceiling thresholds used for evaluations (only applies if save_rank = True). In km.
 ceil_thres = [0.1524, 0.3048, 0.9144]
 
-# Option to save/use output from a pickle file
-# If use_pickle is True, then the script will attempt to read the pickle file specified. If the file
-# is not found, that file will be written to.
-use_pickle = True
-pickle_fname = './sfc_station_ceil_exp2_compare_winter.pkl'
+# Option to save/use output from a netCDF file
+# If use_saved is True, then the script will attempt to read the netCDF file in cache_dir that 
+# matches the parameters above. If the file is not found, that file will be written to. The netCDF
+# file contains a labeled data cube with (station, variable, year, day, hour) dimensions (see 
+# sfc.stations_to_dataset). Least recently used files are removed from cache_dir if there are more
+# than cache_max_entries files or the files exceed cache_max_gb (set either to None for no limit).
+# Only entries created by this script count toward cache_max_entries and cache_max_gb. The final 
+# netCDF file for each analysis window is published to final_fname (include %s placeholder for 
+# cache_name), which is read by the scripts in fig_code. This is a hard link to (or copy of) the 
+# cache entry, so it is not removed when the cache entry is evicted
+use_saved = True
+cache_dir = './cache'
+cache_name = 'sfc_station_ceil_exp2_compare_winter'
+cache_max_entries = 20
+cache_max_gb = None
+final_fname = '%s.nc'
+
+# Option to update the netCDF file incrementally (only applies if use_saved = True). Stations, years,
+# analysis days, and analysis times that are missing from the netCDF file are extracted and added to
+# the file, and z-scores and ranks are only recomputed where they are affected (all z-scores and 
+# ranks are recomputed if years are added or removed). Everything is recomputed if the settings used
+# to create the file differ from the settings above. Not used if swap_obs = True. If incremental = 
+# False, the netCDF file also depends on the stations, years, analysis days, and analysis times and
+# the sizes and modification times of the real and fake obs files that are read (the IEM cache is 
+# derived from the real obs files, so it is not included). If incremental = True, input files that
+# change without changing the stations, years, analysis days, or analysis times are not detected
+incremental = True
+
+# Option to use the climatology store. The store contains the counts, means, standard deviations,
+# medians, median absolute deviations, and sorted values of the real obs climatology for each 
+# station, variable, analysis day, and analysis time (see sfc.build_climo_store). It is built once
+# for a given set of real obs and saved in cache_dir (as [climo_store_name]_[hash].nc), then z-scores
+# and ranks for any NR experiment are computed from the store without rescanning the climatology
+use_climo_store = True
+climo_store_name = 'sfc_station_climo'
+
+# Option to process the stations in chunks (e.g., for the full ASOS network), which keeps the peak
+# memory usage independent of the number of stations. The number of stations in each chunk is chosen
+# so that the estimated memory usage of a chunk is below station_chunk_gb (see 
+# sfc.station_chunk_size). The output for each chunk is written to its own netCDF file 
+# ([cache_name]_chunk[n]), then the fake obs, z-scores, percentiles, and ranks for all stations are
+# assembled and written to final_fname. Requires use_saved = True (cache_max_entries should be 
+# large enough to retain the files for all chunks if they are to be updated incrementally later). 
+# Set station_chunk_gb to None to process all stations at once
+station_chunk_gb = None
 
 # Output file name (include %s placeholder for station ID)
 out_fname = '%s_sfc_station_compare_perfect.png'
 
+# Optional: Batch mode. List of analysis windows (e.g., different seasons) that are processed in a 
+# single run. The real obs for all windows are extracted together, and if iem_cache_dir is set, each
+# station archive is only read once and all windows are sliced from memory. Each window is a 
+# dictionary that can contain the keys 'real_obs_dir', 'startdate', 'enddate', 'fake_obs_dir', 
+# 'analysis_days', 'cache_name', and 'out_fname' (keys that are not provided use the values above).
+# Set to None to only process the window defined above
+batch_windows = None
+#batch_windows = [{'startdate':'02010000', 'enddate':'02080000',
+#                  'analysis_days':[dt.datetime(2022, 2, 1) + dt.timedelta(days=i) for i in range(7)],
+#                  'fake_obs_dir':'/work2/noaa/wrfruc/murdzek/nature_run_winter/obs/eval_sfc_station_ceil_exp2/perfect_csv/',
+#                  'cache_name':'sfc_station_ceil_exp2_compare_winter',
+#                  'out_fname':'%s_sfc_station_compare_perfect_winter.png'},
+#                 {'real_obs_dir':'/work2/noaa/wrfruc/murdzek/real_obs/sfc_stations/spring',
+#                  'startdate':'04290000', 'enddate':'05070000',
+#                  'analysis_days':[dt.datetime(2022, 4, 29) + dt.timedelta(days=i) for i in range(8)],
+#                  'fake_obs_dir':'/work2/noaa/wrfruc/murdzek/nature_run_spring/obs/eval_sfc_station_ceil_exp2/perfect_csv/',
+#                  'cache_name':'sfc_station_ceil_exp2_compare_spring',
+#                  'out_fname':'%s_sfc_station_compare_perfect_spring.png'}]
+
+# Optional: Compare several NR obs experiments against the same real obs climatology. Dictionary
+# with experiment names as keys and fake obs directories as values (use a list with one directory 
+# per window if batch_windows is used). These replace fake_obs_dir. The real obs and climatology 
+# statistics are only computed once and are shared by all experiments. Each experiment has its own
+# netCDF file ([cache_name]_[experiment]) and figures ([experiment]_[out_fname]). A netCDF file 
+# containing all experiments along an experiment dimension is also written to combined_fname 
+# (include %s placeholder for cache_name). Set experiments to None to only use fake_obs_dir
+experiments = None
+#experiments = {'exp2':'/work2/noaa/wrfruc/murdzek/nature_run_winter/obs/eval_sfc_station_ceil_exp2/perfect_csv/',
+#               'exp3':'/work2/noaa/wrfruc/murdzek/nature_run_winter/obs/eval_sfc_station_ceil_exp3/perfect_csv/'}
+combined_fname = '%s_experiments.nc'
+
 
 #---------------------------------------------------------------------------------------------------
 # Compare NR to Surface Station Obs
 #---------------------------------------------------------------------------------------------------
 
-# Try to read from pickle file
-if use_pickle:
-    try:
-        with open(pickle_fname, 'rb') as handle:
-            all_data = pickle.load(handle)
-        fake_stations = all_data['fake_stations']
-        fake_stations_z = all_data['fake_stations_z']
-        real_stations = all_data['real_stations']
-        all_zscores = all_data['all_zscores']
-        analysis_times = all_data['analysis_times']
-        pickle_avail = True
-    except FileNotFoundError:
-        pickle_avail = False
-else:
-    pickle_avail = False
+if verify_conversions:
+    metconv.verify()
+
+# The z-score percentiles compare the NR z-score to a leave-one-year-out null distribution, which 
+# is only consistent with the z-score if both use the same climatology sample
+if (climo_pool_days > 0) and create_bootstrap_null:
+    raise ValueError('create_bootstrap_null must be False if climo_pool_days > 0')
 
 # Variables to extract
 real_varnames = ['lon', 'lat', 'tmpf', 'dwpf', 'drct', 'sknt', 'alti', 'vsby', 'elevation']
 fake_varnames = ['TOB', 'QOB', 'POB', 'UOB', 'VOB', 'WSPD', 'WDIR']
 fake_varnames_noplot = ['ELV', 'ceil']
 
-# Extract some values that will be used a lot
-ndays = len(analysis_days)
-ntimes = len(analysis_times)
-analysis_year = analysis_days[0].year
-min_hr = -max_time_allowed / 3600.
-max_hr = max_time_allowed / 3600.
-
-if not pickle_avail:
-
-    # Extract real surface station obs first
-    real_stations = {}
-    for ID in station_ids:
-        print('Extracting real obs at %s' % ID)
-        real_stations[ID] = {}
-        for v in real_varnames:
-            real_stations[ID][v] = np.ones([len(years) * ndays, ntimes]) * np.nan
-        real_stations[ID]['ceil'] = np.ones([len(years), ntimes * ndays]) * np.nan
-        real_stations[ID]['n_skyl'] = np.zeros(len(years))
-        real_stations[ID]['frac_ceil'] = np.zeros(len(years)) * np.nan
-        real_stations[ID]['frac_ceil_thres'] = np.zeros([len(ceil_thres), len(years)]) * np.nan
-        for j, yr in enumerate(years):
-            tmp_df = pd.read_csv('%s/%s_%d%s_%d%s.txt' % (real_obs_dir, ID, yr, startdate, yr, enddate), 
-                                 skiprows=5)
-
-            if len(tmp_df) == 0:
-                print('No data for %s %d (all data will be NaN)' % (ID, yr))
-                continue
-
-            # Only retain times with thermodynamic and kinematic obs (this eliminates special obs for 
-            # gusts, etc.)
-            ss_df = tmp_df.loc[(tmp_df['tmpf'] != 'M') & (tmp_df['drct'] != 'M')].copy()
-            ss_df.reset_index(inplace=True, drop=True)
-
-            station_times = [dt.datetime.strptime(s, '%Y-%m-%d %H:%M').replace(year=analysis_year) 
-                             for s in ss_df['valid'].values]
-            station_times_tot = np.array([(s - dt.datetime(analysis_year, 1, 1)).total_seconds() 
-                                          for s in station_times])
-
-            # Temporary variables for determining fraction of time with a ceiling
-            ceil_obs = 0
-            tot_obs = 0
-
-            for k, d in enumerate(analysis_days):
-                for l, time in enumerate(analysis_times):
-                    diff = np.abs(station_times_tot - ((d + time) - dt.datetime(analysis_year, 1, 1)).total_seconds())
-                    idx = np.argmin(diff)
-                    for v in real_varnames:
-                        if (diff.min() > max_time_allowed) or (ss_df.loc[idx, v] == 'M'):
-                            real_stations[ID][v][(j*ndays) + k, l] = np.nan
-                        else:
-                            real_stations[ID][v][(j*ndays) + k, l] = ss_df.loc[idx, v]
-
-                    # Determine if there is a ceiling
-                    skyc = ss_df.loc[idx, ['skyc%d' % n for n in range(1, 5)]].values
-                    skyl = ss_df.loc[idx, ['skyl%d' % n for n in range(1, 5)]].values
-                    skyl[skyl == 'M'] = np.nan
-                    skyl = np.float64(skyl)
-                    ceil_idx = np.where((skyc == 'OVC') | (skyc == 'BKN'))[0]
-                    if len(ceil_idx) > 0:
-                        ceil_obs = ceil_obs + 1
-                        if not np.all(np.isnan(skyl[ceil_idx])):
-                            real_stations[ID]['n_skyl'][j] = real_stations[ID]['n_skyl'][j] + 1
-                            real_stations[ID]['ceil'][j, (k*ntimes) + l] = np.nanmin(skyl[ceil_idx])
-                    if not np.all(skyc == 'M'):
-                        tot_obs = tot_obs + 1
-                        if len(ceil_idx) == 0:
-                            real_stations[ID]['n_skyl'][j] = real_stations[ID]['n_skyl'][j] + 1
-
-            real_stations[ID]['ceil'][j, :] = (real_stations[ID]['ceil'][j, :] * units.ft).to(units.km).magnitude    
-            if tot_obs > 0:
-                real_stations[ID]['frac_ceil'][j] = ceil_obs / tot_obs
-                for l, thres in enumerate(ceil_thres):
-                    real_stations[ID]['frac_ceil_thres'][l, j] = np.nansum(real_stations[ID]['ceil'][j, :] <= thres) / tot_obs
-
-    # Convert real obs to same units/variables as fake obs
-    # Note that the surface stations report the altimeter setting rather than station-level pressure.
-    # The difference between these two is discussed here: https://www.weather.gov/bou/pressure_definitions
-    for ID in station_ids:
-        real_stations[ID]['POB'] = mc.altimeter_to_station_pressure(real_stations[ID]['alti'] * units.inHg, 
-                                                                    real_stations[ID]['elevation'] * units.m).to('mbar').magnitude
-        real_stations[ID]['TOB'] = (real_stations[ID]['tmpf'] * units.degF).to('degC').magnitude       
-        real_stations[ID]['QOB'] = mc.specific_humidity_from_dewpoint(real_stations[ID]['POB'] * units.mbar,
-                                                                      real_stations[ID]['dwpf'] * units.degF).magnitude * 1e6
-        wnd_tmp = mc.wind_components(real_stations[ID]['sknt'] * units.kt, real_stations[ID]['drct'] * units.deg)
-        real_stations[ID]['UOB'] = wnd_tmp[0].to(units.m / units.s).magnitude
-        real_stations[ID]['VOB'] = wnd_tmp[1].to(units.m / units.s).magnitude
-        real_stations[ID]['WSPD'] = (real_stations[ID]['sknt'] * units.kt).to(units.m / units.s).magnitude
-        real_stations[ID]['WDIR'] = real_stations[ID]['drct']
-        real_stations[ID]['lon'] = real_stations[ID]['lon'] + 360.
-
-    # Extract fake observations
-    print()
-    fake_stations = {}
-    for ID in station_ids:
-        fake_stations[ID] = {}
-        for v in fake_varnames + fake_varnames_noplot:
-            fake_stations[ID][v] = np.ones([ndays, ntimes]) * np.nan
-    for i, d in enumerate(analysis_days):
-        for j, t in enumerate(analysis_times):
-            time = d + t
-            print(time.strftime('%Y%m%d %H:%M'))
+# Cache entries written by this script (only these are considered by cache.evict)
+cache_scope = 'compare_NR_real_sfc_stations'
+
+# Analysis windows. Window-specific parameters that are not set in batch_windows use the values 
+# above
+window_keys = ['real_obs_dir', 'startdate', 'enddate', 'fake_obs_dir', 'analysis_days', 
+               'cache_name', 'out_fname']
+default_window = {'real_obs_dir':real_obs_dir, 'startdate':startdate, 'enddate':enddate,
+                  'fake_obs_dir':fake_obs_dir, 'analysis_days':analysis_days, 
+                  'cache_name':cache_name, 'out_fname':out_fname}
+if batch_windows is None:
+    windows = [default_window]
+else:
+    windows = [dict(default_window, **w) for w in batch_windows]
+for i, w in enumerate(windows):
+    w['group'] = i
+    w['group_name'] = w['cache_name']
+
+# Each experiment is treated as a separate window. Windows from the same group share the real obs
+# climatology
+if experiments is not None:
+    exp_windows = []
+    for i, w in enumerate(windows):
+        for exp, exp_dir in experiments.items():
+            if type(exp_dir) != str:
+                exp_dir = exp_dir[i]
+            exp_windows.append(dict(w, fake_obs_dir=exp_dir,
+                                    cache_name='%s_%s' % (w['cache_name'], exp),
+                                    out_fname='%s_%s' % (exp, w['out_fname'])))
+    windows = exp_windows
+all_analysis_times = analysis_times
+
+# Divide the stations into chunks
+if station_chunk_gb is None:
+    station_chunks = [station_ids]
+else:
+    if not use_saved:
+        raise ValueError('use_saved must be True if station_chunk_gb is set')
+    chunk_size = sfc.station_chunk_size(station_chunk_gb, len(years), 
+                                        max([len(w['analysis_days']) for w in windows]),
+                                        len(analysis_times), len(real_varnames), len(fake_varnames),
+                                        zscore=zscore)
+    station_chunks = [station_ids[i:(i+chunk_size)] for i in range(0, len(station_ids), chunk_size)]
+    print('processing %d stations in %d chunks of up to %d stations' % 
+          (len(station_ids), len(station_chunks), chunk_size))
+chunk_fnames = [[] for w in windows]
+
+for ichunk, station_ids in enumerate(station_chunks):
+    chunk_tag = ''
+    if len(station_chunks) > 1:
+        chunk_tag = '_chunk%04d' % ichunk
+        print()
+        print('station chunk %d of %d' % (ichunk + 1, len(station_chunks)))
+
+    # Determine which entries are missing from the netCDF file for each window. The real obs required
+    # by all windows are then extracted together, so each station archive is only read once
+    real_requests = []
+    window_state = []
+    for iw, w in enumerate(windows):
+        real_obs_dir, startdate, enddate, fake_obs_dir, analysis_days, cache_name, out_fname = \
+            [w[k] for k in window_keys]
+        cache_name = cache_name + chunk_tag
+        analysis_times = all_analysis_times
+        if len(windows) > 1:
+            print()
+            print('window %d: %s to %s, %s' % (iw, startdate, enddate, fake_obs_dir))
+
+        # Settings saved with the netCDF file
+        settings = {'elv_adjust_prs':elv_adjust_prs, 'elv_adjust_T':elv_adjust_T, 
+                    'max_time_allowed':max_time_allowed, 'startdate':startdate, 'enddate':enddate,
+                    'zscore':zscore, 'zscore_min_pts':zscore_min_pts, 
+                    'climo_pool_days':climo_pool_days}
+
+        # Name of the netCDF file, which is a hash of all parameters that affect the output. The 
+        # stations, years, analysis days, and analysis times are handled by the incremental update (if
+        # used)
+        if use_saved:
+            incremental = incremental and not swap_obs
+            config = dict(settings, ceil_thres=ceil_thres, real_obs_dir=real_obs_dir, 
+                          fake_obs_dir=fake_obs_dir, fake_varnames=fake_varnames, swap_obs=swap_obs,
+                          swap_year=swap_year, create_bootstrap_null=create_bootstrap_null, 
+                          save_rank=save_rank)
+            inputs = None
+            if not incremental:
+                config.update({'station_ids':station_ids, 'years':years, 'analysis_days':analysis_days,
+                               'analysis_times':analysis_times})
+                inputs = (['%s/%s_%d%s_%d%s.txt' % (real_obs_dir, ID, yr, startdate, yr, enddate)
+                           for ID in station_ids for yr in years] +
+                          ['%s/%s.sfc.fake.prepbufr.csv' % 
+                           (fake_obs_dir, (d + t).strftime('%Y%m%d%H%M'))
+                           for d in analysis_days for t in analysis_times])
+            saved_fname = cache.entry_fname(cache_dir, cache_name, config, inputs=inputs, ext='.nc',
+                                            scope=cache_scope)
+
+        # Try to read from netCDF file
+        # new contains boolean arrays that are True for the stations, years, days, and hours that must
+        # be extracted. restats is True if all z-scores and ranks must be recomputed
+        saved_avail = False
+        new = None
+        restats = True
+        all_data = None
+        if use_saved:
             try:
-                full_bufr_csv = bufr.bufrCSV('%s/%s.sfc.fake.prepbufr.csv' % 
-                                             (fake_obs_dir, time.strftime('%Y%m%d%H%M')))
-                full_bufr_csv.df = bufr.compute_wspd_wdir(full_bufr_csv.df)
+                with xr.open_dataset(saved_fname) as ds:
+                    if incremental:
+                        new, restats = sfc.plan_station_update(ds, station_ids, years, analysis_days, 
+                                                               analysis_times, settings, ceil_thres,
+                                                               fake_varnames)
+                        if new is None:
+                            print('recomputing all output')
+                        else:
+                            restats = (restats or (create_bootstrap_null and 'bootstrap_null' not in ds) or
+                                       (save_rank and 'rank' not in ds))
+                            saved_avail = not (restats or np.any([np.any(n) for n in new.values()]))
+                            ds = sfc.reindex_station_dataset(ds, station_ids, years, analysis_days,
+                                                             analysis_times)
+                    else:
+                        saved_avail = True
+                    if saved_avail or (new is not None):
+                        all_data = sfc.dataset_to_stations(ds)
+                cache.touch(saved_fname)
+                if saved_avail or (new is not None):
+                    fake_stations = all_data['fake_stations']
+                    fake_stations_z = all_data['fake_stations_z']
+                    real_stations = all_data['real_stations']
+                    all_zscores = all_data['all_zscores']
+                    analysis_times = all_data['analysis_times']
+                    var_units = all_data['var_units']
             except FileNotFoundError:
-                print('file not found, continuing to next time')
-                continue
-        
-            # Remove rows that do not have thermodynamic AND kinematic data
-            bufr_csv_no_nan = full_bufr_csv.df.loc[np.logical_not(np.isnan(full_bufr_csv.df['TOB']) |
-                                                                  np.isnan(full_bufr_csv.df['UOB']))].copy()
-
-            for ID in station_ids:
-                red_csv = bufr_csv_no_nan.loc[bufr_csv_no_nan['SID'] == "'%s'" % ID].copy()
-                if len(red_csv) == 0:
-                    # No obs, switching to next station
-                    print('no simulated obs for %s' % ID)
-                    continue
-                red_csv.reset_index(inplace=True, drop=True)
-                idx = np.argmin(np.abs(red_csv['DHR']))
-                if (3600*np.abs(red_csv['DHR'].loc[idx])) < max_time_allowed:
+                saved_avail = False
+
+        # Extract some values that will be used a lot
+        nstations = len(station_ids)
+        ndays = len(analysis_days)
+        ntimes = len(analysis_times)
+        analysis_year = analysis_days[0].year
+        min_hr = -max_time_allowed / 3600.
+        max_hr = max_time_allowed / 3600.
+
+        if not saved_avail:
+
+            # Start from empty output if the netCDF file is not being updated
+            if new is None:
+                new = {'station':np.ones(nstations, dtype=bool), 'year':np.ones(len(years), dtype=bool),
+                       'day':np.ones(ndays, dtype=bool), 'hour':np.ones(ntimes, dtype=bool)}
+                real_stations = {}
+                fake_stations = {}
+                for ID in station_ids:
+                    fake_stations[ID] = {}
                     for v in fake_varnames + fake_varnames_noplot:
-                        fake_stations[ID][v][i, j] = red_csv.loc[idx, v]
-
-    # Perform pressure and temperature adjustment
+                        fake_stations[ID][v] = np.ones([ndays, ntimes]) * np.nan
+                var_units = {}
+            new_station = new['station'][:, np.newaxis, np.newaxis]
+            new_cells = new_station | new['day'][np.newaxis, :, np.newaxis] | new['hour'][np.newaxis, np.newaxis, :]
+
+            # Real surface station obs are requested in up to four blocks: (1) new stations, (2) new 
+            # years, (3) new days, and (4) new hours. The ceiling statistics for blocks (3) and (4) are
+            # combined with the existing statistics for each year
+            old = {k:~new[k] for k in new}
+            every = {k:np.ones(new[k].size, dtype=bool) for k in new}
+            real_blocks = [(new['station'], every['year'], every['day'], every['hour'], False),
+                           (old['station'], new['year'], every['day'], every['hour'], False),
+                           (old['station'], old['year'], new['day'], every['hour'], True),
+                           (old['station'], old['year'], old['day'], new['hour'], True)]
+            for station_mask, year_mask, day_mask, hour_mask, partial in real_blocks:
+                if not (np.any(station_mask) and np.any(year_mask) and np.any(day_mask) and 
+                        np.any(hour_mask)):
+                    continue
+                print('requesting real obs for %d stations, %d years, %d days, %d times' % 
+                      (np.sum(station_mask), np.sum(year_mask), np.sum(day_mask), np.sum(hour_mask)))
+                real_requests.append({'window':iw, 'year_mask':year_mask, 'day_mask':day_mask,
+                                      'hour_mask':hour_mask, 'partial':partial,
+                                      'station_ids':[ID for ID, m in zip(station_ids, station_mask) if m],
+                                      'years':years[year_mask], 'real_obs_dir':real_obs_dir,
+                                      'startdate':startdate, 'enddate':enddate,
+                                      'analysis_days':[d for d, m in zip(analysis_days, day_mask) if m],
+                                      'analysis_times':[t for t, m in zip(analysis_times, hour_mask) if m]})
+        else:
+            new_cells = None
+
+        # The z-scores read from the netCDF file are kept if the file is complete or is being updated
+        # incrementally (all_data is None if the output is recomputed from scratch)
+        loaded = all_data is not None
+        window_state.append({'settings':settings, 'saved_fname':saved_fname if use_saved else None,
+                             'saved_avail':saved_avail, 'new_cells':new_cells, 'restats':restats,
+                             'all_data':all_data, 'fake_stations':fake_stations,
+                             'fake_stations_z':fake_stations_z if loaded else None,
+                             'real_stations':real_stations, 
+                             'all_zscores':all_zscores if loaded else None,
+                             'analysis_times':analysis_times, 'var_units':var_units})
+
+    # Extract real surface station obs for all windows. Requests that are identical for several 
+    # experiments are only extracted once, then converted to the same units/variables as the fake obs
     print()
-    g = 9.81
-    Rd = 287.04
-    lr = 0.0065  # Based on US Standard Atmosphere, see Part 4, Table I from https://ntrs.nasa.gov/citations/19770009539
-    for ID in station_ids:
-        elv_diff = (np.unique(real_stations[ID]['elevation'][~np.isnan(real_stations[ID]['elevation'])])[0] -
-                    np.unique(fake_stations[ID]['ELV'][~np.isnan(fake_stations[ID]['ELV'])])[0]) 
-        print('%s, elev diff = %.1f' % (ID, elv_diff))
-        if elv_adjust_prs:
-            # Use hydrostatic balance for the adjustment
-            fake_stations[ID]['POB_original'] = fake_stations[ID]['POB'].copy()
-            fake_stations[ID]['POB'] = (fake_stations[ID]['POB'] * 
-                                        np.exp(-g * elv_diff / (Rd * (fake_stations[ID]['TOB'] + 273.15))))
-        if elv_adjust_T:
-            # Adjust based on a specified lapse rate
-            fake_stations[ID]['TOB_original'] = fake_stations[ID]['TOB'].copy()
-            fake_stations[ID]['TOB'] = fake_stations[ID]['TOB'] - (lr * elv_diff)
-            
-    # Convert ceiling from gpm to km and compute binary ceiling
-    for ID in station_ids:
-        fake_stations[ID]['ceil'] = (mc.geopotential_to_height(fake_stations[ID]['ceil'] * units.m * const.g).to('km').magnitude -
-                                     mc.geopotential_to_height(fake_stations[ID]['ELV'] * units.m * const.g).to('km').magnitude)
-        fake_stations[ID]['bin_ceil'] = np.float64(~np.isnan(fake_stations[ID]['ceil']))
-        fake_stations[ID]['bin_ceil'][np.isnan(fake_stations[ID]['TOB'])] = np.nan
-        tot_obs = np.count_nonzero(~np.isnan(fake_stations[ID]['bin_ceil']))
-        fake_stations[ID]['frac_ceil'] = np.nansum(fake_stations[ID]['bin_ceil']) / tot_obs
-        fake_stations[ID]['frac_ceil_thres'] = np.zeros(len(ceil_thres))
-        for l, thres in enumerate(ceil_thres):
-            fake_stations[ID]['frac_ceil_thres'][l] = np.nansum(fake_stations[ID]['ceil'] <= thres) / tot_obs
-
-    # Swap fake obs with real obs if desired
-    if swap_obs:
-        iyr = np.where(years == swap_year)[0][0]
-        istart = iyr * ndays
-        iend = istart + ndays 
-        for ID in station_ids:
+    req_keys = [(tuple(r['station_ids']), tuple(r['years']), r['real_obs_dir'], r['startdate'], 
+                 r['enddate'], tuple(r['analysis_days']), tuple(r['analysis_times'])) 
+                for r in real_requests]
+    unique_keys = list(dict.fromkeys(req_keys))
+    unique_subsets = sfc.extract_real_obs_batch([real_requests[req_keys.index(k)] for k in unique_keys],
+                                                real_varnames, max_time_allowed, ceil_thres, 
+                                                nprocs=nprocs_real, cache_dir=iem_cache_dir)
+    unique_subsets = [sfc.convert_real_obs(subset) for subset in unique_subsets]
+    real_subsets = [unique_subsets[unique_keys.index(k)] for k in req_keys]
+
+    # Climatology statistics are shared by the experiments in each group (only the most recent group is
+    # retained)
+    climo_key = None
+    combined_ds = []
+
+    for iw, w in enumerate(windows):
+        real_obs_dir, startdate, enddate, fake_obs_dir, analysis_days, cache_name, out_fname = \
+            [w[k] for k in window_keys]
+        state = window_state[iw]
+        settings = state['settings']
+        saved_fname = state['saved_fname']
+        saved_avail = state['saved_avail']
+        new_cells = state['new_cells']
+        restats = state['restats']
+        all_data = state['all_data']
+        fake_stations = state['fake_stations']
+        fake_stations_z = state['fake_stations_z']
+        real_stations = state['real_stations']
+        all_zscores = state['all_zscores']
+        analysis_times = state['analysis_times']
+        var_units = state['var_units']
+        window_state[iw] = None
+        nstations = len(station_ids)
+        ndays = len(analysis_days)
+        ntimes = len(analysis_times)
+        if len(windows) > 1:
+            print()
+            print('window %d: %s to %s, %s' % (iw, startdate, enddate, fake_obs_dir))
+
+        if not saved_avail:
+
+            # Insert real obs
+            for req, subset in zip(real_requests, real_subsets):
+                if req['window'] != iw:
+                    continue
+                sfc.insert_real_obs(real_stations, subset, np.where(req['year_mask'])[0], 
+                                    np.where(req['day_mask'])[0], np.where(req['hour_mask'])[0], 
+                                    ndays, ntimes, partial=req['partial'])
+
+            # Extract fake observations (only files that contain missing entries are read)
+            print()
+            fake_vals = np.ones([nstations, len(fake_varnames + fake_varnames_noplot), ndays, ntimes]) * np.nan
+            fake_idx = [(i, j) for i in range(ndays) for j in range(ntimes) if np.any(new_cells[:, i, j])]
+            fake_fnames = ['%s/%s.sfc.fake.prepbufr.csv' % 
+                           (fake_obs_dir, (analysis_days[i] + analysis_times[j]).strftime('%Y%m%d%H%M'))
+                           for i, j in fake_idx]
+            full_bufr_csv = None
+            for (i, j), bufr_csv in zip(fake_idx, sfc.prefetch(sfc.read_fake_obs_file, fake_fnames, 
+                                                               depth=fake_obs_prefetch)):
+                time = analysis_days[i] + analysis_times[j]
+                print(time.strftime('%Y%m%d %H:%M'))
+                if bufr_csv is None:
+                    print('file not found, continuing to next time')
+                    continue
+                full_bufr_csv = bufr_csv
+    
+                # Remove rows that do not have thermodynamic AND kinematic data
+                bufr_csv_no_nan = full_bufr_csv.df.loc[np.logical_not(np.isnan(full_bufr_csv.df['TOB']) |
+                                                                      np.isnan(full_bufr_csv.df['UOB']))].copy()
+
+                # Group by station once and scatter the closest ob for each station into fake_vals
+                fake_vals[:, :, i, j], found = sfc.extract_fake_obs(bufr_csv_no_nan, station_ids, 
+                                                                    fake_varnames + fake_varnames_noplot,
+                                                                    max_time_allowed)
+                for ID in np.array(station_ids)[~found & new_cells[:, i, j]]:
+                    print('no simulated obs for %s' % ID)
+
+            if full_bufr_csv is not None:
+                var_units.update({v:full_bufr_csv.meta[v]['units'] for v in fake_varnames})
+
+            # Insert the new fake obs, then perform pressure and temperature adjustment and convert ceiling
+            # from gpm to km for the new entries
+            print()
+            g = 9.81
+            Rd = 287.04
+            lr = 0.0065  # Based on US Standard Atmosphere, see Part 4, Table I from https://ntrs.nasa.gov/citations/19770009539
+            for n, ID in enumerate(station_ids):
+                cells = new_cells[n]
+                if not np.any(cells):
+                    continue
+                fake = fake_stations[ID]
+                for m, v in enumerate(fake_varnames + fake_varnames_noplot):
+                    fake[v][cells] = fake_vals[n, m][cells]
+
+                elv_diff = (np.unique(real_stations[ID]['elevation'][~np.isnan(real_stations[ID]['elevation'])])[0] -
+                            np.unique(fake['ELV'][~np.isnan(fake['ELV'])])[0]) 
+                print('%s, elev diff = %.1f' % (ID, elv_diff))
+                if elv_adjust_prs:
+                    # Use hydrostatic balance for the adjustment
+                    fake.setdefault('POB_original', np.ones([ndays, ntimes]) * np.nan)
+                    fake['POB_original'][cells] = fake['POB'][cells]
+                    fake['POB'][cells] = (fake['POB'][cells] * 
+                                          np.exp(-g * elv_diff / (Rd * (fake['TOB'][cells] + 273.15))))
+                if elv_adjust_T:
+                    # Adjust based on a specified lapse rate
+                    fake.setdefault('TOB_original', np.ones([ndays, ntimes]) * np.nan)
+                    fake['TOB_original'][cells] = fake['TOB'][cells]
+                    fake['TOB'][cells] = fake['TOB'][cells] - (lr * elv_diff)
+
+                fake['ceil'][cells] = 1e-3 * (metconv.geopotential_to_height(fake['ceil'][cells] * metconv.g) -
+                                              metconv.geopotential_to_height(fake['ELV'][cells] * metconv.g))
+
+            # Compute binary ceiling
+            for ID in station_ids:
+                fake_stations[ID]['bin_ceil'] = np.float64(~np.isnan(fake_stations[ID]['ceil']))
+                fake_stations[ID]['bin_ceil'][np.isnan(fake_stations[ID]['TOB'])] = np.nan
+                tot_obs = np.count_nonzero(~np.isnan(fake_stations[ID]['bin_ceil']))
+                fake_stations[ID]['frac_ceil'] = np.nansum(fake_stations[ID]['bin_ceil']) / tot_obs
+                fake_stations[ID]['frac_ceil_thres'] = np.zeros(len(ceil_thres))
+                for l, thres in enumerate(ceil_thres):
+                    fake_stations[ID]['frac_ceil_thres'][l] = np.nansum(fake_stations[ID]['ceil'] <= thres) / tot_obs
+
+            # Swap fake obs with real obs if desired
+            if swap_obs:
+                iyr = np.where(years == swap_year)[0][0]
+                istart = iyr * ndays
+                iend = istart + ndays 
+                for ID in station_ids:
+                    for v in fake_varnames:
+                        fake_stations[ID][v] = real_stations[ID][v][istart:iend]
+                    fake_stations[ID]['ceil'] = real_stations[ID]['ceil'][iyr, :]
+                    fake_stations[ID]['frac_ceil'] = real_stations[ID]['frac_ceil'][iyr]
+                    fake_stations[ID]['frac_ceil_thres'] = real_stations[ID]['frac_ceil_thres'][:, iyr]
+                    fake_stations[ID]['bin_ceil'] = np.float64(~np.isnan(fake_stations[ID]['ceil']))
+
+            # Determine which z-scores and ranks need to be computed
+            if restats:
+                stale = np.ones([nstations, ndays, ntimes], dtype=bool)
+                all_zscores = {v:np.ones([ndays*nstations, ntimes]) * np.nan for v in fake_varnames}
+                if create_bootstrap_null:
+                    all_null = {v:np.ones([nstations, ndays, ntimes, len(years)]) * np.nan 
+                                for v in fake_varnames}
+                    all_z_pct = {v:np.ones([ndays*nstations, ntimes]) * np.nan for v in fake_varnames}
+                if save_rank:
+                    all_rank = {v:np.ones([ndays*nstations, ntimes]) * np.nan for v in fake_varnames}
+                    all_rank['ceil'] = np.ones([nstations, len(ceil_thres)]) * np.nan
+                    all_rank_nobs = {v:np.zeros([ndays*nstations, ntimes]) for v in fake_varnames}
+            else:
+                stale = new_cells
+                if climo_pool_days > 0:
+                    # The pooled climatology changes for days within climo_pool_days of a new day
+                    stale = sfc.rolling_day_sum(np.int64(stale), climo_pool_days) > 0
+                if create_bootstrap_null:
+                    all_null = {v:np.stack([all_data['bootstrap_null'][ID][v] for ID in station_ids]) 
+                                for v in fake_varnames}
+                    all_z_pct = all_data['all_z_pct']
+                if save_rank:
+                    all_rank = all_data['all_rank']
+                    all_rank_nobs = all_data['all_rank_nobs']
+
+            # Compute z-scores, the bootstrap null distribution (created by replacing each year in the 
+            # climo with the NR and computing the z-score of the year that was removed), the percentile of
+            # the NR z-score within the null distribution, and the rank of the NR compared to the obs (note
+            # that these ranks are fractions b/c not all distributions have the same number of values).
+            # These are computed for all stale stations, days, and times at once
+            print()
+            print('computing standardized anomalies...')
+            if climo_key != (w['group'], stale.tobytes()):
+                climo_key = (w['group'], stale.tobytes())
+                climo_cache = {}
+                store = None
+                if use_climo_store:
+                    store_config = {'real_obs_dir':real_obs_dir, 'startdate':startdate, 
+                                    'enddate':enddate, 'max_time_allowed':max_time_allowed,
+                                    'station_ids':station_ids, 'years':years, 
+                                    'analysis_days':analysis_days, 'analysis_times':analysis_times, 
+                                    'varnames':fake_varnames, 'climo_pool_days':climo_pool_days}
+                    store_inputs = ['%s/%s_%d%s_%d%s.txt' % (real_obs_dir, ID, yr, startdate, yr, 
+                                                             enddate)
+                                    for ID in station_ids for yr in years]
+                    store_fname = cache.entry_fname(cache_dir, climo_store_name, store_config, 
+                                                    inputs=store_inputs, ext='.nc', 
+                                                    scope=cache_scope)
+                    try:
+                        with xr.open_dataset(store_fname) as store:
+                            store = store.load()
+                        cache.touch(store_fname)
+                    except FileNotFoundError:
+                        print('building climatology store')
+                        store = sfc.build_climo_store(real_stations, station_ids, fake_varnames, 
+                                                      years, analysis_days, analysis_times,
+                                                      ndays_pool=climo_pool_days)
+                        sfc.write_station_dataset(store, store_fname)
             for v in fake_varnames:
-                fake_stations[ID][v] = real_stations[ID][v][istart:iend]
-            fake_stations[ID]['ceil'] = real_stations[ID]['ceil'][iyr, :]
-            fake_stations[ID]['frac_ceil'] = real_stations[ID]['frac_ceil'][iyr]
-            fake_stations[ID]['frac_ceil_thres'] = real_stations[ID]['frac_ceil_thres'][:, iyr]
-            fake_stations[ID]['bin_ceil'] = np.float64(~np.isnan(fake_stations[ID]['ceil']))
-
-    # Compute z-scores for fake stations
-    # For modified z-scores explanation, see here: 
-    # https://medium.com/analytics-vidhya/anomaly-detection-by-modified-z-score-f8ad6be62bac
-    print()
-    print('computing standardized anomalies...')
-    fake_stations_z = {}
-    all_zscores = {}
-    if create_bootstrap_null:
-        bootstrap_null = {}
-        fake_stations_z_pct = {}
-        all_z_pct = {}
-    for v in fake_varnames:
-        all_zscores[v] = np.zeros([ndays*len(station_ids), ntimes])
-        if create_bootstrap_null:
-            all_z_pct[v] = np.zeros([ndays*len(station_ids), ntimes])
-    for i, ID in enumerate(station_ids):
-        fake_stations_z[ID] = {}
-        if create_bootstrap_null:
-            bootstrap_null[ID] = {}
-            fake_stations_z_pct[ID] = {}
-        for v in fake_varnames:
-            fake_stations_z[ID][v] = np.zeros([ndays, ntimes])
+                fake_cube = sfc.station_cube(fake_stations, station_ids, v)[stale]
+                if v not in climo_cache:
+                    real_cube = None
+                    summary = None
+                    if store is not None:
+                        summary = sfc.climo_store_summary(store, v, stale)
+                    elif climo_pool_days > 0:
+                        summary = sfc.pooled_climo_summary(sfc.station_cube(real_stations, station_ids,
+                                                                            v, len(years)),
+                                                           climo_pool_days)
+                        summary = {key:summary[key][stale] for key in summary}
+                    if (summary is None) or create_bootstrap_null:
+                        real_cube = sfc.station_cube(real_stations, station_ids, v, len(years))[stale]
+                    climo_cache[v] = (real_cube, summary, 
+                                      sfc.climo_stats(real_cube, zscore_min_pts, zscore=zscore, 
+                                                      summary=summary))
+                real_cube, summary, climo = climo_cache[v]
+                z = sfc.compute_zscore(fake_cube, real_cube, zscore_min_pts, zscore=zscore, 
+                                       climo=climo)
+                all_zscores[v].reshape(nstations, ndays, ntimes)[stale] = z
+                if create_bootstrap_null:
+                    null = sfc.bootstrap_null(fake_cube, real_cube, zscore_min_pts, zscore=zscore)
+                    all_null[v][stale] = null
+                    all_z_pct[v].reshape(nstations, ndays, ntimes)[stale] = sfc.bootstrap_percentile(null, z)
+                if save_rank:
+                    rank, nobs = sfc.compute_rank(fake_cube, real_cube, zscore_min_pts, 
+                                                  summary=summary)
+                    all_rank[v].reshape(nstations, ndays, ntimes)[stale] = rank
+                    all_rank_nobs[v].reshape(nstations, ndays, ntimes)[stale] = nobs
+
+            fake_stations_z = {}
             if create_bootstrap_null:
-                bootstrap_null[ID][v] = np.zeros([ndays, ntimes, len(years)])
-                fake_stations_z_pct[ID][v] = np.zeros([ndays, ntimes])
-            for k in range(ndays):
-                if zscore == 'regular':
-                    ctr = np.nanmean(real_stations[ID][v][k::ndays, :], axis=0)
-                    spd = np.nanstd(real_stations[ID][v][k::ndays, :], axis=0)
+                bootstrap_null = {}
+                fake_stations_z_pct = {}
+            if save_rank:
+                fake_station_rank = {}
+            for i, ID in enumerate(station_ids):
+                fake_stations_z[ID] = {}
+                if create_bootstrap_null:
+                    bootstrap_null[ID] = {}
+                    fake_stations_z_pct[ID] = {}
+                if save_rank:
+                    fake_station_rank[ID] = {}
+                for v in fake_varnames:
+                    fake_stations_z[ID][v] = all_zscores[v][(i*ndays):((i+1)*ndays), :]
                     if create_bootstrap_null:
-                        for l in range(len(years)):
-                            sample_real = real_stations[ID][v][k::ndays, :].copy()
-                            sample_fake = sample_real[l, :]
-                            sample_real[l, :] = fake_stations[ID][v][k, :]
-                            sample_ctr = np.nanmean(sample_real, axis=0)
-                            sample_spd = np.nanstd(sample_real, axis=0)
-                            sample_spd[np.sum(~np.isnan(sample_real), axis=0) < zscore_min_pts] = np.nan
-                            sample_spd[np.isclose(sample_spd, 0)] = np.nan
-                            bootstrap_null[ID][v][k, :, l] = (sample_fake - sample_ctr) / sample_spd
-                elif zscore == 'modified':
-                    ctr = np.nanmedian(real_stations[ID][v][k::ndays, :], axis=0)
-                    spd = 1.4826 * ss.median_abs_deviation(real_stations[ID][v][k::ndays, :], axis=0, 
-                                                           nan_policy='omit')
-
-                # Set Z-score to NaN if the spread is close to 0 or if the number of climo data 
-                # points < zscore_min_pts
-                spd[np.sum(~np.isnan(real_stations[ID][v][k::ndays, :]), axis=0) < zscore_min_pts] = np.nan
-                spd[np.isclose(spd, 0)] = np.nan
-                fake_stations_z[ID][v][k, :] = (fake_stations[ID][v][k, :] - ctr) / spd
-                all_zscores[v][i*ndays+k, :] = fake_stations_z[ID][v][k, :]
+                        bootstrap_null[ID][v] = all_null[v][i]
+                        fake_stations_z_pct[ID][v] = all_z_pct[v][(i*ndays):((i+1)*ndays), :]
+                    if save_rank:
+                        fake_station_rank[ID][v] = all_rank[v][(i*ndays):((i+1)*ndays), :]
+
+                # Ceiling obs
+                if save_rank:
+                    if np.any(stale[i]):
+                        fake_station_rank[ID]['ceil'] = np.zeros(len(ceil_thres))
+                        for j in range(len(ceil_thres)):
+                            # Special case if frac_ceil_thres = 0 or 1. Don't want to set rank to 0 (1) if 
+                            # some of the years in the climo also have frac_ceil_thres = 0 (1). Place NR in
+                            # the middle of the 0s (1s) instead
+                            if np.isclose(fake_stations[ID]['frac_ceil_thres'][j], 0):
+                                fake_station_rank[ID]['ceil'][j] = (np.ceil(0.5*np.sum(np.isclose(real_stations[ID]['frac_ceil_thres'][j, :], 0))) / 
+                                                                    len(real_stations[ID]['frac_ceil_thres'][j, :]))
+                            elif np.isclose(fake_stations[ID]['frac_ceil_thres'][j], 1):
+                                fake_station_rank[ID]['ceil'][j] = (np.ceil(0.5*np.sum(np.isclose(real_stations[ID]['frac_ceil_thres'][j, :], 1))) / 
+                                                                    len(real_stations[ID]['frac_ceil_thres'][j, :]))
+                            else:
+                                combined_array = np.array([fake_stations[ID]['frac_ceil_thres'][j]] +
+                                                           list(real_stations[ID]['frac_ceil_thres'][j, :]))
+                                combined_array = combined_array[~np.isnan(combined_array)]
+                                fake_station_rank[ID]['ceil'][j] = np.where(np.argsort(combined_array) == 0)[0][0] / (combined_array.size - 1)
+                        all_rank['ceil'][i, :] = fake_station_rank[ID]['ceil']
+                    else:
+                        fake_station_rank[ID]['ceil'] = all_rank['ceil'][i, :]
+
+            # Save output to netCDF file for use later (and/or combine with other experiments)
+            if use_saved or (experiments is not None):
+                all_data = {}
+                all_data['fake_stations'] = fake_stations
+                all_data['fake_stations_z'] = fake_stations_z
+                all_data['real_stations'] = real_stations
+                all_data['all_zscores'] = all_zscores
+                all_data['analysis_times'] = analysis_times
+                all_data['ceil_thres'] = ceil_thres
+                all_data.update(settings)
                 if create_bootstrap_null:
-                    for l in range(ntimes):
-                        npts = np.sum(~np.isnan(bootstrap_null[ID][v][k, l, :]))
-                        if npts > 0:
-                            fake_stations_z_pct[ID][v][k, l] = (np.sum(bootstrap_null[ID][v][k, l, :] < 
-                                                                       fake_stations_z[ID][v][k, l]) / npts)
-                        else:
-                            fake_stations_z_pct[ID][v][k, l] = np.nan
-                    all_z_pct[v][i*ndays+k, :] = fake_stations_z_pct[ID][v][k, :]
-
-    # Compute rank of the NR compared to the obs (note that these ranks are fractions b/c not all
-    # distributions have the same number of values)
-    if save_rank:
-        fake_station_rank = {}
-        all_rank = {'ceil':np.zeros([len(station_ids), len(ceil_thres)])}
-        all_rank_nobs = {}
-        for v in fake_varnames:
-            all_rank[v] = np.zeros([ndays*len(station_ids), ntimes])
-            all_rank_nobs[v] = np.zeros([ndays*len(station_ids), ntimes])
-        for i, ID in enumerate(station_ids):
-            fake_station_rank[ID] = {}
-            for v in fake_varnames:
-                fake_station_rank[ID][v] = np.zeros([ndays, ntimes])
-                for k in range(ndays):
-                    for l in range(ntimes):
-                        if (np.isnan(fake_stations[ID][v][k, l]) or 
-                            (np.sum(~np.isnan(real_stations[ID][v][k::ndays, l])) < zscore_min_pts)):
-                            fake_station_rank[ID][v][k, l] = np.nan
-                            continue
-                        combined_array = np.array([fake_stations[ID][v][k, l]] +
-                                                  list(real_stations[ID][v][k::ndays, l]))
-                        combined_array = combined_array[~np.isnan(combined_array)]
-                        fake_station_rank[ID][v][k, l] = np.where(np.argsort(combined_array) == 0)[0][0] / (combined_array.size - 1)
-                        all_rank_nobs[v][i*ndays+k, l] = combined_array.size - 1
-                    all_rank[v][i*ndays+k, :] = fake_station_rank[ID][v][k, :]
-            # Ceiling obs
-            fake_station_rank[ID]['ceil'] = np.zeros(len(ceil_thres))
-            for j in range(len(ceil_thres)):
-                # Special case if frac_ceil_thres = 0 or 1. Don't want to set rank to 0 (1) if some 
-                # of the years in the climo also have frac_ceil_thres = 0 (1). Place NR in the 
-                # middle of the 0s (1s) instead
-                if np.isclose(fake_stations[ID]['frac_ceil_thres'][j], 0):
-                    fake_station_rank[ID]['ceil'][j] = (np.ceil(0.5*np.sum(np.isclose(real_stations[ID]['frac_ceil_thres'][j, :], 0))) / 
-                                                        len(real_stations[ID]['frac_ceil_thres'][j, :]))
-                elif np.isclose(fake_stations[ID]['frac_ceil_thres'][j], 1):
-                    fake_station_rank[ID]['ceil'][j] = (np.ceil(0.5*np.sum(np.isclose(real_stations[ID]['frac_ceil_thres'][j, :], 1))) / 
-                                                        len(real_stations[ID]['frac_ceil_thres'][j, :]))
-                else:
-                    combined_array = np.array([fake_stations[ID]['frac_ceil_thres'][j]] +
-                                               list(real_stations[ID]['frac_ceil_thres'][j, :]))
-                    combined_array = combined_array[~np.isnan(combined_array)]
-                    fake_station_rank[ID]['ceil'][j] = np.where(np.argsort(combined_array) == 0)[0][0] / (combined_array.size - 1)
-            all_rank['ceil'][i, :] = fake_station_rank[ID]['ceil']
-
-    # Save output to pickle file for use later
-    if use_pickle:
-        all_data = {}
-        all_data['fake_stations'] = fake_stations
-        all_data['fake_stations_z'] = fake_stations_z
-        all_data['real_stations'] = real_stations
-        all_data['all_zscores'] = all_zscores
-        all_data['analysis_times'] = analysis_times
-        all_data['elv_adjust_prs'] = elv_adjust_prs
-        all_data['elv_adjust_T'] = elv_adjust_T
-        all_data['ceil_thres'] = ceil_thres
-        if create_bootstrap_null:
-            all_data['bootstrap_null'] = bootstrap_null
-            all_data['fake_stations_z_pct'] = fake_stations_z_pct
-            all_data['all_z_pct'] = all_z_pct
-        if save_rank:
-            all_data['fake_station_rank'] = fake_station_rank
-            all_data['all_rank'] = all_rank
-            all_data['all_rank_nobs'] = all_rank_nobs
-        with open(pickle_fname, 'wb') as handle:
-            pickle.dump(all_data, handle)
-
-
-#---------------------------------------------------------------------------------------------------
-# Plot results
-#---------------------------------------------------------------------------------------------------
-
-print()
-print('creating plots...')
-
-ncols = 4
-plot_hr = np.array([t.total_seconds() / 3600. for t in analysis_times])
-fig_ztot, axes_ztot = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
-plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
-for ID in station_ids:
-    fig, axes = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
-    plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
-    fig_z, axes_z = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
-    plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
-    for j, v in enumerate(fake_varnames):
-        ax = axes[int(j/ncols), j%ncols]
-        ax_z = axes_z[int(j/ncols), j%ncols]
-
-        # Plot fake station data
-        for k in range(ndays):
-            ax.plot(plot_hr, fake_stations[ID][v][k, :], 'k-', lw=0.75)
-            ax_z.plot(plot_hr, fake_stations_z[ID][v][k, :], 'k-', lw=0.75)
-    
-        ax_z.axhline(zcutoff, c='r', ls='-', lw=1.5)
-        ax_z.axhline(-zcutoff, c='r', ls='-', lw=1.5)
-
-        # Plot real station data percentiles
-        pcts = [0, 10, 25, 50, 75, 90, 100]
-        var_percentiles = {}
-        for p in pcts:
-            var_percentiles[p] = np.zeros(ntimes)
-            for l in range(ntimes):
-                var_percentiles[p][l] = np.nanpercentile(real_stations[ID][v][:, l], p) 
-        
-        ax.plot(plot_hr, var_percentiles[50], 'r-', lw=2)
-        ax.fill_between(plot_hr, var_percentiles[25], var_percentiles[75], color='r', alpha=0.4)
-        ax.fill_between(plot_hr, var_percentiles[10], var_percentiles[90], color='r', alpha=0.2)
-        ax.plot(plot_hr, var_percentiles[0], 'r-', lw=0.5)
-        ax.plot(plot_hr, var_percentiles[100], 'r-', lw=0.5)
-
-        ax.set_ylabel('%s (%s)' % (v, full_bufr_csv.meta[v]['units']), size=14)
-        ax_z.set_ylabel('%s z-score' % v, size=14)
-        for a in [ax, ax_z]:
-            a.grid()
-            a.set_xlim([plot_hr.min(), plot_hr.max()])
-    for j in range(ncols):
-        if j != 3:
-            axes[-1, j].set_xlabel('hour', size=14)
-            axes_z[-1, j].set_xlabel('hour', size=14)
-        axes[0, 3].set_xlabel('hour', size=14)
-        axes_z[0, 3].set_xlabel('hour', size=14)
-
-    # Add fraction of time with a ceiling in the final subplot
-    ax = axes[1, 3]
-    if ceil_plot == 'binary':
-        ax.hist(real_stations[ID]['frac_ceil'], color='red')
-        ax.axvline(fake_stations[ID]['frac_ceil'], c='k', lw=2)
-        ax.set_xlabel('fraction of time with ceiling', size=10)
-        ax.set_ylabel('number of years', size=14)
-        ax.set_xlim([0, 1])
-    elif ceil_plot == 'hgt':
-        bins = np.arange(0, 12.5, 0.5)
-        ctrs = 0.5 * (bins[1:] + bins[:-1]) 
-        
-        real_cdf = np.zeros([len(years), len(ctrs)])
-        for j in range(len(years)):
-            tmp, _ = np.histogram(real_stations[ID]['ceil'][j, :], bins=bins)
-            real_cdf[j, :] = (np.array([np.sum(tmp[:(n+1)]) for n in range(len(tmp))]) / 
-                              real_stations[ID]['n_skyl'][j])
-        pcts = [0, 10, 25, 50, 75, 90, 100]
-        var_percentiles = {}
-        for p in pcts:
-            var_percentiles[p] = np.zeros(len(ctrs))
-            for l in range(len(ctrs)):
-                var_percentiles[p][l] = np.nanpercentile(real_cdf[:, l], p) 
-        
-        ax.plot(ctrs, var_percentiles[50], 'r-', lw=2)
-        ax.fill_between(ctrs, var_percentiles[25], var_percentiles[75], color='r', alpha=0.4)
-        ax.fill_between(ctrs, var_percentiles[10], var_percentiles[90], color='r', alpha=0.2)
-        ax.plot(ctrs, var_percentiles[0], 'r-', lw=0.5)
-        ax.plot(ctrs, var_percentiles[100], 'r-', lw=0.5)
-        
-        tmp, _ = np.histogram(fake_stations[ID]['ceil'], bins=bins)
-        fake_cdf = (np.array([np.sum(tmp[:(n+1)]) for n in range(len(tmp))]) / 
-                    np.count_nonzero(~np.isnan(fake_stations[ID]['bin_ceil'])))
-        ax.plot(ctrs, fake_cdf, 'k-')
-        ax.set_xlabel('cloud ceiling (km)', size=14)
-        ax.set_ylabel('cumulative fraction of days', size=14)
-        ax.set_xlim([0, 12])
-        ax.set_ylim([0, 1])
-
-    ax.grid()
-
-    for f, tag, ttl in zip([fig, fig_z], [ID, '%s_z%s' % (ID, zscore)], 
-                           [ID, '%s: %s z-score' % (ID, zscore)]):
-        plt.figure(f.number)
-        plt.suptitle(ttl, size=18)
-        plt.savefig(out_fname % tag)
-        plt.close()
-
-# Make ztot figure
-fig, axes = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
-plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
-for i, v in enumerate(fake_varnames):
-    ax = axes[int(i/ncols), i%ncols]
-        
-    pcts = [0, 10, 25, 50, 75, 90, 100]
-    var_percentiles = {}
-    for p in pcts:
-        var_percentiles[p] = np.zeros(ntimes)
-        for l in range(ntimes):
-            var_percentiles[p][l] = np.nanpercentile(all_zscores[v][:, l], p) 
-        
-    ax.plot(plot_hr, var_percentiles[50], 'k-', lw=2)
-    ax.fill_between(plot_hr, var_percentiles[25], var_percentiles[75], color='k', alpha=0.4)
-    ax.fill_between(plot_hr, var_percentiles[10], var_percentiles[90], color='k', alpha=0.2)
-    ax.plot(plot_hr, var_percentiles[0], 'k-', lw=0.5)
-    ax.plot(plot_hr, var_percentiles[100], 'k-', lw=0.5)
-
-    ax.grid()
-    ax.axhline(zcutoff, c='r', ls='-', lw=1.5)
-    ax.axhline(-zcutoff, c='r', ls='-', lw=1.5)
-    ax.set_ylabel('%s z-score' % v, size=14)
-    ax.set_xlim([plot_hr.min(), plot_hr.max()])
-for i in range(ncols):
-    if i != 3:
-        axes[-1, i].set_xlabel('hour', size=14)
-    axes[0, 3].set_xlabel('hour', size=14)
-plt.suptitle('all stations: %s z-score' % zscore, size=18)
-plt.savefig(out_fname % ('all_z_%s' % zscore))
-plt.close()
+                    all_data['bootstrap_null'] = bootstrap_null
+                    all_data['fake_stations_z_pct'] = fake_stations_z_pct
+                    all_data['all_z_pct'] = all_z_pct
+                if save_rank:
+                    all_data['fake_station_rank'] = fake_station_rank
+                    all_data['all_rank'] = all_rank
+                    all_data['all_rank_nobs'] = all_rank_nobs
+                ds = sfc.stations_to_dataset(all_data, years, analysis_days, var_units=var_units)
+            if use_saved:
+                sfc.write_station_dataset(ds, saved_fname)
+                if len(station_chunks) == 1:
+                    cache.evict(cache_dir, max_entries=cache_max_entries, max_gb=cache_max_gb,
+                                scope=cache_scope)
+        if saved_avail and (experiments is not None):
+            with xr.open_dataset(saved_fname) as ds:
+                ds = ds.load()
+        if use_saved:
+            chunk_fnames[iw].append(saved_fname)
+            if len(station_chunks) == 1:
+                cache.publish(saved_fname, final_fname % cache_name)
+
+        # Combine all experiments for this group
+        if experiments is not None:
+            combined_ds.append(ds)
+            if (iw == len(windows) - 1) or (windows[iw+1]['group'] != w['group']):
+                ds = sfc.combine_experiments(combined_ds, list(experiments.keys()),
+                                             [v['fake_obs_dir'] for v in windows 
+                                              if v['group'] == w['group']])
+                print('writing %s' % (combined_fname % (w['group_name'] + chunk_tag)))
+                sfc.write_station_dataset(ds, combined_fname % (w['group_name'] + chunk_tag))
+                combined_ds = []
+
+        # Plot results
+        if make_plots != 'none':
+            print()
+            print('creating plots...')
+            plot_hr = np.array([t.total_seconds() / 3600. for t in analysis_times])
+            plot_kw = {'plot_hr':plot_hr, 'zcutoff':zcutoff, 'zscore':zscore, 'out_fname':out_fname}
+
+        if make_plots == 'all':
+
+            # Ceiling CDFs for all stations and years (only needed if ceil_plot = 'hgt')
+            real_ceil_cdf = None
+            fake_ceil_cdf = None
+            ctrs = None
+            if ceil_plot == 'hgt':
+                bins = np.arange(0, 12.5, 0.5)
+                ctrs = 0.5 * (bins[1:] + bins[:-1]) 
+                real_ceil_cdf = sfc.ceiling_cdf(np.array([real_stations[ID]['ceil'] for ID in station_ids]),
+                                                bins, np.array([real_stations[ID]['n_skyl'] for ID in station_ids]))
+                fake_ceil_cdf = sfc.ceiling_cdf(np.array([fake_stations[ID]['ceil'].ravel() for ID in station_ids]),
+                                                bins, np.array([np.count_nonzero(~np.isnan(fake_stations[ID]['bin_ceil'])) 
+                                                                for ID in station_ids]))
+
+            sfcplt.plot_all_stations(station_ids, fake_stations, fake_stations_z, real_stations, 
+                                     real_ceil_cdf, fake_ceil_cdf, nprocs=nprocs_plot, 
+                                     fake_varnames=fake_varnames, var_units=var_units, ceil_ctrs=ctrs,
+                                     ceil_plot=ceil_plot, **plot_kw)
+
+        # Make ztot figure (for station chunks, this is created after all chunks are assembled)
+        if (make_plots != 'none') and (len(station_chunks) == 1):
+            sfcplt.plot_zscore_summary(all_zscores, fake_varnames, **plot_kw)
+
+# Assemble the output for all station chunks
+if len(station_chunks) > 1:
+    for iw, w in enumerate(windows):
+        print()
+        print('assembling %d station chunks for %s' % (len(station_chunks), w['cache_name']))
+        ds = sfc.assemble_station_chunks(chunk_fnames[iw])
+        sfc.write_station_dataset(ds, final_fname % w['cache_name'])
+        if make_plots != 'none':
+            analysis_times = list(pd.to_timedelta(ds['hour'].values).to_pytimedelta())
+            plot_hr = np.array([t.total_seconds() / 3600. for t in analysis_times])
+            all_zscores = {v:ds['zscore'].sel(variable=v).values.reshape(-1, len(plot_hr))
+                           for v in fake_varnames}
+            sfcplt.plot_zscore_summary(all_zscores, fake_varnames, plot_hr, zcutoff=zcutoff,
+                                       zscore=zscore, out_fname=w['out_fname'])
+        ds.close()
+    cache.evict(cache_dir, max_entries=cache_max_entries, max_gb=cache_max_gb, scope=cache_scope)
 
 
 """
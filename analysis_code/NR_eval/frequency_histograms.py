@@ -14,13 +14,19 @@ Date Created: 8 March 2023
 #---------------------------------------------------------------------------------------------------
 
 import glob
+import fnmatch
 import datetime as dt
 import numpy as np
 import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 import sys
-import pickle
+import multiprocessing as mp
+import concurrent.futures as cf
+import functools
+
+import analysis_cache as cache
+import mrms_fcts as mrms
 
 
 #---------------------------------------------------------------------------------------------------
@@ -47,6 +53,11 @@ MRMS_path = '/work2/noaa/wrfruc/murdzek/real_obs/mrms'
 # MRMS years to use
 MRMS_years = np.arange(2016, 2024)
 
+# Optional: MRMS store created by make_mrms_store.py. If not None, MRMS fields are read from the 
+# store (which is cropped to the NR/MRMS common domain) rather than the raw GRIB2 files in MRMS_path.
+# The store must contain a file for each field and each year in MRMS_years
+MRMS_store_dir = None
+
 # Option to use days from MRMS before and after eval_dates. Offsets here are days relative to the 
 # first date in eval_dates
 MRMS_offset = [-7, 0, 7]
@@ -54,13 +65,19 @@ MRMS_offset = [-7, 0, 7]
 # Times to evaluate (strings, HHMM)
 eval_times = ['0000', '0600', '1200', '1800']
 
-# Field to evaluate (options: 'cref', 'precip1hr', 'precip6hr')
-#field = 'precip1hr'
-field = sys.argv[2]
+# Fields to evaluate (options: 'cref', 'precip1hr', 'precip6hr'). Multiple fields can be passed as
+# a comma-separated list
+#fields = ['precip1hr']
+fields = sys.argv[2].split(',')
+
+# Domains (options: 'all', 'easternUS'). Multiple domains can be passed as a comma-separated list
+#domains = ['all']
+domains = sys.argv[3].split(',')
 
-# Domain (options: 'all', 'easternUS')
-#domain = 'all'
-domain = sys.argv[3]
+# Option to zoom into the smallest precip rates for precip1hr or the highest reflectivities for cref
+# (i.e., the bin set). Multiple bin sets can be passed as a comma-separated list (e.g., '0,1')
+#zooms = [False]
+zooms = [bool(int(k)) for k in sys.argv[4].split(',')]
 
 # Optional: Link to MRMS and NR masks (these should be .npy objects). Set to None if not being used
 # Masks are created by the make_NR_MRMS_coverage_mask.py program
@@ -70,17 +87,33 @@ elif model == 'HRRR':
     NR_mask_file = './HRRR_mask_999.npy'
 MRMS_mask_file = './MRMS_mask_999.npy'
 
-# Option to zoom into the smallest precip rates for precip1hr or the highest reflectivities for cref
-#zoom = 0
-zoom = bool(int(sys.argv[4]))
-
 # Option to save/use output from a pickle file
-# If use_pickle is True, then the script will attempt to read the pickle file specified. If the file
-# is not found, that file will be written to.
+# If use_pickle is True, then the script will attempt to read the pickle file in cache_dir that 
+# matches the parameters above and the current input files. If the file is not found, that file 
+# will be written to. Least recently used pickle files are removed from cache_dir if there are more 
+# than cache_max_entries files or the files exceed cache_max_gb (set either to None for no limit)
+# A separate pickle file is used for each field, domain, and bin set. Only entries created by this
+# script count toward cache_max_entries and cache_max_gb
 use_pickle = True
-pickle_fname = './%s_%s_%s_spring.pkl' % (model, field, domain)
-
-# Output file
+cache_dir = './cache'
+cache_max_entries = 50
+cache_max_gb = None
+
+# Pickle files containing the final histograms, which are read by the scripts in fig_code (only
+# used if use_pickle = True). Include four %s placeholders for the model, field, domain, and bin set
+# ('' or '_zoom'). These are hard links to (or copies of) the cache entries, so they are not removed
+# when the cache entries are evicted
+final_fname = './%s_%s_%s%s_spring.pkl'
+
+# Number of worker processes used to read the MRMS files. Each worker reads all the MRMS files for
+# a subset of the MRMS years/offsets, and the resulting counts are added together in the parent 
+# process. MRMS files are read serially if nprocs = 1
+nprocs = 1
+if len(sys.argv) > 6:
+    nprocs = int(sys.argv[6])
+
+# Output file. Include four %s placeholders for the model, field, domain, and bin set ('regular' or
+# 'zoom') if more than one field, domain, or bin set is used
 #out_file = './NR_precip1hr_eval_all.png'
 out_file = sys.argv[5]
 
@@ -93,77 +126,245 @@ out_file = sys.argv[5]
 def precip_kgpm2_to_mm(x):
     return x * 1e3 / 997.
 
-start_time = dt.datetime.now()
+def find_MRMS_file(y, MRMS_time, MRMS_fname):
+    """
+    Find the MRMS file valid at MRMS_time. Returns the file name and the index of the matching
+    entry in MRMS_fname, or (None, None) if the file is missing
+    """
+
+    for n, f in enumerate(MRMS_fname):
+        fname_list = fnmatch.filter(MRMS_files[y], '%s/%d/%d%s*%s*' % 
+                                    (MRMS_path, y, y, MRMS_time.strftime('%m%d-%H%M'), f))
+        if len(fname_list) > 0:
+            return fname_list[0], n
+
+    return None, None
+
+
+def read_MRMS_field(y, MRMS_time, field, store):
+    """
+    Read the MRMS field valid at MRMS_time (using year y) from the raw GRIB2 files or the MRMS 
+    store. Also returns the number of gridpoints with MRMS coverage outside of the returned field 
+    (nonzero only for the MRMS store, which is cropped to the NR/MRMS common domain). Returns 
+    (None, 0) if the field is missing
+    """
+
+    if MRMS_store_dir is None:
+        fname, n = find_MRMS_file(y, MRMS_time, field_info[field]['MRMS_fname'])
+        if fname is None:
+            return None, 0
+        ds = xr.open_dataset(fname, engine='pynio')
+        field_data = ds[field_info[field]['MRMS_var'][n]].values
+        ds.close()
+        return field_data, 0
+    else:
+        try:
+            valid_time = MRMS_time.replace(year=int(y))
+        except ValueError:
+            return None, 0
+        field_data = mrms.read_store_time(store, field, valid_time)
+        if field_data is None:
+            return None, 0
+        return field_data, mrms.read_store_covered_outside(store, valid_time)
+
+
+def add_MRMS_masks(ds, domains):
+    """
+    Add the flat index of the valid gridpoints in each domain to MRMS_idx (and the flat index of the
+    remaining gridpoints to MRMS_out_idx) using the lat/lon coordinates from MRMS dataset ds (either
+    a raw GRIB2 file or an MRMS store)
+    """
+
+    MRMS_lon, MRMS_lat = np.meshgrid(ds['lon_0'].values - 360., ds['lat_0'].values)
+    mask_external = MRMS_mask_external
+    if (MRMS_store_dir is not None) and (type(MRMS_mask_external) == np.ndarray):
+        mask_external = MRMS_mask_external[mrms.store_bbox(ds)]
+    for domain in domains:
+        mask = (mask_external * ((MRMS_lat >= lat_lim[domain][0]) * 
+                                 (MRMS_lat <= lat_lim[domain][1]) * 
+                                 (MRMS_lon >= lon_lim[domain][0]) * 
+                                 (MRMS_lon <= lon_lim[domain][1]))) != 0
+        MRMS_idx[domain] = mrms.valid_index(mask)
+        MRMS_out_idx[domain] = mrms.valid_index(~mask)
+
+
+def MRMS_sample_counts(y, o, field, field_keys, times):
+    """
+    Histogram counts and number of points for a single MRMS sample (year and offset)
+
+    The MRMS masks are read from MRMS_idx and MRMS_out_idx, which must already contain all domains
+    in field_keys (worker processes inherit MRMS_idx and MRMS_out_idx from the parent process). Only
+    the valid gridpoints in each domain are histogrammed. If MRMS_store_dir is not None, the MRMS 
+    store for year y is opened by the worker
+
+    Parameters
+    ----------
+    y : integer
+        MRMS year
+    o : integer
+        MRMS offset (days)
+    field : string
+        Field
+    field_keys : list of tuples
+        Histograms to compute. Each entry is (field, domain, zoom)
+    times : list of dt.datetime
+        NR valid times
+
+    Returns
+    -------
+    counts : dictionary
+        Histogram counts. Keys are the entries in field_keys, then eval_times
+    pts : dictionary
+        Number of points. Keys are the entries in field_keys, then eval_times
+
+    """
+
+    info = field_info[field]
+    field_domains = list(dict.fromkeys([key[1] for key in field_keys]))
+    counts = {}
+    pts = {}
+    for key in field_keys:
+        counts[key] = {}
+        pts[key] = {}
+        for t in eval_times:
+            counts[key][t] = np.zeros(info['bins'][key[2]].size-1)
+            pts[key][t] = 0.
+
+    store = None
+    if MRMS_store_dir is not None:
+        store = mrms.open_store(MRMS_store_dir, field, y)
+
+    print()
+    print('extracting MRMS %s data for year = %d, offset = %d' % (field, y, o))
+    for t in times:
+        MRMS_time = t + dt.timedelta(days=float(o))
+        print('extracting MRMS data for %s' % MRMS_time.strftime('%m %d %H:%M'))
+        field_data, npts_outside = read_MRMS_field(y, MRMS_time, field, store)
+        if field_data is None:
+            print('MRMS data for %d-%s is missing!' % (y, MRMS_time.strftime('%m-%d %H:%M')))
+            continue
 
-# Try to read from pickle file
-if use_pickle:
-    try:
-        with open(pickle_fname, 'rb') as handle:
-            all_data = pickle.load(handle)
-        NR_total_counts = all_data['NR_total_counts']
-        NR_total_pts = all_data['NR_total_pts']
-        MRMS_freq = all_data['MRMS_freq']
-        yscale = all_data['yscale']
-        xlabel = all_data['xlabel']
-    except FileNotFoundError:
-        pickle_avail = False
-else:
-    pickle_avail = False
+        hhmm = t.strftime('%H%M')
+        for domain in field_domains:
+            MRMS_data = mrms.gather(field_data, MRMS_idx[domain])
+            # Number of points is all points in the domain plus covered points outside the domain
+            # (including covered points outside of the MRMS store grid)
+            npts = MRMS_idx[domain].size + npts_outside + np.count_nonzero(
+                   mrms.gather(field_data, MRMS_out_idx[domain]) > info['MRMS_no_coverage'])
+            for key in field_keys:
+                if key[1] != domain:
+                    continue
+                counts[key][hhmm] = (mrms.histogram(MRMS_data, info['bins'][key[2]]) + 
+                                     counts[key][hhmm])
+                pts[key][hhmm] = pts[key][hhmm] + npts
+
+    if store is not None:
+        store.close()
 
-if not pickle_avail:
+    return counts, pts
 
-    # Define necessary variables for each input field
+
+start_time = dt.datetime.now()
+
+# Define necessary variables for each input field. Bins are defined for each bin set (zoom)
+field_info = {}
+for field in fields:
     if field == 'cref':
         if model == 'NR':
             NR_var = 'REFC_P0_L200_GLC0'
         elif model == 'HRRR':
             NR_var = 'REFC_P0_L10_GLC0'
-        NR_transform = None
-        MRMS_var = ['MergedReflectivityQCComposite_P0_L102_GLL0']
-        MRMS_fname = ['MRMS_MergedReflectivityQCComposite']
-        MRMS_no_coverage = -999.
-        if zoom:
-            bins = np.arange(30, 76, 5)
-        else:
-            bins = np.arange(5, 76, 5)
-        xlabel = 'composite reflectivity (dBZ)'
-        yscale = 'linear'
+        field_info[field] = {'NR_var':NR_var,
+                             'NR_transform':None,
+                             'MRMS_var':mrms.products['cref']['MRMS_var'],
+                             'MRMS_fname':mrms.products['cref']['MRMS_fname'],
+                             'MRMS_no_coverage':-999.,
+                             'bins':{True:np.arange(30, 76, 5), False:np.arange(5, 76, 5)},
+                             'xlabel':'composite reflectivity (dBZ)',
+                             'yscale':'linear'}
     elif field == 'precip1hr':
-        NR_var = 'APCP_P8_L1_GLC0_acc'
-        NR_transform = precip_kgpm2_to_mm
-        MRMS_var = ['VAR_209_6_37_P0_L102_GLL0', 'GaugeCorrQPE01H_P0_L102_GLL0']
-        MRMS_fname = ['MRMS_MultiSensor_QPE_01H_Pass2', 'MRMS_GaugeCorr_QPE_01H']
-        MRMS_no_coverage = -3.
-        if zoom:
-            bins = np.arange(0.5, 15, 0.5)
-        else:
-            bins = np.arange(1, 150, 5)
-        xlabel = '1-hr total precip (mm)'
-        yscale = 'log'
+        field_info[field] = {'NR_var':'APCP_P8_L1_GLC0_acc',
+                             'NR_transform':precip_kgpm2_to_mm,
+                             'MRMS_var':mrms.products['precip1hr']['MRMS_var'],
+                             'MRMS_fname':mrms.products['precip1hr']['MRMS_fname'],
+                             'MRMS_no_coverage':-3.,
+                             'bins':{True:np.arange(0.5, 15, 0.5), False:np.arange(1, 150, 5)},
+                             'xlabel':'1-hr total precip (mm)',
+                             'yscale':'log'}
     elif field == 'precip6hr':
-        NR_var = 'APCP_P8_L1_GLC0_acc'
-        NR_transform = precip_kgpm2_to_mm
-        MRMS_var = ['VAR_209_6_39_P0_L102_GLL0', 'GaugeCorrQPE06H_P0_L102_GLL0']
-        MRMS_fname = ['MRMS_MultiSensor_QPE_06H_Pass2', 'MRMS_GaugeCorr_QPE_06H']
-        MRMS_no_coverage = -3.
-        if zoom:
-            bins = np.arange(0.5, 15, 0.5)
+        field_info[field] = {'NR_var':'APCP_P8_L1_GLC0_acc',
+                             'NR_transform':precip_kgpm2_to_mm,
+                             'MRMS_var':mrms.products['precip6hr']['MRMS_var'],
+                             'MRMS_fname':mrms.products['precip6hr']['MRMS_fname'],
+                             'MRMS_no_coverage':-3.,
+                             'bins':{True:np.arange(0.5, 15, 0.5), False:np.arange(1, 200, 5)},
+                             'xlabel':'6-hr total precip (mm)',
+                             'yscale':'log'}
+
+# Add 0 to MRMS_offset if empty
+if len(MRMS_offset) == 0:
+    MRMS_offset = [0]
+
+# Spatial domain limits
+lat_lim = {}
+lon_lim = {}
+for domain in domains:
+    if domain == 'all':
+        lat_lim[domain] = [5, 70]
+        lon_lim[domain] = [-150, -40]
+    elif domain == 'easternUS':
+        lat_lim[domain] = [5, 70]
+        lon_lim[domain] = [-100, -40]
+
+# All requested histograms. Each histogram is identified by (field, domain, zoom)
+hist_keys = [(f, d, z) for f in fields for d in domains for z in zooms]
+hists = {}
+
+# Try to read from pickle files. Each file name is a hash of all parameters that affect the 
+# histogram plus the size and modification time of the input files. The MRMS inputs are the MRMS
+# store files (if used) or the raw MRMS files that are read for eval_dates and eval_times (found
+# using a single listing of each MRMS directory for each field)
+pickle_fname = {}
+MRMS_inputs = {}
+for key in hist_keys:
+    field, domain, zoom = key
+    info = field_info[field]
+    if not use_pickle:
+        continue
+    config = {'model':model, 'field':field, 'domain':domain, 'eval_dates':eval_dates, 
+              'eval_times':eval_times, 'NR_path':NR_path, 'NR_var':info['NR_var'], 
+              'NR_transform':(None if info['NR_transform'] is None else 
+                              info['NR_transform'].__name__),
+              'MRMS_path':MRMS_path, 'MRMS_years':MRMS_years, 'MRMS_offset':MRMS_offset, 
+              'MRMS_var':info['MRMS_var'], 'MRMS_fname':info['MRMS_fname'], 
+              'MRMS_no_coverage':info['MRMS_no_coverage'], 'bins':info['bins'][zoom], 
+              'lat_lim':lat_lim[domain], 'lon_lim':lon_lim[domain]}
+    if field not in MRMS_inputs:
+        if MRMS_store_dir is not None:
+            MRMS_inputs[field] = [mrms.store_fname(MRMS_store_dir, field, y) for y in MRMS_years]
         else:
-            bins = np.arange(1, 200, 5)
-        xlabel = '6-hr total precip (mm)'
-        yscale = 'log'
+            MRMS_inputs[field] = mrms.sample_files(MRMS_path, MRMS_years, field, 
+                                                   [dt.datetime.strptime(d.strftime('%Y%m%d') + t, 
+                                                                         '%Y%m%d%H%M')
+                                                    for d in eval_dates for t in eval_times], 
+                                                   MRMS_offset)
+    if MRMS_store_dir is not None:
+        config['MRMS_store_dir'] = MRMS_store_dir
+    inputs = (['%s/%s/%s_%s.nc' % (NR_path, d.strftime('%Y%m%d'), field, d.strftime('%Y%m%d'))
+               for d in eval_dates] + MRMS_inputs[field] +
+              [f for f in [NR_mask_file, MRMS_mask_file] if f != None])
+    pickle_fname[key] = cache.entry_fname(cache_dir, '%s_%s_%s' % (model, field, domain), config, 
+                                          inputs=inputs, scope='frequency_histograms')
+    try:
+        hists[key] = cache.read_pickle(pickle_fname[key])
+    except FileNotFoundError:
+        pass
 
-    # Add 0 to MRMS_offset if empty
-    if len(MRMS_offset) == 0:
-        MRMS_offset = [0]
+# Histograms that must be computed. Each NR and MRMS file is only read once, and all histograms 
+# for that field are updated using the in-memory field
+todo_keys = [key for key in hist_keys if key not in hists]
 
-    # Spatial domain limits
-    if domain == 'all':
-        lat_lim = [5, 70]
-        lon_lim = [-150, -40]
-    elif domain == 'easternUS':
-        lat_lim = [5, 70]
-        lon_lim = [-100, -40]
+if len(todo_keys) > 0:
 
     # Load NR and MRMS masks
     if NR_mask_file != None:
@@ -175,104 +376,160 @@ if not pickle_avail:
     else:
         MRMS_mask_external = 1
 
-    # Initialize dictionaries
-    NR_counts = {}
-    NR_total_counts = {}
-    NR_total_pts = {}
-    for t in eval_times:
-        NR_total_counts[t] = np.zeros(bins.size-1)
-        NR_total_pts[t] = 0
-
-    MRMS_total_counts = {}
-    MRMS_total_pts = {}
-    MRMS_freq = {}
     n_MRMS = len(MRMS_years) * len(MRMS_offset)
     MRMS_years_all, MRMS_offset_all = np.meshgrid(MRMS_years, MRMS_offset)
     MRMS_years_all = MRMS_years_all.ravel()
     MRMS_offset_all = MRMS_offset_all.ravel()
-    for t in eval_times:
-        MRMS_total_counts[t] = np.zeros([bins.size-1, n_MRMS])
-        MRMS_freq[t] = np.zeros([bins.size-1, n_MRMS])
-        MRMS_total_pts[t] = np.zeros(n_MRMS)
-
-    # Extract NR data
-    NR_mask = np.array([[np.nan]])
-    for d in eval_dates:
-        d_str = d.strftime('%Y%m%d')
-        try:
-            ds = xr.open_dataset('%s/%s/%s_%s.nc' % (NR_path, d_str, field, d_str))
-        except FileNotFoundError:
-            continue
-
-        # Create mask based on desired domain
-        if np.isnan(NR_mask[0, 0]):
-            NR_lat = ds['gridlat_0'].values
-            NR_lon = ds['gridlon_0'].values
-            NR_mask = NR_mask_external * ((NR_lat >= lat_lim[0]) * (NR_lat <= lat_lim[1]) * 
-                                          (NR_lon >= lon_lim[0]) * (NR_lon <= lon_lim[1]))
-
-        # Unfortunately, the numpy datetime objects in ds and the datetime datetime objects in 
-        # eval_times cannot be easily compared, so we'll convert both of them to pd.Timestamp objects
-        ds_timestamps = np.empty(ds['time'].size, dtype=object)
-        for j, t in enumerate(ds['time'].values):
-            ds_timestamps[j] = pd.Timestamp(t)
 
-        print('NR extracting data for %s' % d_str)
-        for t in eval_times:
-            full_time = dt.datetime.strptime(d_str + t, '%Y%m%d%H%M')
-            try:
-                time_idx = np.where(ds_timestamps == pd.Timestamp(full_time))[0][0]
-            except IndexError:
-                continue
-            if NR_transform != None:
-                NR_data = NR_mask * NR_transform(ds[NR_var][time_idx, :, :].values)
-            else:    
-                NR_data = NR_mask * ds[NR_var][time_idx, :, :].values
-            NR_counts[full_time] = np.histogram(NR_data, bins=bins)[0]
-            NR_total_counts[t] = NR_total_counts[t] + NR_counts[full_time]
-            NR_total_pts[t] = NR_total_pts[t] + np.sum(NR_mask)
-
-    # Extract MRMS data
-    MRMS_mask = np.array([[np.nan]])
-    for i, (y, o) in enumerate(zip(MRMS_years_all, MRMS_offset_all)):
-        print()
-        print('extracting MRMS data for year = %d, offset = %d' % (y, o))
-        for t in NR_counts.keys():
-            MRMS_time = t + dt.timedelta(days=float(o))
-            print('extracting MRMS data for %s' % MRMS_time.strftime('%m %d %H:%M'))
-            for n, f in enumerate(MRMS_fname):
-                fname_list = glob.glob('%s/%d/%d%s*%s*' % (MRMS_path, y, y, MRMS_time.strftime('%m%d-%H%M'), f))
-                if len(fname_list) > 0:
+    # List the contents of each MRMS directory once (rather than globbing for each file). If using
+    # the MRMS store, check that it contains all fields, years, and eval_times and was created using
+    # the same MRMS mask before extracting any data
+    MRMS_files = {}
+    if MRMS_store_dir is None:
+        for y in MRMS_years:
+            MRMS_files[y] = sorted(glob.glob('%s/%d/*' % (MRMS_path, y)))
+    else:
+        for field in dict.fromkeys([key[0] for key in todo_keys]):
+            mrms.check_store(MRMS_store_dir, field, MRMS_years, hhmm=eval_times,
+                             bbox=(mrms.valid_bbox(MRMS_mask_external) if MRMS_mask_file != None 
+                                   else (slice(None), slice(None))))
+
+    # Domain masks are shared by all fields (assuming all fields are on the same grid). Histograms 
+    # are computed using only the valid gridpoints in each domain (NR_idx and MRMS_idx)
+    NR_idx = {}
+    MRMS_idx = {}
+    MRMS_out_idx = {}
+
+    for field in fields:
+        field_keys = [key for key in todo_keys if key[0] == field]
+        if len(field_keys) == 0:
+            continue
+        info = field_info[field]
+        field_domains = list(dict.fromkeys([key[1] for key in field_keys]))
+        bins = {key:info['bins'][key[2]] for key in field_keys}
+
+        # Initialize dictionaries
+        NR_total_counts = {}
+        NR_total_pts = {}
+        MRMS_total_counts = {}
+        MRMS_total_pts = {}
+        for key in field_keys:
+            NR_total_counts[key] = {}
+            NR_total_pts[key] = {}
+            MRMS_total_counts[key] = {}
+            MRMS_total_pts[key] = {}
+            for t in eval_times:
+                NR_total_counts[key][t] = np.zeros(bins[key].size-1)
+                NR_total_pts[key][t] = 0
+                MRMS_total_counts[key][t] = np.zeros([bins[key].size-1, n_MRMS])
+                MRMS_total_pts[key][t] = np.zeros(n_MRMS)
+
+        # Extract NR data. All NR files are opened lazily as a single dataset, and only the 2D 
+        # fields at the requested times are decoded
+        NR_times = []
+        ds = mrms.open_NR(NR_path, field, eval_dates)
+        if ds is not None:
+
+            # Create masks based on desired domains
+            new_domains = [domain for domain in field_domains if domain not in NR_idx]
+            if len(new_domains) > 0:
+                NR_lat = ds['gridlat_0'].values
+                NR_lon = ds['gridlon_0'].values
+                for domain in new_domains:
+                    NR_idx[domain] = mrms.valid_index(NR_mask_external * 
+                                                      ((NR_lat >= lat_lim[domain][0]) * 
+                                                       (NR_lat <= lat_lim[domain][1]) * 
+                                                       (NR_lon >= lon_lim[domain][0]) * 
+                                                       (NR_lon <= lon_lim[domain][1])))
+
+            sel_times = mrms.available_times(ds, [dt.datetime.strptime(d.strftime('%Y%m%d') + t, 
+                                                                       '%Y%m%d%H%M')
+                                                  for d in eval_dates for t in eval_times])
+            NR_sel = ds[info['NR_var']].sel(time=sel_times)
+            NR_times = [pd.Timestamp(full_time).to_pydatetime() for full_time in sel_times]
+
+            for j, full_time in enumerate(NR_times):
+                print('NR extracting %s data for %s' % (field, full_time.strftime('%Y%m%d %H:%M')))
+                t = full_time.strftime('%H%M')
+                field_data = NR_sel[j, :, :].values
+                for domain in field_domains:
+                    NR_data = mrms.gather(field_data, NR_idx[domain])
+                    if info['NR_transform'] != None:
+                        NR_data = info['NR_transform'](NR_data)
+                    npts = NR_idx[domain].size
+                    for key in field_keys:
+                        if key[1] != domain:
+                            continue
+                        NR_total_counts[key][t] = (NR_total_counts[key][t] + 
+                                                   mrms.histogram(NR_data, bins[key]))
+                        NR_total_pts[key][t] = NR_total_pts[key][t] + npts
+            ds.close()
+
+        # Create MRMS masks using the first available MRMS file (or MRMS store)
+        new_domains = [domain for domain in field_domains if domain not in MRMS_idx]
+        if MRMS_store_dir is not None:
+            for y in MRMS_years:
+                if len(new_domains) == 0:
+                    break
+                store = mrms.open_store(MRMS_store_dir, field, y)
+                if store is not None:
+                    add_MRMS_masks(store, new_domains)
+                    store.close()
+                    new_domains = []
+        else:
+            for y, o in zip(MRMS_years_all, MRMS_offset_all):
+                if len(new_domains) == 0:
                     break
-            if len(fname_list) == 0:
-                print('MRMS data for %d-%s is missing!' % (y, MRMS_time.strftime('%m-%d %H:%M')))
-                continue
-            ds = xr.open_dataset(fname_list[0], engine='pynio')
- 
-            # Create mask for MRMS data
-            if np.isnan(MRMS_mask[0, 0]):
-                MRMS_lon, MRMS_lat = np.meshgrid(ds['lon_0'].values - 360., ds['lat_0'].values)
-                MRMS_mask = MRMS_mask_external * ((MRMS_lat >= lat_lim[0]) * (MRMS_lat <= lat_lim[1]) * 
-                                                  (MRMS_lon >= lon_lim[0]) * (MRMS_lon <= lon_lim[1]))
-
-            hhmm = t.strftime('%H%M')
-            MRMS_total_counts[hhmm][:, i] = (np.histogram(MRMS_mask * ds[MRMS_var[n]].values, bins=bins)[0] + 
-                                             MRMS_total_counts[hhmm][:, i])
-            MRMS_total_pts[hhmm][i] = MRMS_total_pts[hhmm][i] + np.sum(np.logical_or(MRMS_mask, ds[MRMS_var[n]].values > MRMS_no_coverage))
-
-        for hhmm in eval_times:
-            MRMS_freq[hhmm][:, i] = MRMS_total_counts[hhmm][:, i] / MRMS_total_pts[hhmm][i]
-
-    # Save output to pickle file for use later
+                for t in NR_times:
+                    fname = find_MRMS_file(y, t + dt.timedelta(days=float(o)), 
+                                           info['MRMS_fname'])[0]
+                    if fname is not None:
+                        ds = xr.open_dataset(fname, engine='pynio')
+                        add_MRMS_masks(ds, new_domains)
+                        ds.close()
+                        new_domains = []
+                        break
+
+        # Extract MRMS data. Counts are computed for each MRMS sample (year and offset) 
+        # independently, so the samples can be distributed across worker processes
+        sample_fct = functools.partial(MRMS_sample_counts, field=field, field_keys=field_keys, 
+                                       times=NR_times)
+        if nprocs > 1:
+            print('Extracting MRMS data using %d processes' % nprocs)
+            with cf.ProcessPoolExecutor(max_workers=nprocs, 
+                                        mp_context=mp.get_context('fork')) as pool:
+                sample_results = list(pool.map(sample_fct, MRMS_years_all, MRMS_offset_all))
+        else:
+            sample_results = list(map(sample_fct, MRMS_years_all, MRMS_offset_all))
+        for i, (counts, pts) in enumerate(sample_results):
+            for key in field_keys:
+                for hhmm in eval_times:
+                    MRMS_total_counts[key][hhmm][:, i] = counts[key][hhmm]
+                    MRMS_total_pts[key][hhmm][i] = pts[key][hhmm]
+
+        # Compute MRMS frequencies and save output to pickle files for use later
+        for key in field_keys:
+            MRMS_freq = {}
+            for hhmm in eval_times:
+                MRMS_freq[hhmm] = MRMS_total_counts[key][hhmm] / MRMS_total_pts[key][hhmm]
+            hists[key] = {'NR_total_counts':NR_total_counts[key],
+                          'NR_total_pts':NR_total_pts[key],
+                          'MRMS_freq':MRMS_freq,
+                          'yscale':info['yscale'],
+                          'xlabel':info['xlabel']}
+            if use_pickle:
+                cache.write_pickle(hists[key], pickle_fname[key])
+
     if use_pickle:
-        all_data = {}
-        all_data['NR_total_counts'] = NR_total_counts
-        all_data['NR_total_pts'] = NR_total_pts
-        all_data['MRMS_freq'] = MRMS_freq
-        all_data['yscale'] = yscale
-        all_data['xlabel'] = xlabel
-        with open(pickle_fname, 'wb') as handle:
-            pickle.dump(all_data, handle)
+        cache.evict(cache_dir, max_entries=cache_max_entries, max_gb=cache_max_gb, 
+                    scope='frequency_histograms')
+
+# Publish final histograms to stable paths
+if use_pickle:
+    for key in hist_keys:
+        field, domain, zoom = key
+        cache.publish(pickle_fname[key], 
+                      final_fname % (model, field, domain, '_zoom' if zoom else ''))
 
 
 #---------------------------------------------------------------------------------------------------   
@@ -282,35 +539,48 @@ if not pickle_avail:
 nrows = int(np.floor(np.sqrt(len(eval_times))))
 ncols = int(np.ceil(len(eval_times) / nrows))
 figsize = (3 + 2*ncols, 3 + 2*nrows) 
-fig, axes = plt.subplots(nrows=nrows, ncols=ncols, sharex=True, sharey=True, figsize=figsize)
-bin_ctrs = bins[:-1] + 0.5 * (bins[1] - bins[0])
-for i, t in enumerate(eval_times):
-    ax = axes[int(i / ncols), i % ncols]
-
-    ax.plot(bin_ctrs, NR_total_counts[t] / NR_total_pts[t], 'k-', linewidth=2.5) 
-
-    MRMS_freq_pct = {}
-    for pct in [0, 10, 25, 50, 75, 90, 100]:
-        MRMS_freq_pct[pct] = np.nanpercentile(MRMS_freq[t], pct, axis=1)
-    
-    ax.plot(bin_ctrs, MRMS_freq_pct[50], 'r-', linewidth=2.5)
-    ax.fill_between(bin_ctrs, MRMS_freq_pct[25], MRMS_freq_pct[75], color='r', alpha=0.35)
-    ax.fill_between(bin_ctrs, MRMS_freq_pct[10], MRMS_freq_pct[90], color='r', alpha=0.15)
-    ax.plot(bin_ctrs, MRMS_freq_pct[0], 'r-', linewidth=0.75)
-    ax.plot(bin_ctrs, MRMS_freq_pct[100], 'r-', linewidth=0.75)
- 
-    ax.set_title('%s UTC' % t, size=14)
-    ax.set_yscale(yscale)
-    ax.grid() 
-
-for i in range(ncols):
-    axes[-1, i].set_xlabel(xlabel, size=12)
-for i in range(nrows):
-    axes[i, 0].set_ylabel('fraction of gridpoints in domain', size=12)
-
-plt.suptitle('%s Frequencies (black) and MRMS Frequencies (red)\n7-Day Composites' % model, size=16)
-plt.savefig(out_file)
-plt.close()
+for key in hist_keys:
+    field, domain, zoom = key
+    NR_total_counts = hists[key]['NR_total_counts']
+    NR_total_pts = hists[key]['NR_total_pts']
+    MRMS_freq = hists[key]['MRMS_freq']
+    yscale = hists[key]['yscale']
+    xlabel = hists[key]['xlabel']
+    bins = field_info[field]['bins'][zoom]
+
+    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, sharex=True, sharey=True, figsize=figsize)
+    bin_ctrs = bins[:-1] + 0.5 * (bins[1] - bins[0])
+    for i, t in enumerate(eval_times):
+        ax = axes[int(i / ncols), i % ncols]
+
+        ax.plot(bin_ctrs, NR_total_counts[t] / NR_total_pts[t], 'k-', linewidth=2.5) 
+
+        MRMS_freq_pct = {}
+        for pct in [0, 10, 25, 50, 75, 90, 100]:
+            MRMS_freq_pct[pct] = np.nanpercentile(MRMS_freq[t], pct, axis=1)
+        
+        ax.plot(bin_ctrs, MRMS_freq_pct[50], 'r-', linewidth=2.5)
+        ax.fill_between(bin_ctrs, MRMS_freq_pct[25], MRMS_freq_pct[75], color='r', alpha=0.35)
+        ax.fill_between(bin_ctrs, MRMS_freq_pct[10], MRMS_freq_pct[90], color='r', alpha=0.15)
+        ax.plot(bin_ctrs, MRMS_freq_pct[0], 'r-', linewidth=0.75)
+        ax.plot(bin_ctrs, MRMS_freq_pct[100], 'r-', linewidth=0.75)
+     
+        ax.set_title('%s UTC' % t, size=14)
+        ax.set_yscale(yscale)
+        ax.grid() 
+
+    for i in range(ncols):
+        axes[-1, i].set_xlabel(xlabel, size=12)
+    for i in range(nrows):
+        axes[i, 0].set_ylabel('fraction of gridpoints in domain', size=12)
+
+    plt.suptitle('%s Frequencies (black) and MRMS Frequencies (red)\n7-Day Composites' % model, 
+                 size=16)
+    if '%s' in out_file:
+        plt.savefig(out_file % (model, field, domain, 'zoom' if zoom else 'regular'))
+    else:
+        plt.savefig(out_file)
+    plt.close()
 
 print('elapsed time = %.2f min' % ((dt.datetime.now() - start_time).total_seconds() / 60))
 
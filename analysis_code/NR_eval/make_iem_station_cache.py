@@ -0,0 +1,58 @@
+"""
+Create a Columnar Cache of the Iowa Environmental Mesonet Surface Station Archives
+
+Each station's full record (all raw IEM text files in real_obs_dirs) is parsed once and written to
+a Parquet file with float32 columns, NaN for missing values, and datetime64 times.
+compare_NR_real_sfc_stations_perfect_matching.py can then read only the columns and time windows
+it needs from this cache (set iem_cache_dir in that script).
+
+Real surface station obs come from the Iowa Environmental Mesonet database:
+https://mesonet.agron.iastate.edu/request/download.phtml
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import datetime as dt
+
+import sfc_station_fcts as sfc
+
+
+#---------------------------------------------------------------------------------------------------
+# Input Parameters
+#---------------------------------------------------------------------------------------------------
+
+# Directories containing the raw IEM files
+real_obs_dirs = ['/work2/noaa/wrfruc/murdzek/real_obs/sfc_stations/winter',
+                 '/work2/noaa/wrfruc/murdzek/real_obs/sfc_stations/spring']
+
+# Stations
+with open('station_list.txt', 'r') as fptr:
+    station_ids = fptr.readlines()
+    for i in range(len(station_ids)):
+        station_ids[i] = station_ids[i].strip()
+
+# Output directory for the cache
+cache_dir = '/work2/noaa/wrfruc/murdzek/real_obs/sfc_stations/parquet_cache'
+
+
+#---------------------------------------------------------------------------------------------------
+# Create Cache
+#---------------------------------------------------------------------------------------------------
+
+start_time = dt.datetime.now()
+
+for ID in station_ids:
+    df = sfc.write_iem_station_cache(ID, real_obs_dirs, cache_dir)
+    print('%s: %d obs written' % (ID, len(df)))
+
+print('elapsed time = %.2f min' % ((dt.datetime.now() - start_time).total_seconds() / 60))
+
+
+"""
+End make_iem_station_cache.py
+"""
@@ -0,0 +1,112 @@
+"""
+Convert Raw MRMS GRIB2 Files into Compressed, Chunked netCDF Files
+
+One netCDF file is created for each MRMS product and year. Fields are cropped to the bounding box of
+the NR/MRMS common domain (from the MRMS mask created by make_NR_MRMS_coverage_mask.py), and the
+original MRMS valid times are retained in the time dimension. The resulting store is read by
+frequency_histograms.py and obj_based_mrms_cref_compare.py so that repeat analyses do not need to
+decode the GRIB2 files.
+
+The GRIB2 files for each product and year are converted in monthly batches (see 
+mrms_fcts.write_store), so only the GRIB2 files for a single month are open at once. Store files are
+only rewritten if they are missing, older than the corresponding MRMS directory, were created for a
+different domain (MRMS_mask_file) or store_times, or were written by an older version of this script
+(without the number of covered gridpoints outside of the domain).
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import datetime as dt
+import numpy as np
+import multiprocessing as mp
+import concurrent.futures as cf
+import os
+
+import mrms_fcts as mrms
+
+
+#---------------------------------------------------------------------------------------------------
+# Input Parameters
+#---------------------------------------------------------------------------------------------------
+
+# MRMS data file path
+MRMS_path = '/work2/noaa/wrfruc/murdzek/real_obs/mrms'
+
+# MRMS years to convert
+MRMS_years = np.arange(2015, 2024)
+
+# MRMS products to convert (options: 'cref', 'precip1hr', 'precip6hr')
+products = ['cref', 'precip1hr', 'precip6hr']
+
+# Only convert MRMS files valid at these times (strings, HHMM). Set to None to convert all files
+store_times = ['0000', '0600', '1200', '1800']
+
+# MRMS mask defining the NR/MRMS common domain (created by make_NR_MRMS_coverage_mask.py). Set to
+# None to keep the full MRMS grid
+MRMS_mask_file = './MRMS_mask_999.npy'
+
+# Output directory
+store_dir = './mrms_store'
+
+# Chunk size in the (lat, lon) dimensions and zlib compression level
+chunks = (512, 512)
+complevel = 4
+
+# Number of worker processes. Each worker converts a single product and year
+nprocs = 4
+
+
+#---------------------------------------------------------------------------------------------------
+# Convert MRMS Files
+#---------------------------------------------------------------------------------------------------
+
+start_time = dt.datetime.now()
+
+os.makedirs(store_dir, exist_ok=True)
+
+if MRMS_mask_file != None:
+    bbox = mrms.valid_bbox(np.load(MRMS_mask_file))
+else:
+    bbox = (slice(None), slice(None))
+
+def convert(product, year):
+    fname = mrms.store_fname(store_dir, product, year)
+    year_dir = '%s/%d' % (MRMS_path, year)
+    if os.path.isfile(fname) and (os.stat(fname).st_mtime_ns > os.stat(year_dir).st_mtime_ns):
+        try:
+            ds = mrms.open_store(store_dir, product, year)
+            current = ((ds.attrs.get('store_times', None) == mrms.store_times_attr(store_times)) and
+                       (list(ds.attrs['bbox']) == mrms.bbox_attr(bbox, ds.attrs['grid_shape'])))
+            ds.close()
+            if current:
+                print('%s is up to date' % fname)
+                return
+        except ValueError:
+            pass
+    files = mrms.list_product_files(MRMS_path, year, product, hhmm=store_times)
+    if len(files) == 0:
+        print('no MRMS %s files for %d' % (product, year))
+        return
+    print('writing %s (%d times)' % (fname, len(files)))
+    mrms.write_store(files, product, bbox, fname, hhmm=store_times, chunks=chunks, 
+                     complevel=complevel)
+
+jobs = [(p, y) for p in products for y in MRMS_years if os.path.isdir('%s/%d' % (MRMS_path, y))]
+if (nprocs > 1) and (len(jobs) > 0):
+    with cf.ProcessPoolExecutor(max_workers=nprocs, mp_context=mp.get_context('fork')) as pool:
+        list(pool.map(convert, *zip(*jobs)))
+else:
+    for p, y in jobs:
+        convert(p, y)
+
+print('elapsed time = %.2f min' % ((dt.datetime.now() - start_time).total_seconds() / 60))
+
+
+"""
+End make_mrms_store.py
+"""
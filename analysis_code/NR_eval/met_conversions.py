@@ -0,0 +1,198 @@
+"""
+Plain NumPy Meteorological Conversions
+
+These functions reproduce the MetPy (v1.4) formulas used to convert the surface station obs, but
+operate directly on NumPy arrays in fixed units, so no pint quantities or temporary copies are
+created. Computations are performed in the dtype of the input arrays (e.g., float32 input yields
+float32 output).
+
+Use verify() to check agreement with MetPy. Relative differences are below verify_rtol for float64
+input and below verify_rtol_float32 for float32 input.
+
+These functions are used by compare_NR_real_sfc_stations_perfect_matching.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+
+
+#---------------------------------------------------------------------------------------------------
+# Constants (same values as metpy.constants)
+#---------------------------------------------------------------------------------------------------
+
+g = 9.80665                     # Gravitational acceleration (m s^-2)
+Re = 6371008.7714               # Mean Earth radius (m)
+R = 8.314462618                 # Universal gas constant (J mol^-1 K^-1)
+Md = 28.96546e-3                # Molecular weight of dry air (kg mol^-1)
+Mw = 18.015268e-3               # Molecular weight of water (kg mol^-1)
+Rd = R / Md                     # Dry air gas constant (J kg^-1 K^-1)
+epsilon = Mw / Md               # Ratio of molecular weights of water and dry air
+
+# Unit conversions
+inHg_to_hPa = 33.86388640341    # 1 inch of mercury (hPa)
+kt_to_ms = 1852. / 3600.        # 1 knot (m s^-1)
+
+# Tolerances (relative difference) used by verify()
+verify_rtol = 1e-8
+verify_rtol_float32 = 1e-5
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def altimeter_to_station_pressure(alti, elev):
+    """
+    Convert altimeter setting (inHg) to station pressure (hPa) using the same formula as
+    metpy.calc.altimeter_to_station_pressure (Smithsonian Meteorological Tables)
+
+    Parameters
+    ----------
+    alti : np.array
+        Altimeter setting (inHg)
+    elev : np.array
+        Station elevation (m)
+
+    Returns
+    -------
+    prs : np.array
+        Station pressure (hPa)
+
+    """
+
+    t0 = 288.
+    p0 = 1013.25
+    gamma = 0.0065
+    n = Rd * gamma / g
+
+    return ((alti * inHg_to_hPa)**n - (p0**n * gamma * elev / t0))**(1. / n) + 0.3
+
+
+def saturation_vapor_pressure(T):
+    """
+    Saturation vapor pressure (hPa) from temperature (degC) using Bolton (1980), same as
+    metpy.calc.saturation_vapor_pressure
+    """
+
+    return 6.112 * np.exp(17.67 * T / (T + 243.5))
+
+
+def specific_humidity_from_dewpoint(prs, Td):
+    """
+    Compute specific humidity (kg/kg) from pressure (hPa) and dewpoint (degC), same as
+    metpy.calc.specific_humidity_from_dewpoint
+    """
+
+    e = saturation_vapor_pressure(Td)
+    w = epsilon * e / (prs - e)
+
+    return w / (1. + w)
+
+
+def wind_components(wspd, wdir):
+    """
+    Compute the zonal and meridional wind components from wind speed and direction (deg), same as
+    metpy.calc.wind_components. The components have the same units as wspd
+    """
+
+    wdir = np.deg2rad(wdir)
+
+    return -wspd * np.sin(wdir), -wspd * np.cos(wdir)
+
+
+def geopotential_to_height(geopot):
+    """
+    Compute height (m) from geopotential (m^2 s^-2), same as metpy.calc.geopotential_to_height
+    """
+
+    return (geopot * Re) / (g * Re - geopot)
+
+
+def degF_to_degC(T):
+    """
+    Convert temperature from degF to degC
+    """
+
+    return (T - 32.) * (5. / 9.)
+
+
+def verify(npts=100000, seed=0):
+    """
+    Compare the functions in this module against MetPy using realistic surface station values
+
+    Parameters
+    ----------
+    npts : integer, optional
+        Number of random values used for each comparison
+    seed : integer, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    max_diff : dictionary
+        Maximum relative difference from MetPy for each function and dtype. An AssertionError is
+        raised if any difference exceeds verify_rtol (float64) or verify_rtol_float32 (float32)
+
+    """
+
+    import metpy.calc as mc
+    import metpy.constants as const
+    from metpy.units import units
+
+    rng = np.random.default_rng(seed)
+    alti = rng.uniform(28, 31.5, npts)
+    elev = rng.uniform(-50, 3500, npts)
+    Td = rng.uniform(-40, 30, npts)
+    prs = rng.uniform(650, 1050, npts)
+    wspd = rng.uniform(0, 60, npts)
+    wdir = rng.uniform(0, 360, npts)
+    gph = rng.uniform(0, 15000, npts)
+
+    # Reference values from MetPy
+    wnd_ref = mc.wind_components(wspd * units.kt, wdir * units.deg)
+    ref = {'altimeter_to_station_pressure':
+               mc.altimeter_to_station_pressure(alti * units.inHg, elev * units.m).to('hPa').magnitude,
+           'specific_humidity_from_dewpoint':
+               mc.specific_humidity_from_dewpoint(prs * units.hPa, Td * units.degC).to('kg/kg').magnitude,
+           'u': wnd_ref[0].to('m/s').magnitude,
+           'v': wnd_ref[1].to('m/s').magnitude,
+           'geopotential_to_height':
+               mc.geopotential_to_height(gph * units.m * const.g).to('m').magnitude,
+           'degF_to_degC':
+               (Td * units.degF).to('degC').magnitude}
+
+    max_diff = {}
+    for dtype, rtol in zip([np.float64, np.float32], [verify_rtol, verify_rtol_float32]):
+        wnd = wind_components(dtype(kt_to_ms) * wspd.astype(dtype), wdir.astype(dtype))
+        test = {'altimeter_to_station_pressure':
+                    altimeter_to_station_pressure(alti.astype(dtype), elev.astype(dtype)),
+                'specific_humidity_from_dewpoint':
+                    specific_humidity_from_dewpoint(prs.astype(dtype), Td.astype(dtype)),
+                'u': wnd[0],
+                'v': wnd[1],
+                'geopotential_to_height':
+                    geopotential_to_height(dtype(g) * gph.astype(dtype)),
+                'degF_to_degC':
+                    degF_to_degC(Td.astype(dtype))}
+        for key in ref:
+            assert test[key].dtype == dtype
+            # Wind components and temperatures cross 0, so differences are relative to the scale
+            # of the reference values
+            scale = np.maximum(np.abs(ref[key]), np.amax(np.abs(ref[key])) * 1e-3)
+            diff = np.amax(np.abs(test[key] - ref[key]) / scale)
+            max_diff['%s (%s)' % (key, np.dtype(dtype).name)] = diff
+            print('%s (%s): max relative difference = %.2e' % (key, np.dtype(dtype).name, diff))
+            assert diff <= rtol, '%s differs from MetPy by %.2e' % (key, diff)
+
+    return max_diff
+
+
+"""
+End met_conversions.py
+"""
@@ -0,0 +1,547 @@
+"""
+Functions for Masked MRMS and NR Gridded Fields
+
+Domain/coverage masks are converted once into a flat index of the valid gridpoints (or the bounding
+box of the valid gridpoints), so that each MRMS or NR field only needs to be gathered at those
+points rather than multiplied by a full-grid mask.
+
+Raw MRMS GRIB2 files can also be converted into a store of compressed, chunked netCDF files (one
+file per product and year) that are cropped to the NR/MRMS common domain. Each store file has a
+time dimension containing the original MRMS valid times, so individual times can be read lazily
+without decoding any GRIB2 files. The number of gridpoints with MRMS coverage outside of the 
+cropped domain is saved for each time, so that the number of covered points (the denominator of
+the MRMS frequencies in frequency_histograms.py) is the same as when using the raw GRIB2 files.
+
+NR output for several days is opened lazily as a single multi-file dataset chunked by time, so only
+the 2D fields at the requested times are decoded.
+
+These functions are used by frequency_histograms.py, obj_based_mrms_cref_compare.py, and 
+make_mrms_store.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+import xarray as xr
+import datetime as dt
+import fnmatch
+import glob
+import os
+
+
+#---------------------------------------------------------------------------------------------------
+# Constants
+#---------------------------------------------------------------------------------------------------
+
+# MRMS products. MRMS_fname are the substrings used to identify the MRMS files for each product
+# and MRMS_var are the corresponding GRIB2 variable names. If several files exist for the same
+# valid time, the first entry in MRMS_fname is used. Gridpoints without MRMS coverage are set to
+# no_coverage
+products = {'cref':{'MRMS_var':['MergedReflectivityQCComposite_P0_L102_GLL0'],
+                    'MRMS_fname':['MRMS_MergedReflectivityQCComposite'],
+                    'no_coverage':-999.},
+            'precip1hr':{'MRMS_var':['VAR_209_6_37_P0_L102_GLL0', 'GaugeCorrQPE01H_P0_L102_GLL0'],
+                         'MRMS_fname':['MRMS_MultiSensor_QPE_01H_Pass2', 'MRMS_GaugeCorr_QPE_01H'],
+                         'no_coverage':-3.},
+            'precip6hr':{'MRMS_var':['VAR_209_6_39_P0_L102_GLL0', 'GaugeCorrQPE06H_P0_L102_GLL0'],
+                         'MRMS_fname':['MRMS_MultiSensor_QPE_06H_Pass2', 'MRMS_GaugeCorr_QPE_06H'],
+                         'no_coverage':-3.}}
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def valid_index(mask):
+    """
+    Flat index of the valid (nonzero) gridpoints in a mask
+
+    Parameters
+    ----------
+    mask : np.array
+        Mask. Any dimensions
+
+    Returns
+    -------
+    idx : np.array
+        Indices of the nonzero entries in mask.ravel()
+
+    """
+
+    return np.flatnonzero(mask)
+
+
+def gather(field, idx):
+    """
+    Extract the valid gridpoints from a field
+
+    Parameters
+    ----------
+    field : np.array
+        Gridded field. Same dimensions as the mask used to create idx
+    idx : np.array
+        Flat index of valid gridpoints (see valid_index)
+
+    Returns
+    -------
+    pts : np.array
+        1D array of field values at the valid gridpoints
+
+    """
+
+    return np.take(field.ravel(), idx)
+
+
+def valid_bbox(mask):
+    """
+    Bounding box of the valid (nonzero) gridpoints in a 2D mask
+
+    Parameters
+    ----------
+    mask : np.array
+        2D mask
+
+    Returns
+    -------
+    bbox : tuple of slices
+        Slices that crop a 2D field to the smallest box containing all valid gridpoints. Empty
+        slices are returned if there are no valid gridpoints
+
+    """
+
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    if rows.size == 0:
+        return (slice(0, 0), slice(0, 0))
+
+    return (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+
+def is_uniform(bins, rtol=1e-6):
+    """
+    Check whether bin edges are uniformly spaced
+    """
+
+    widths = np.diff(bins)
+
+    return bool(np.all(np.abs(widths - widths[0]) <= rtol * np.abs(widths[0])))
+
+
+def histogram(x, bins):
+    """
+    Histogram of a 1D array. Equivalent to np.histogram(x, bins=bins)[0]
+
+    For uniformly spaced bins, the bin index is computed in closed form (and corrected for roundoff
+    so that the result matches np.histogram exactly), which avoids the binary search used by
+    np.histogram for arbitrary bin edges
+
+    Parameters
+    ----------
+    x : np.array
+        Data. NaNs and values outside of bins are ignored
+    bins : np.array
+        Bin edges. The last bin includes its right edge
+
+    Returns
+    -------
+    counts : np.array
+        Number of values in each bin
+
+    """
+
+    nbins = bins.size - 1
+    if not is_uniform(bins):
+        return np.histogram(x, bins=bins)[0]
+
+    x = x[(x >= bins[0]) & (x <= bins[-1])]
+    idx = ((x - bins[0]) * (nbins / (bins[-1] - bins[0]))).astype(np.int64)
+    idx = np.clip(idx, 0, nbins - 1)
+
+    # Correct for roundoff in the bin index (same approach as np.histogram with an integer number
+    # of bins)
+    idx[x < bins[idx]] -= 1
+    idx[(x >= bins[idx + 1]) & (idx != nbins - 1)] += 1
+
+    return np.bincount(idx, minlength=nbins)
+
+
+def file_valid_time(fname):
+    """
+    Valid time of an MRMS file. MRMS file names start with the valid time (YYYYMMDD-HHMMSS)
+    """
+
+    return dt.datetime.strptime(os.path.basename(fname)[:15], '%Y%m%d-%H%M%S')
+
+
+def list_product_files(MRMS_path, year, product, hhmm=None):
+    """
+    List the raw MRMS files for a product and year
+
+    Parameters
+    ----------
+    MRMS_path : string
+        MRMS data file path (files for each year are in [MRMS_path]/[year])
+    year : integer
+        Year
+    product : string
+        MRMS product (see products)
+    hhmm : list of strings, optional
+        Only include files valid at these times (HHMM). All files are included if None
+
+    Returns
+    -------
+    files : list of tuples
+        (valid time, file name, GRIB2 variable name) for each valid time, sorted by valid time
+
+    """
+
+    all_files = sorted(glob.glob('%s/%d/*' % (MRMS_path, year)))
+    files = {}
+    for f, v in zip(products[product]['MRMS_fname'], products[product]['MRMS_var']):
+        for fname in fnmatch.filter(all_files, '%s/%d/%d*%s*' % (MRMS_path, year, year, f)):
+            valid_time = file_valid_time(fname)
+            if (hhmm is not None) and (valid_time.strftime('%H%M') not in hhmm):
+                continue
+            key = valid_time.strftime('%Y%m%d%H%M')
+            if key not in files:
+                files[key] = (valid_time, fname, v)
+
+    return [files[key] for key in sorted(files.keys())]
+
+
+def sample_files(MRMS_path, years, product, times, offsets):
+    """
+    Raw MRMS files that are read for a set of NR valid times and MRMS years/offsets
+
+    The MRMS valid time for each sample is the NR valid time shifted by the offset (in days) in the
+    MRMS year. Only the MRMS directory listing for each year is needed, so the returned files can be
+    used as cache inputs without checking every file in the MRMS directories
+
+    Parameters
+    ----------
+    MRMS_path : string
+        MRMS data file path (files for each year are in [MRMS_path]/[year])
+    years : list of integers
+        MRMS years
+    product : string
+        MRMS product (see products)
+    times : list of dt.datetime
+        NR valid times
+    offsets : list of integers
+        MRMS offsets (days)
+
+    Returns
+    -------
+    fnames : list of strings
+        MRMS files, sorted by year and valid time
+
+    """
+
+    mdhm = set([(t + dt.timedelta(days=float(o))).strftime('%m%d%H%M') for t in times 
+                for o in offsets])
+    hhmm = sorted(set([s[4:] for s in mdhm]))
+    fnames = []
+    for y in years:
+        fnames = fnames + [f for t, f, _ in list_product_files(MRMS_path, y, product, hhmm=hhmm)
+                           if t.strftime('%m%d%H%M') in mdhm]
+
+    return fnames
+
+
+def store_fname(store_dir, product, year):
+    """
+    Name of the MRMS store file for a product and year
+    """
+
+    return '%s/MRMS_%s_%d.nc' % (store_dir, product, year)
+
+
+def bbox_attr(bbox, shape):
+    """
+    Bounding box (tuple of slices) on a grid with the given shape as a list of row and column 
+    limits [row start, row stop, column start, column stop] (used for the bbox store attribute)
+    """
+
+    rows = range(*bbox[0].indices(shape[0]))
+    cols = range(*bbox[1].indices(shape[1]))
+
+    return [rows.start, rows.stop, cols.start, cols.stop]
+
+
+def store_times_attr(hhmm):
+    """
+    Valid times (HHMM) included in an MRMS store as a string (used for the store_times store 
+    attribute). 'all' if hhmm is None
+    """
+
+    if hhmm is None:
+        return 'all'
+
+    return ','.join(sorted(hhmm))
+
+
+def write_store(files, product, bbox, fname, hhmm=None, chunks=(512, 512), complevel=4):
+    """
+    Write MRMS fields cropped to bbox to a compressed netCDF file chunked by time
+
+    The GRIB2 files are converted in monthly batches. Each batch is written to a temporary netCDF
+    file, so only the GRIB2 files for a single month are open at once, and the batches are then 
+    combined into the output file. The number of gridpoints with MRMS coverage outside of bbox is
+    saved for each time (covered_outside). bbox and hhmm are saved as attributes, so stores created
+    using a different domain or set of valid times can be detected
+
+    Parameters
+    ----------
+    files : list of tuples
+        (valid time, file name, GRIB2 variable name) for each time (see list_product_files)
+    product : string
+        MRMS product. Used as the variable name in the store
+    bbox : tuple of slices
+        Bounding box of the NR/MRMS common domain on the full MRMS grid (see valid_bbox)
+    fname : string
+        Output netCDF file name
+    hhmm : list of strings, optional
+        Valid times (HHMM) that files were selected for (see list_product_files). None if files 
+        were selected for all valid times
+    chunks : tuple of integers, optional
+        Chunk size in the (lat, lon) dimensions. Each chunk holds a single time
+    complevel : integer, optional
+        zlib compression level
+
+    Returns
+    -------
+    None
+
+    """
+
+    no_coverage = products[product]['no_coverage']
+    months = list(dict.fromkeys([t.strftime('%Y%m') for t, _, _ in files]))
+    part_fnames = []
+    for m in months:
+        batch = [f for f in files if f[0].strftime('%Y%m') == m]
+        raw = [xr.open_dataset(f, engine='pynio', chunks={}) for _, f, _ in batch]
+        full = [ds[v].expand_dims(time=[np.datetime64(t, 'ns')]) 
+                for (t, _, v), ds in zip(batch, raw)]
+        fields = [da.isel(lat_0=bbox[0], lon_0=bbox[1]).rename(product) for da in full]
+        covered_outside = [((da > no_coverage).sum(dim=['lat_0', 'lon_0']) - 
+                            (f > no_coverage).sum(dim=['lat_0', 'lon_0'])).rename('covered_outside')
+                           for da, f in zip(full, fields)]
+        shape = (raw[0].sizes['lat_0'], raw[0].sizes['lon_0'])
+        part = xr.Dataset(data_vars={product:xr.concat(fields, dim='time').astype(np.float32),
+                                     'covered_outside':xr.concat(covered_outside, dim='time')})
+        nlat, nlon = part[product].shape[1:]
+        encoding = {product:{'zlib':True, 'complevel':complevel, 
+                             'chunksizes':(1, min(chunks[0], nlat), min(chunks[1], nlon))}}
+        part_fnames.append('%s.%s.tmp' % (fname, m))
+        part.to_netcdf(part_fnames[-1], encoding=encoding)
+        for ds in raw:
+            ds.close()
+
+    out = xr.open_mfdataset(part_fnames, combine='nested', concat_dim='time', 
+                            data_vars='minimal', coords='minimal', compat='override')
+    out.attrs = {'bbox':bbox_attr(bbox, shape),
+                 'grid_shape':list(shape),
+                 'store_times':store_times_attr(hhmm),
+                 'source_files':','.join([os.path.basename(f) for _, f, _ in files])}
+    out.to_netcdf(fname + '.tmp', encoding=encoding)
+    out.close()
+    os.replace(fname + '.tmp', fname)
+    for f in part_fnames:
+        os.remove(f)
+
+
+def check_store(store_dir, product, years, hhmm=None, bbox=None):
+    """
+    Check that the MRMS store is consistent with an analysis
+
+    Parameters
+    ----------
+    store_dir : string
+        MRMS store directory
+    product : string
+        MRMS product
+    years : list of integers
+        Years. A FileNotFoundError is raised if the store does not contain a file for each year
+    hhmm : list of strings, optional
+        Valid times (HHMM) used in the analysis. A ValueError is raised if a store file was not 
+        created for all of these valid times (individual valid times that are missing from a store
+        file were also missing from the raw MRMS files when the store was created)
+    bbox : tuple of slices, optional
+        Bounding box of the NR/MRMS common domain used in the analysis (see valid_bbox). A 
+        ValueError is raised if a store file was created for a different bounding box
+
+    Returns
+    -------
+    None
+
+    """
+
+    missing = [int(y) for y in years if not os.path.isfile(store_fname(store_dir, product, y))]
+    if len(missing) > 0:
+        raise FileNotFoundError('MRMS store %s has no %s files for %s (run make_mrms_store.py)' %
+                                (store_dir, product, ', '.join([str(y) for y in missing])))
+    for y in years:
+        fname = store_fname(store_dir, product, y)
+        with xr.open_dataset(fname) as ds:
+            attrs = ds.attrs
+        if 'store_times' not in attrs:
+            raise ValueError('%s was written by an older version of make_mrms_store.py' % fname)
+        if (hhmm is not None) and (attrs['store_times'] != 'all'):
+            absent = [t for t in hhmm if t not in attrs['store_times'].split(',')]
+            if len(absent) > 0:
+                raise ValueError('%s does not contain valid times %s (update store_times in '
+                                 'make_mrms_store.py)' % (fname, ', '.join(absent)))
+        if (bbox is not None) and (list(attrs['bbox']) != bbox_attr(bbox, attrs['grid_shape'])):
+            raise ValueError('%s was created for a different MRMS mask (update MRMS_mask_file in '
+                             'make_mrms_store.py)' % fname)
+
+
+def open_store(store_dir, product, year):
+    """
+    Lazily open the MRMS store file for a product and year. Returns None if the file does not exist
+    """
+
+    fname = store_fname(store_dir, product, year)
+    if not os.path.isfile(fname):
+        return None
+
+    ds = xr.open_dataset(fname, chunks={'time':1})
+    if 'covered_outside' not in ds:
+        ds.close()
+        raise ValueError('%s was written by an older version of make_mrms_store.py' % fname)
+
+    return ds
+
+
+def store_bbox(ds):
+    """
+    Bounding box of an MRMS store on the full MRMS grid (as a tuple of slices)
+    """
+
+    bbox = ds.attrs['bbox']
+
+    return (slice(bbox[0], bbox[1]), slice(bbox[2], bbox[3]))
+
+
+def read_store_time(ds, product, valid_time):
+    """
+    Read the MRMS field valid at valid_time (times are matched to the minute) from an MRMS store
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        MRMS store (see open_store). Can be None
+    product : string
+        MRMS product
+    valid_time : dt.datetime
+        Valid time
+
+    Returns
+    -------
+    field : np.array
+        2D MRMS field on the store grid. None if the store does not contain valid_time
+
+    """
+
+    idx = store_time_index(ds, valid_time)
+    if idx is None:
+        return None
+
+    return ds[product][idx].values
+
+
+def read_store_covered_outside(ds, valid_time):
+    """
+    Number of gridpoints with MRMS coverage outside of the store grid at valid_time (see 
+    write_store). Returns None if the store does not contain valid_time
+    """
+
+    idx = store_time_index(ds, valid_time)
+    if idx is None:
+        return None
+
+    return int(ds['covered_outside'][idx].values)
+
+
+def store_time_index(ds, valid_time):
+    """
+    Index of valid_time (matched to the minute) in the time dimension of an MRMS store. Returns None
+    if ds is None or does not contain valid_time
+    """
+
+    if ds is None:
+        return None
+    idx = np.flatnonzero(ds['time'].values.astype('datetime64[m]') == 
+                         np.datetime64(valid_time, 'm'))
+    if idx.size == 0:
+        return None
+
+    return idx[0]
+
+
+def open_NR(NR_path, field, dates):
+    """
+    Lazily open the daily NR files for a field as a single dataset chunked by time
+
+    Parameters
+    ----------
+    NR_path : string
+        NR data file path (files are [NR_path]/[YYYYMMDD]/[field]_[YYYYMMDD].nc)
+    field : string
+        Field
+    dates : list of dt.datetime
+        Dates to open. Missing files are skipped
+
+    Returns
+    -------
+    ds : xr.Dataset
+        NR dataset. Variables without a time dimension (e.g., gridlat_0, gridlon_0) are taken from
+        the first file. Times that appear in more than one file are only kept once (from the first
+        file), so selecting a list of unique times returns one field per time. None if none of the
+        files exist
+
+    """
+
+    fnames = ['%s/%s/%s_%s.nc' % (NR_path, d.strftime('%Y%m%d'), field, d.strftime('%Y%m%d'))
+              for d in dates]
+    fnames = [f for f in fnames if os.path.isfile(f)]
+    if len(fnames) == 0:
+        return None
+
+    ds = xr.open_mfdataset(fnames, combine='nested', concat_dim='time', chunks={'time':1},
+                           data_vars='minimal', coords='minimal', compat='override')
+
+    return ds.drop_duplicates('time', keep='first')
+
+
+def available_times(ds, times):
+    """
+    Subset of times that are in ds['time']
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Dataset with a time dimension
+    times : list of dt.datetime
+        Requested times
+
+    Returns
+    -------
+    avail : np.array
+        Requested times (datetime64[ns]) that are in ds['time'], in the same order as times
+
+    """
+
+    times = np.array(times, dtype='datetime64[ns]')
+
+    return times[np.isin(times, ds['time'].values.astype('datetime64[ns]'))]
+
+
+"""
+End mrms_fcts.py
+"""
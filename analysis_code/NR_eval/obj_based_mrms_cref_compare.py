@@ -16,7 +16,9 @@ import scipy.ndimage as sn
 import matplotlib.pyplot as plt
 import sys
 import glob
-import pickle
+
+import analysis_cache as cache
+import mrms_fcts as mrms
 
 
 #---------------------------------------------------------------------------------------------------
@@ -43,6 +45,11 @@ MRMS_path = '/work2/noaa/wrfruc/murdzek/real_obs/mrms'
 # MRMS years to use
 MRMS_years = np.arange(2015, 2024)
 
+# Optional: MRMS store created by make_mrms_store.py. If not None, MRMS fields are read from the 
+# store (which is cropped to the NR/MRMS common domain) rather than the raw GRIB2 files in MRMS_path.
+# The store must contain a file for each year in MRMS_years
+MRMS_store_dir = None
+
 # Option to use days from MRMS before and after eval_dates. Offsets here are days relative to the 
 # first date in eval_dates
 MRMS_offset = [-7, 0, 7]
@@ -68,10 +75,20 @@ elif model == 'HRRR':
 MRMS_mask_file = './MRMS_mask_999.npy'
 
 # Option to save/use output from a pickle file
-# If use_pickle is True, then the script will attempt to read the pickle file specified. If the file
-# is not found, that file will be written to.
+# If use_pickle is True, then the script will attempt to read the pickle file in cache_dir that 
+# matches the parameters above and the current input files. If the file is not found, that file 
+# will be written to. Least recently used pickle files are removed from cache_dir if there are more 
+# than cache_max_entries files or the files exceed cache_max_gb (set either to None for no limit).
+# Only entries created by this script count toward cache_max_entries and cache_max_gb
 use_pickle = True
-pickle_fname = './NR_cref_obj_%sdbz_%sminsize_%s_winter.pkl' % (ref_thres, min_size, domain)
+cache_dir = './cache'
+cache_max_entries = 50
+cache_max_gb = None
+
+# Pickle file containing the final objects, which is read by the scripts in fig_code (only used if
+# use_pickle = True). This is a hard link to (or copy of) the cache entry, so it is not removed when
+# the cache entry is evicted
+final_fname = './%s_cref_obj_%sdbz_%sminsize_%s_winter.pkl' % (model, ref_thres, min_size, domain)
 
 # Output file
 out_file = './NR_cref_obj_%sdbz_%sminsize_%s_winter.png' % (ref_thres, min_size, domain)
@@ -83,14 +100,56 @@ out_file = './NR_cref_obj_%sdbz_%sminsize_%s_winter.png' % (ref_thres, min_size,
 
 start_time = dt.datetime.now()
 
-# Try to read from pickle file
+# Define necessary variables for each input field
+if model == 'NR':
+    NR_var = 'REFC_P0_L200_GLC0'
+elif model == 'HRRR':
+    NR_var = 'REFC_P0_L10_GLC0'
+MRMS_var = mrms.products['cref']['MRMS_var'][0]
+MRMS_fname = mrms.products['cref']['MRMS_fname'][0]
+MRMS_no_coverage = -999.
+
+# Add 0 to MRMS_offset if empty
+if len(MRMS_offset) == 0:
+    MRMS_offset = [0]
+
+# Spatial domain limits
+if domain == 'all':
+    lat_lim = [5, 70]
+    lon_lim = [-150, -40]
+elif domain == 'easternUS':
+    lat_lim = [5, 70]
+    lon_lim = [-100, -40]
+
+# Try to read from pickle file. The file name is a hash of all parameters that affect the objects
+# plus the size and modification time of the input files. The MRMS inputs are the MRMS store files
+# (if used) or the raw MRMS files that are read for eval_dates and eval_times (found using a single
+# listing of each MRMS directory)
 if use_pickle:
+    config = {'model':model, 'domain':domain, 'eval_dates':eval_dates, 'eval_times':eval_times,
+              'NR_path':NR_path, 'NR_var':NR_var, 'MRMS_path':MRMS_path, 'MRMS_years':MRMS_years, 
+              'MRMS_offset':MRMS_offset, 'MRMS_var':MRMS_var, 'MRMS_fname':MRMS_fname, 
+              'ref_thres':ref_thres, 'min_size':min_size, 'lat_lim':lat_lim, 'lon_lim':lon_lim}
+    if MRMS_store_dir is not None:
+        config['MRMS_store_dir'] = MRMS_store_dir
+        MRMS_inputs = [mrms.store_fname(MRMS_store_dir, 'cref', y) for y in MRMS_years]
+    else:
+        MRMS_inputs = mrms.sample_files(MRMS_path, MRMS_years, 'cref', 
+                                        [dt.datetime.strptime(d.strftime('%Y%m%d') + t, 
+                                                              '%Y%m%d%H%M')
+                                         for d in eval_dates for t in eval_times], MRMS_offset)
+    inputs = (['%s/%s/cref_%s.nc' % (NR_path, d.strftime('%Y%m%d'), d.strftime('%Y%m%d'))
+               for d in eval_dates] + MRMS_inputs +
+              [f for f in [NR_mask_file, MRMS_mask_file] if f != None])
+    pickle_fname = cache.entry_fname(cache_dir, '%s_cref_obj_%sdbz_%sminsize_%s' % 
+                                     (model, ref_thres, min_size, domain), config, inputs=inputs,
+                                     scope='obj_based_mrms_cref_compare')
     try:
-        with open(pickle_fname, 'rb') as handle:
-            all_obj = pickle.load(handle)
+        all_obj = cache.read_pickle(pickle_fname)
         NR_obj = all_obj['NR_obj']
         MRMS_obj = all_obj['MRMS_obj']
         nMRMS = all_obj['nMRMS']
+        pickle_avail = True
     except FileNotFoundError:
         pickle_avail = False
 else:
@@ -98,27 +157,6 @@ else:
 
 if not pickle_avail:
 
-    # Define necessary variables for each input field
-    if model == 'NR':
-        NR_var = 'REFC_P0_L200_GLC0'
-    elif model == 'HRRR':
-        NR_var = 'REFC_P0_L10_GLC0'
-    MRMS_var = 'MergedReflectivityQCComposite_P0_L102_GLL0'
-    MRMS_fname = 'MRMS_MergedReflectivityQCComposite'
-    MRMS_no_coverage = -999.
-
-    # Add 0 to MRMS_offset if empty
-    if len(MRMS_offset) == 0:
-        MRMS_offset = [0]
-
-    # Spatial domain limits
-    if domain == 'all':
-        lat_lim = [5, 70]
-        lon_lim = [-150, -40]
-    elif domain == 'easternUS':
-        lat_lim = [5, 70]
-        lon_lim = [-100, -40]
-
     # Load NR and MRMS masks
     if NR_mask_file != None:
         NR_mask_external = np.load(NR_mask_file)
@@ -129,6 +167,13 @@ if not pickle_avail:
     else:
         MRMS_mask_external = 1
 
+    # Check that the MRMS store contains all years and eval_times and was created using the same
+    # MRMS mask before extracting any data
+    if MRMS_store_dir is not None:
+        mrms.check_store(MRMS_store_dir, 'cref', MRMS_years, hhmm=eval_times,
+                         bbox=(mrms.valid_bbox(MRMS_mask_external) if MRMS_mask_file != None else
+                               (slice(None), slice(None))))
+
     # Initialize dictionaries
     NR_obj = {}
     MRMS_obj = {}
@@ -142,72 +187,89 @@ if not pickle_avail:
             for k in range(nMRMS):
                 MRMS_obj[t][key].append([])
 
-    # Extract NR data
-    NR_mask = np.array([[np.nan]])
+    # Extract NR data. All NR files are opened lazily as a single dataset, and only the 2D fields at
+    # the requested times are decoded. Fields are cropped to the bounding box of the valid 
+    # gridpoints in the mask
     full_times = []
-    for d in eval_dates:
-        d_str = d.strftime('%Y%m%d')
-        try:
-            ds = xr.open_dataset('%s/%s/cref_%s.nc' % (NR_path, d_str, d_str))
-        except FileNotFoundError:
-            continue
+    ds = mrms.open_NR(NR_path, 'cref', eval_dates)
+    if ds is not None:
 
         # Create mask based on desired domain
-        if np.isnan(NR_mask[0, 0]):
-            NR_lat = ds['gridlat_0'].values
-            NR_lon = ds['gridlon_0'].values
-            NR_mask = NR_mask_external * ((NR_lat >= lat_lim[0]) * (NR_lat <= lat_lim[1]) *
-                                          (NR_lon >= lon_lim[0]) * (NR_lon <= lon_lim[1]))
-
-        # Unfortunately, the numpy datetime objects in ds and the datetime datetime objects in 
-        # eval_times cannot be easily compared, so we'll convert both of them to pd.Timestamp objects
-        ds_timestamps = np.empty(ds['time'].size, dtype=object)
-        for j, t in enumerate(ds['time'].values):
-            ds_timestamps[j] = pd.Timestamp(t)
-
-        print('NR extracting data for %s' % d_str)
-        for t in eval_times:
-            full_t = dt.datetime.strptime(d_str + t, '%Y%m%d%H%M')
-            try:
-                time_idx = np.where(ds_timestamps == pd.Timestamp(full_t))[0][0]
-            except IndexError:
-                continue
-            full_times.append(full_t)
-            NR_data = NR_mask * ds[NR_var][time_idx, :, :].values
-            NR_data_labeled, nlabels = sn.label(NR_data >= ref_thres)
+        NR_lat = ds['gridlat_0'].values
+        NR_lon = ds['gridlon_0'].values
+        NR_mask = (NR_mask_external * ((NR_lat >= lat_lim[0]) * (NR_lat <= lat_lim[1]) *
+                                       (NR_lon >= lon_lim[0]) * (NR_lon <= lon_lim[1]))) != 0
+        NR_bbox = mrms.valid_bbox(NR_mask)
+        NR_mask = NR_mask[NR_bbox]
+
+        sel_times = mrms.available_times(ds, [dt.datetime.strptime(d.strftime('%Y%m%d') + t, 
+                                                                   '%Y%m%d%H%M')
+                                              for d in eval_dates for t in eval_times])
+        NR_sel = ds[NR_var].sel(time=sel_times)
+        full_times = [pd.Timestamp(full_t).to_pydatetime() for full_t in sel_times]
+
+        for j, full_t in enumerate(full_times):
+            print('NR extracting data for %s' % full_t.strftime('%Y%m%d %H:%M'))
+            t = full_t.strftime('%H%M')
+            NR_data = NR_sel[j, NR_bbox[0], NR_bbox[1]].values
+            NR_data_labeled, nlabels = sn.label(NR_mask & (NR_data >= ref_thres))
             for label in range(1, nlabels):
-                size = np.sum(NR_data_labeled == label)
+                NR_obj_pts = (NR_data_labeled == label)
+                size = np.sum(NR_obj_pts)
                 if size >= min_size:
                     NR_obj[t]['size'].append(size)
-                    NR_obj[t]['max_dbz'].append(np.amax(NR_data * (NR_data_labeled == label)))
+                    NR_obj[t]['max_dbz'].append(np.amax(NR_data[NR_obj_pts]))
+        ds.close()
 
     # Extract MRMS data
-    MRMS_mask = np.array([[np.nan]])
+    MRMS_bbox = None
     MRMS_years_all, MRMS_offset_all = np.meshgrid(MRMS_years, MRMS_offset)
     MRMS_years_all = MRMS_years_all.ravel()
     MRMS_offset_all = MRMS_offset_all.ravel()
     for i, (y, o) in enumerate(zip(MRMS_years_all, MRMS_offset_all)):
         print()
         print('extracting MRMS data for year = %d, offset = %d' % (y, o))
+        if MRMS_store_dir is not None:
+            store = mrms.open_store(MRMS_store_dir, 'cref', y)
  
         for t in full_times:
             MRMS_time = t + dt.timedelta(days=float(o))
             print('extracting MRMS data for %s' % MRMS_time.strftime('%m %d %H:%M'))
-            fname_list = glob.glob('%s/%d/%d%s*%s*' % (MRMS_path, y, y, MRMS_time.strftime('%m%d-%H%M'), MRMS_fname))
-            if len(fname_list) == 0:
-                print('MRMS data for %d-%s is missing!' % (y, MRMS_time.strftime('%m-%d %H:%M')))
-                continue
-            ds = xr.open_dataset(fname_list[0], engine='pynio')
+            if MRMS_store_dir is None:
+                fname_list = glob.glob('%s/%d/%d%s*%s*' % (MRMS_path, y, y, MRMS_time.strftime('%m%d-%H%M'), MRMS_fname))
+                if len(fname_list) == 0:
+                    print('MRMS data for %d-%s is missing!' % (y, MRMS_time.strftime('%m-%d %H:%M')))
+                    continue
+                ds = xr.open_dataset(fname_list[0], engine='pynio')
+                mask_external = MRMS_mask_external
+            else:
+                try:
+                    store_data = mrms.read_store_time(store, 'cref', MRMS_time.replace(year=int(y)))
+                except ValueError:
+                    store_data = None
+                if store_data is None:
+                    print('MRMS data for %d-%s is missing!' % (y, MRMS_time.strftime('%m-%d %H:%M')))
+                    continue
+                ds = store
+                mask_external = MRMS_mask_external
+                if type(MRMS_mask_external) == np.ndarray:
+                    mask_external = MRMS_mask_external[mrms.store_bbox(store)]
 
             # Create mask for MRMS data
-            if np.isnan(MRMS_mask[0, 0]):
+            if MRMS_bbox is None:
                 MRMS_lon, MRMS_lat = np.meshgrid(ds['lon_0'].values - 360., ds['lat_0'].values)
-                MRMS_mask = MRMS_mask_external * ((MRMS_lat >= lat_lim[0]) * (MRMS_lat <= lat_lim[1]) *
-                                                  (MRMS_lon >= lon_lim[0]) * (MRMS_lon <= lon_lim[1]))
+                MRMS_mask = (mask_external * ((MRMS_lat >= lat_lim[0]) * (MRMS_lat <= lat_lim[1]) *
+                                              (MRMS_lon >= lon_lim[0]) * (MRMS_lon <= lon_lim[1]))) != 0
+                MRMS_bbox = mrms.valid_bbox(MRMS_mask)
+                MRMS_mask = MRMS_mask[MRMS_bbox]
 
             hhmm = t.strftime('%H%M')
-            MRMS_data = MRMS_mask * ds[MRMS_var].values
-            MRMS_data_bool = (MRMS_data >= ref_thres)
+            if MRMS_store_dir is None:
+                MRMS_data = ds[MRMS_var][MRMS_bbox[0], MRMS_bbox[1]].values
+                ds.close()
+            else:
+                MRMS_data = store_data[MRMS_bbox]
+            MRMS_data_bool = MRMS_mask & (MRMS_data >= ref_thres)
             MRMS_data_labeled, nlabels = sn.label(MRMS_data_bool)
 
             MRMS_obj_labels_all = np.unique(MRMS_data_labeled)[1:]
@@ -219,6 +281,9 @@ if not pickle_avail:
             MRMS_obj_max_dbz = sn.maximum(MRMS_data, MRMS_data_labeled, MRMS_obj_labels)
             MRMS_obj[hhmm]['size'][i] = MRMS_obj[hhmm]['size'][i] + list(MRMS_obj_size)
             MRMS_obj[hhmm]['max_dbz'][i] = MRMS_obj[hhmm]['max_dbz'][i] + list(MRMS_obj_max_dbz)
+
+        if (MRMS_store_dir is not None) and (store is not None):
+            store.close()
  
     # Save output to pickle file for use later
     if use_pickle:
@@ -228,8 +293,13 @@ if not pickle_avail:
         all_obj['nMRMS'] = nMRMS
         all_obj['ref_thres'] = ref_thres
         all_obj['min_size'] = min_size
-        with open(pickle_fname, 'wb') as handle:
-            pickle.dump(all_obj, handle)
+        cache.write_pickle(all_obj, pickle_fname)
+        cache.evict(cache_dir, max_entries=cache_max_entries, max_gb=cache_max_gb, 
+                    scope='obj_based_mrms_cref_compare')
+
+# Publish final objects to a stable path
+if use_pickle:
+    cache.publish(pickle_fname, final_fname)
 
 
 #---------------------------------------------------------------------------------------------------
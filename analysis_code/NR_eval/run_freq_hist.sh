@@ -2,8 +2,8 @@
 
 #SBATCH -A wrfruc
 #SBATCH -t 06:00:00
-#SBATCH --nodes=1 --ntasks=1
-#SBATCH --mem=4GB
+#SBATCH --nodes=1 --ntasks=1 --cpus-per-task=8
+#SBATCH --mem=16GB
 #SBATCH --partition=orion
 
 date
@@ -14,14 +14,14 @@ model=( 'NR' )
 field=( 'precip6hr' )
 domain=( 'all' 'easternUS' )
 zoom=( 'regular' )
+
+# All fields, domains, and bin sets for a model are computed in a single call, so each NR and MRMS 
+# file is only read once. MRMS files are read by a pool of SLURM_CPUS_PER_TASK worker processes
+fields=$(IFS=,; echo "${field[*]}")
+domains=$(IFS=,; echo "${domain[*]}")
+zooms=$(IFS=,; echo "${!zoom[*]}")
 for m in ${model[@]}; do
-  for f in ${field[@]}; do
-    for d in ${domain[@]}; do
-      for k in ${!zoom[@]}; do
-        python frequency_histograms.py $m $f $d $k "./${m}_${f}_${d}_${zoom[$k]}_landmask_spring_freq_hist.png"
-      done 
-    done
-  done
+  python frequency_histograms.py $m $fields $domains $zooms "./%s_%s_%s_%s_landmask_spring_freq_hist.png" ${SLURM_CPUS_PER_TASK:-1}
 done
 
 report-mem
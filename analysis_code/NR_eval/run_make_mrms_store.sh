@@ -0,0 +1,14 @@
+#!/bin/sh
+
+#SBATCH -A wrfruc
+#SBATCH -t 04:00:00
+#SBATCH --nodes=1 --ntasks=1 --cpus-per-task=4
+#SBATCH --mem=16GB
+#SBATCH --partition=orion
+
+. ~/.bashrc
+my_py
+
+date
+python make_mrms_store.py
+date
@@ -0,0 +1,2053 @@
+"""
+Functions Used to Compare Real and Simulated Surface Station Observations
+
+These functions are used by compare_NR_real_sfc_stations_perfect_matching.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import datetime as dt
+import multiprocessing as mp
+import concurrent.futures as cf
+import functools
+import glob
+import os
+import json
+import collections
+from metpy.units import units
+
+import pyDA_utils.bufr as bufr
+import met_conversions as metconv
+
+
+#---------------------------------------------------------------------------------------------------
+# Constants
+#---------------------------------------------------------------------------------------------------
+
+# Numeric and sky cover columns retained from the IEM files. Any other columns are discarded
+iem_float_cols = ['lon', 'lat', 'elevation', 'tmpf', 'dwpf', 'relh', 'drct', 'sknt', 'p01i', 'alti',
+                  'mslp', 'vsby', 'gust', 'skyl1', 'skyl2', 'skyl3', 'skyl4']
+iem_skyc_cols = ['skyc1', 'skyc2', 'skyc3', 'skyc4']
+iem_skyl_cols = ['skyl1', 'skyl2', 'skyl3', 'skyl4']
+
+# Entries in the real_stations and fake_stations dictionaries that are not defined at each analysis
+# time (these are stored separately in the station data cube)
+station_summary_keys = ['n_skyl', 'ceil_nobs', 'frac_ceil', 'frac_ceil_thres']
+
+# Settings that are saved as attributes in the station data cube. The cube can only be updated
+# incrementally if the ingest settings are unchanged. If the statistics settings change, the 
+# ingested obs are retained, but all z-scores and ranks are recomputed
+ingest_attr_keys = ['elv_adjust_prs', 'elv_adjust_T', 'max_time_allowed', 'startdate', 'enddate']
+stats_attr_keys = ['zscore', 'zscore_min_pts', 'climo_pool_days']
+dataset_attr_keys = ingest_attr_keys + stats_attr_keys
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def iem_times_to_seconds(valid, analysis_year):
+    """
+    Convert IEM 'valid' timestamps to seconds since 1 January of analysis_year
+
+    The year of each timestamp is replaced by analysis_year (i.e., month, day, hour, and minute are
+    retained), which allows obs from different years to be matched to the same analysis times.
+
+    Parameters
+    ----------
+    valid : pd.Series
+        IEM timestamps (datetime64 or strings formatted as YYYY-MM-DD HH:MM)
+    analysis_year : integer
+        Year that all timestamps are mapped to
+
+    Returns
+    -------
+    seconds : np.array
+        Seconds since 1 January of analysis_year
+
+    """
+
+    times = pd.Series(valid)
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        times = pd.to_datetime(times, format='%Y-%m-%d %H:%M')
+    shifted = pd.to_datetime(pd.DataFrame({'year':analysis_year, 'month':times.dt.month,
+                                           'day':times.dt.day, 'hour':times.dt.hour,
+                                           'minute':times.dt.minute}))
+    seconds = (shifted - pd.Timestamp(analysis_year, 1, 1)).dt.total_seconds().values
+
+    return seconds
+
+
+def analysis_times_to_seconds(analysis_days, analysis_times):
+    """
+    Convert all combinations of analysis_days and analysis_times to seconds since 1 January of
+    the analysis year
+
+    Parameters
+    ----------
+    analysis_days : list of dt.datetime objects
+        Analysis days
+    analysis_times : list of dt.timedelta objects
+        Analysis times relative to 0000 UTC
+
+    Returns
+    -------
+    seconds : np.array
+        Seconds since 1 January of the analysis year. Dimensions are (ndays, ntimes)
+
+    """
+
+    start = dt.datetime(analysis_days[0].year, 1, 1)
+    seconds = np.array([[((d + t) - start).total_seconds() for t in analysis_times]
+                        for d in analysis_days])
+
+    return seconds
+
+
+def match_nearest_times(ob_times, target_times, max_time_allowed):
+    """
+    Find the observation closest in time to each target time
+
+    The observation times are sorted once and all target times are resolved using a single call to
+    np.searchsorted. Results are identical to running np.argmin(np.abs(ob_times - t)) for each
+    target time t (including ties, which are resolved in favor of the smallest index in ob_times).
+
+    Parameters
+    ----------
+    ob_times : np.array
+        Observation times (any units, but must match target_times)
+    target_times : np.array
+        Target times
+    max_time_allowed : float
+        Maximum time difference allowed between a target time and the closest observation
+
+    Returns
+    -------
+    idx : np.array
+        Index of the closest observation in ob_times for each target time
+    valid : np.array
+        Boolean array that is True if the closest observation is within max_time_allowed
+
+    """
+
+    target_times = np.asarray(target_times, dtype=float)
+    if len(ob_times) == 0:
+        return (np.zeros(target_times.shape, dtype=int), np.zeros(target_times.shape, dtype=bool))
+
+    # Stable sort ensures that the first occurrence of a repeated time has the smallest index
+    order = np.argsort(ob_times, kind='stable')
+    sorted_times = np.asarray(ob_times, dtype=float)[order]
+    nobs = sorted_times.size
+
+    # Candidates on either side of each target time. Using side='left' means that the right
+    # candidate is already the first occurrence of its time. The left candidate is moved to the
+    # first occurrence of its time using a second search
+    right = np.searchsorted(sorted_times, target_times, side='left')
+    left = np.searchsorted(sorted_times, sorted_times[np.maximum(right - 1, 0)], side='left')
+    right = np.minimum(right, nobs - 1)
+
+    diff_left = np.abs(sorted_times[left] - target_times)
+    diff_right = np.abs(sorted_times[right] - target_times)
+    use_left = ((diff_left < diff_right) |
+                ((diff_left == diff_right) & (order[left] < order[right])))
+
+    idx = np.where(use_left, order[left], order[right])
+    valid = np.where(use_left, diff_left, diff_right) <= max_time_allowed
+
+    return idx, valid
+
+
+def read_iem_file(fname, dtype=np.float64):
+    """
+    Read a raw IEM text file into a typed DataFrame
+
+    Missing values (flagged using 'M') are set to NaN, numeric columns are cast to dtype, and the
+    'valid' column is converted to datetime64.
+
+    Parameters
+    ----------
+    fname : string
+        IEM text file
+    dtype : numpy dtype, optional
+        Data type used for the numeric columns
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Typed IEM obs
+
+    """
+
+    raw_df = pd.read_csv(fname, skiprows=5, dtype=str, keep_default_na=False, na_values=['M'])
+
+    df = pd.DataFrame({'valid':pd.to_datetime(raw_df['valid'], format='%Y-%m-%d %H:%M')})
+    for c in iem_float_cols:
+        if c in raw_df.columns:
+            df[c] = pd.to_numeric(raw_df[c], errors='coerce').astype(dtype)
+    for c in iem_skyc_cols:
+        if c in raw_df.columns:
+            df[c] = raw_df[c].astype(object)
+
+    return df
+
+
+def iem_cache_fname(ID, cache_dir):
+    """
+    Name of the columnar (Parquet) cache file for a station
+    """
+
+    return '%s/%s.parquet' % (cache_dir, ID)
+
+
+def iem_sources_fname(ID, cache_dir):
+    """
+    Name of the file listing the sources of the columnar (Parquet) cache for a station
+    """
+
+    return '%s/%s.sources.json' % (cache_dir, ID)
+
+
+def iem_raw_fname(real_obs_dir, ID, yr, startdate, enddate):
+    """
+    Name of the raw IEM file for a station, year, and time window (MMDDHHMM)
+    """
+
+    return '%s/%s_%d%s_%d%s.txt' % (real_obs_dir, ID, yr, startdate, yr, enddate)
+
+
+def iem_cache_sources(ID, cache_dir):
+    """
+    Directories and raw IEM files used to create the cache for a station (see 
+    write_iem_station_cache). Returns None if the cache (or its list of sources) does not exist
+    """
+
+    if not os.path.isfile(iem_cache_fname(ID, cache_dir)):
+        return None
+    try:
+        with open(iem_sources_fname(ID, cache_dir), 'r') as fptr:
+            return json.load(fptr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def iem_cache_covers(ID, cache_dir, fnames):
+    """
+    Check whether the cache for a station was created from the current version of each raw IEM file
+    in fnames (files that do not exist are ignored)
+    """
+
+    sources = iem_cache_sources(ID, cache_dir)
+    if sources is None:
+        return False
+    for f in fnames:
+        if not os.path.isfile(f):
+            continue
+        st = os.stat(f)
+        if sources['files'].get(os.path.abspath(f)) != [st.st_size, st.st_mtime_ns]:
+            return False
+
+    return True
+
+
+def write_iem_station_cache(ID, real_obs_dirs, cache_dir):
+    """
+    Write the full record for a station to a columnar (Parquet) cache
+
+    All IEM files for this station in real_obs_dirs are parsed once, combined, and sorted by time.
+    Numeric columns are stored as float32 (with NaN for missing values) and times are stored as
+    datetime64, so subsequent reads do not need to parse any text. The directories and the size and
+    modification time of each raw IEM file are saved to iem_sources_fname, so that 
+    requests for windows or directories that are not in the cache can be detected (see 
+    iem_cache_covers).
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    real_obs_dirs : list of strings
+        Directories containing the raw IEM files (named [ID]_[start]_[end].txt)
+    cache_dir : string
+        Directory containing the cache files
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Full record for this station
+
+    """
+
+    fnames = []
+    for d in real_obs_dirs:
+        fnames = fnames + sorted(glob.glob('%s/%s_*.txt' % (d, ID)))
+
+    if len(fnames) == 0:
+        raise FileNotFoundError('no IEM files found for %s' % ID)
+
+    dfs = [read_iem_file(f, dtype=np.float32) for f in fnames]
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) > 0:
+        df = pd.concat(dfs, ignore_index=True)
+    else:
+        df = read_iem_file(fnames[0], dtype=np.float32)
+
+    # Files for overlapping windows contain the same obs, so remove duplicate rows
+    df = df.drop_duplicates(ignore_index=True)
+    df = df.sort_values('valid', kind='stable', ignore_index=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_parquet(iem_cache_fname(ID, cache_dir), index=False)
+    sources = {'dirs':[os.path.abspath(d) for d in real_obs_dirs], 'files':{}}
+    for f in fnames:
+        st = os.stat(f)
+        sources['files'][os.path.abspath(f)] = [st.st_size, st.st_mtime_ns]
+    with open(iem_sources_fname(ID, cache_dir), 'w') as fptr:
+        json.dump(sources, fptr, indent=2, sort_keys=True)
+
+    return df
+
+
+def iem_year_windows(years, startdate, enddate):
+    """
+    Start and end times (dt.datetime objects) of the startdate to enddate window (MMDDHHMM) in each
+    year
+    """
+
+    return [(dt.datetime.strptime('%d%s' % (yr, startdate), '%Y%m%d%H%M'),
+             dt.datetime.strptime('%d%s' % (yr, enddate), '%Y%m%d%H%M')) for yr in years]
+
+
+def read_iem_station_cache(ID, cache_dir, years, startdate, enddate, columns):
+    """
+    Read a subset of the columnar (Parquet) cache for a station
+
+    Only the requested columns and the times within the startdate to enddate window (start
+    inclusive, end exclusive, matching the IEM download) for each year are read from disk.
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    cache_dir : string
+        Directory containing the cache files
+    years : np.array
+        Years
+    startdate, enddate : string
+        Start and end of the time window (MMDDHHMM)
+    columns : list of strings
+        Columns to read (in addition to 'valid')
+
+    Returns
+    -------
+    dfs : list of pd.DataFrame
+        IEM obs for each year
+
+    """
+
+    return read_iem_station_cache_windows(ID, cache_dir, iem_year_windows(years, startdate, enddate),
+                                          columns)
+
+
+def read_iem_station_cache_windows(ID, cache_dir, windows, columns):
+    """
+    Read several time windows from the columnar (Parquet) cache for a station
+
+    The cache file is only read once (rows outside of all windows are skipped), then each window is
+    sliced from memory.
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    cache_dir : string
+        Directory containing the cache files
+    windows : list of tuples
+        Start (inclusive) and end (exclusive) times of each window (dt.datetime objects)
+    columns : list of strings
+        Columns to read (in addition to 'valid')
+
+    Returns
+    -------
+    dfs : list of pd.DataFrame
+        IEM obs for each window
+
+    """
+
+    filters = [[('valid', '>=', pd.Timestamp(s)), ('valid', '<', pd.Timestamp(e))] 
+               for s, e in windows]
+    df = pd.read_parquet(iem_cache_fname(ID, cache_dir), columns=['valid'] + columns, 
+                         filters=filters)
+
+    dfs = []
+    for s, e in windows:
+        dfs.append(df.loc[(df['valid'] >= s) & (df['valid'] < e)].reset_index(drop=True))
+
+    return dfs
+
+
+def iem_ceiling(df):
+    """
+    Derive the ceiling for each ob in an IEM record
+
+    The ceiling is the lowest layer with broken (BKN) or overcast (OVC) sky cover. All obs and all
+    four sky cover layers are evaluated at once.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Typed IEM obs (see read_iem_file)
+
+    Returns
+    -------
+    ceil : np.array
+        Ceiling height (ft). NaN if there is no ceiling or the ceiling height is missing
+    has_ceil : np.array
+        Boolean array that is True if there is a ceiling (regardless of whether the ceiling height
+        is missing)
+    has_skyc : np.array
+        Boolean array that is True if sky cover is reported for at least one layer
+
+    """
+
+    skyc = df[iem_skyc_cols].values
+    skyl = np.float64(df[iem_skyl_cols].values)
+
+    ceil_layer = (skyc == 'OVC') | (skyc == 'BKN')
+    has_ceil = np.any(ceil_layer, axis=1)
+    has_skyc = ~np.all(pd.isna(skyc), axis=1)
+    ceil = np.fmin.reduce(np.where(ceil_layer, skyl, np.nan), axis=1)
+
+    return ceil, has_ceil, has_skyc
+
+
+def ceiling_cdf(ceil, bins, norm):
+    """
+    Compute the cumulative histogram of ceiling heights along the last axis
+
+    All leading indices (e.g., stations and years) are binned using a single call to np.bincount.
+    Bins follow the np.histogram convention (all bins are half open, except the last bin, which
+    includes the right edge) and NaNs are ignored.
+
+    Parameters
+    ----------
+    ceil : np.array
+        Ceiling heights. Trailing dimension is obs
+    bins : np.array
+        Bin edges
+    norm : np.array or float
+        Normalization for each leading index (e.g., the number of obs with sky cover information).
+        Dimensions are the same as ceil, excluding the trailing dimension
+
+    Returns
+    -------
+    cdf : np.array
+        Cumulative fraction of obs in each bin. Dimensions are the same as ceil, except the trailing
+        dimension, which is len(bins) - 1
+
+    """
+
+    ceil = np.asarray(ceil, dtype=float)
+    nbins = len(bins) - 1
+    lead_shape = ceil.shape[:-1]
+    ceil = ceil.reshape(-1, ceil.shape[-1])
+    nrows = ceil.shape[0]
+
+    idx = np.searchsorted(bins, ceil, side='right') - 1
+    idx[ceil == bins[-1]] = nbins - 1
+    valid = ~np.isnan(ceil) & (idx >= 0) & (idx < nbins)
+    row = np.broadcast_to(np.arange(nrows)[:, np.newaxis], ceil.shape)
+    counts = np.bincount(row[valid] * nbins + idx[valid], minlength=nrows*nbins)
+
+    cdf = (np.cumsum(counts.reshape(lead_shape + (nbins,)), axis=-1) / 
+           np.asarray(norm)[..., np.newaxis])
+
+    return cdf
+
+
+def match_iem_obs(tmp_df, analysis_year, analysis_times_tot, real_varnames, max_time_allowed,
+                  ceil_thres):
+    """
+    Match IEM obs from a single station and year to the analysis times
+
+    Parameters
+    ----------
+    tmp_df : pd.DataFrame
+        Typed IEM obs (see read_iem_file)
+    analysis_year : integer
+        Year of the analysis times
+    analysis_times_tot : np.array
+        Analysis times in seconds since 1 January of analysis_year. Dimensions are (ndays, ntimes)
+    real_varnames : list of strings
+        Variables to extract
+    max_time_allowed : float
+        Maximum time allowed between the analysis times and the real ob (s)
+    ceil_thres : list of floats
+        Ceiling thresholds (km)
+
+    Returns
+    -------
+    out : dictionary
+        Compact arrays for this station and year: 'vals' (nvars, ndays, ntimes), 'ceil'
+        (ndays * ntimes), 'n_skyl', 'ceil_nobs' (number of obs with sky cover information),
+        'frac_ceil', and 'frac_ceil_thres' (nthres). None is returned if there are no thermodynamic
+        and kinematic obs
+
+    """
+
+    ndays, ntimes = analysis_times_tot.shape
+
+    # Only retain times with thermodynamic and kinematic obs (this eliminates special obs for
+    # gusts, etc.)
+    ss_df = tmp_df.loc[~np.isnan(tmp_df['tmpf']) & ~np.isnan(tmp_df['drct'])].copy()
+    ss_df.reset_index(inplace=True, drop=True)
+
+    if len(ss_df) == 0:
+        return None
+
+    # Match all analysis times to the closest ob using a single sorted search, then gather all
+    # variables at once
+    station_times_tot = iem_times_to_seconds(ss_df['valid'], analysis_year)
+    match_idx, match_valid = match_nearest_times(station_times_tot, analysis_times_tot.ravel(),
+                                                 max_time_allowed)
+    ob_vals = np.float64(ss_df[real_varnames].values)
+    matched_vals = np.where(match_valid[:, np.newaxis], ob_vals[match_idx, :], np.nan)
+
+    # Ceiling for each ob in the record, then gather the ceilings at the matched obs
+    ceil, has_ceil, has_skyc = iem_ceiling(ss_df)
+    ceil = ceil[match_idx]
+    has_ceil = has_ceil[match_idx]
+    has_skyc = has_skyc[match_idx]
+
+    out = {}
+    out['vals'] = matched_vals.T.reshape(len(real_varnames), ndays, ntimes)
+    out['ceil'] = (ceil * units.ft).to(units.km).magnitude
+    out['n_skyl'] = np.count_nonzero(~np.isnan(ceil)) + np.count_nonzero(has_skyc & ~has_ceil)
+    out['ceil_nobs'] = np.count_nonzero(has_skyc)
+    out['frac_ceil'] = np.nan
+    out['frac_ceil_thres'] = np.ones(len(ceil_thres)) * np.nan
+    if out['ceil_nobs'] > 0:
+        out['frac_ceil'] = np.count_nonzero(has_ceil) / out['ceil_nobs']
+        out['frac_ceil_thres'] = (np.sum(out['ceil'][:, np.newaxis] <= np.array(ceil_thres), axis=0) /
+                                  out['ceil_nobs'])
+
+    return out
+
+
+def extract_iem_station_year(ID, yr, real_obs_dir, startdate, enddate, analysis_year,
+                             analysis_times_tot, real_varnames, max_time_allowed, ceil_thres):
+    """
+    Extract real surface station obs from a single raw IEM file (one station, one year)
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    yr : integer
+        Year
+    real_obs_dir : string
+        Directory containing the IEM files
+    startdate, enddate : string
+        Start and end dates in the IEM file names (MMDDHHMM)
+    Other parameters : See match_iem_obs
+
+    Returns
+    -------
+    out : dictionary
+        See match_iem_obs
+
+    """
+
+    tmp_df = read_iem_file(iem_raw_fname(real_obs_dir, ID, yr, startdate, enddate))
+
+    if len(tmp_df) == 0:
+        print('No data for %s %d (all data will be NaN)' % (ID, yr))
+        return None
+
+    out = match_iem_obs(tmp_df, analysis_year, analysis_times_tot, real_varnames,
+                        max_time_allowed, ceil_thres)
+    if out is None:
+        print('No thermodynamic and kinematic data for %s %d (all data will be NaN)' % (ID, yr))
+
+    return out
+
+
+def extract_iem_station_cache(ID, years, cache_dir, real_obs_dir, startdate, enddate,
+                              analysis_year, analysis_times_tot, real_varnames, max_time_allowed,
+                              ceil_thres):
+    """
+    Extract real surface station obs for all years from the columnar cache (one station)
+
+    The cache for this station is created from the raw IEM files in real_obs_dir if it does not
+    exist yet (or does not contain the current raw IEM files for the requested years and window).
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    years : np.array
+        Years
+    cache_dir : string
+        Directory containing the cache files
+    real_obs_dir : string
+        Directory containing the raw IEM files (only used if the cache needs to be created)
+    startdate, enddate : string
+        Start and end of the time window (MMDDHHMM)
+    Other parameters : See match_iem_obs
+
+    Returns
+    -------
+    out : list of dictionaries
+        Output from match_iem_obs for each year
+
+    """
+
+    request = {'years':years, 'real_obs_dir':real_obs_dir, 'startdate':startdate, 
+               'enddate':enddate, 'analysis_year':analysis_year, 
+               'analysis_times_tot':analysis_times_tot}
+
+    return extract_iem_station_requests(ID, [request], cache_dir, real_varnames, max_time_allowed,
+                                        ceil_thres)[0]
+
+
+def extract_iem_station_requests(ID, requests, cache_dir, real_varnames, max_time_allowed,
+                                 ceil_thres):
+    """
+    Extract real surface station obs for several analysis windows from the columnar cache (one 
+    station)
+
+    The cache for this station is read once for all requests, and the obs for each request and year
+    are sliced from memory. The cache is created from the raw IEM files in the real_obs_dir of each
+    request if it does not exist yet. If the cache does not contain the current raw IEM file for 
+    each request and year (e.g., a cache created from the winter files is used for a spring window),
+    it is rebuilt from the directories used previously plus the real_obs_dir of each request.
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    requests : list of dictionaries
+        Each request has the keys 'years', 'real_obs_dir', 'startdate', 'enddate' (MMDDHHMM),
+        'analysis_year', and 'analysis_times_tot' (see match_iem_obs)
+    cache_dir : string
+        Directory containing the cache files
+    Other parameters : See match_iem_obs
+
+    Returns
+    -------
+    out : list of lists of dictionaries
+        Output from match_iem_obs for each request and year
+
+    """
+
+    fnames = [iem_raw_fname(r['real_obs_dir'], ID, yr, r['startdate'], r['enddate']) 
+              for r in requests for yr in r['years']]
+    if not iem_cache_covers(ID, cache_dir, fnames):
+        sources = iem_cache_sources(ID, cache_dir)
+        dirs = [os.path.abspath(r['real_obs_dir']) for r in requests]
+        if sources is None:
+            print('Creating IEM cache for %s' % ID)
+        else:
+            print('Updating IEM cache for %s' % ID)
+            dirs = sources['dirs'] + dirs
+        write_iem_station_cache(ID, list(dict.fromkeys(dirs)), cache_dir)
+
+    windows = [iem_year_windows(r['years'], r['startdate'], r['enddate']) for r in requests]
+    dfs = read_iem_station_cache_windows(ID, cache_dir, [w for rw in windows for w in rw],
+                                         list(np.unique(real_varnames + iem_skyc_cols + iem_skyl_cols)))
+
+    out = []
+    i = 0
+    for r in requests:
+        out.append([])
+        for yr in r['years']:
+            tmp_df = dfs[i]
+            i = i + 1
+            if len(tmp_df) == 0:
+                print('No data for %s %d (all data will be NaN)' % (ID, yr))
+                out[-1].append(None)
+                continue
+            out[-1].append(match_iem_obs(tmp_df, r['analysis_year'], r['analysis_times_tot'],
+                                         real_varnames, max_time_allowed, ceil_thres))
+            if out[-1][-1] is None:
+                print('No thermodynamic and kinematic data for %s %d (all data will be NaN)' % 
+                      (ID, yr))
+
+    return out
+
+
+def extract_real_obs(station_ids, years, real_obs_dir, startdate, enddate, analysis_days,
+                     analysis_times, real_varnames, max_time_allowed, ceil_thres, nprocs=1,
+                     cache_dir=None):
+    """
+    Extract real surface station obs from the IEM files for all stations and years
+
+    Each raw (station, year) file is read by extract_iem_station_year. If cache_dir is provided,
+    each station is instead read from the columnar cache by extract_iem_station_cache. If
+    nprocs > 1, the reads are distributed across a pool of worker processes, and the compact arrays
+    returned by each worker are assembled into the output dictionary by the parent process.
+
+    Parameters
+    ----------
+    station_ids : list of strings
+        Station IDs
+    years : np.array
+        Years
+    real_obs_dir : string
+        Directory containing the IEM files
+    startdate, enddate : string
+        Start and end dates in the IEM file names (MMDDHHMM)
+    analysis_days : list of dt.datetime objects
+        Analysis days
+    analysis_times : list of dt.timedelta objects
+        Analysis times relative to 0000 UTC
+    real_varnames : list of strings
+        Variables to extract
+    max_time_allowed : float
+        Maximum time allowed between the analysis times and the real ob (s)
+    ceil_thres : list of floats
+        Ceiling thresholds (km)
+    nprocs : integer, optional
+        Number of worker processes. Files are read serially if nprocs = 1
+    cache_dir : string, optional
+        Directory containing the columnar cache files. Set to None to read the raw IEM files
+
+    Returns
+    -------
+    real_stations : dictionary
+        Real obs. Keys are station IDs, then variables. Variables in real_varnames have dimensions
+        (nyears * ndays, ntimes)
+
+    """
+
+    ndays = len(analysis_days)
+    ntimes = len(analysis_times)
+    analysis_year = analysis_days[0].year
+    analysis_times_tot = analysis_times_to_seconds(analysis_days, analysis_times)
+
+    # Read each (station, year) raw file or each station cache
+    kw = {'real_obs_dir':real_obs_dir, 'startdate':startdate, 'enddate':enddate,
+          'analysis_year':analysis_year, 'analysis_times_tot':analysis_times_tot,
+          'real_varnames':real_varnames, 'max_time_allowed':max_time_allowed,
+          'ceil_thres':ceil_thres}
+    if cache_dir is None:
+        tasks = [(ID, yr) for ID in station_ids for yr in years]
+        read_fct = functools.partial(extract_iem_station_year, **kw)
+        chunksize = max(1, len(years) // 2)
+    else:
+        tasks = [(ID, years) for ID in station_ids]
+        read_fct = functools.partial(extract_iem_station_cache, cache_dir=cache_dir, **kw)
+        chunksize = 1
+    if nprocs > 1:
+        print('Extracting real obs using %d processes' % nprocs)
+        with cf.ProcessPoolExecutor(max_workers=nprocs, mp_context=mp.get_context('fork')) as pool:
+            results = list(pool.map(read_fct, [t[0] for t in tasks], [t[1] for t in tasks],
+                                    chunksize=chunksize))
+    else:
+        results = []
+        for ID, arg in tasks:
+            if (cache_dir is not None) or (arg == years[0]):
+                print('Extracting real obs at %s' % ID)
+            results.append(read_fct(ID, arg))
+    if cache_dir is not None:
+        results = [out for station_results in results for out in station_results]
+
+    return assemble_real_obs(results, station_ids, years, ndays, ntimes, real_varnames, ceil_thres)
+
+
+def extract_real_obs_batch(requests, real_varnames, max_time_allowed, ceil_thres, nprocs=1,
+                           cache_dir=None):
+    """
+    Extract real surface station obs for several analysis windows (e.g., different seasons)
+
+    If cache_dir is provided, each station is read from the columnar cache only once, and all 
+    requests that include that station are sliced from memory by extract_iem_station_requests (so
+    the cost of an additional window is only the matching of the obs to its analysis times). If 
+    nprocs > 1, the stations are distributed across a pool of worker processes. If cache_dir is
+    None, each request is extracted separately from its raw IEM files using extract_real_obs.
+
+    Parameters
+    ----------
+    requests : list of dictionaries
+        Each request has the keys 'station_ids', 'years', 'real_obs_dir', 'startdate', 'enddate',
+        'analysis_days', and 'analysis_times' (see extract_real_obs)
+    real_varnames : list of strings
+        Variables to extract
+    max_time_allowed : float
+        Maximum time allowed between the analysis times and the real ob (s)
+    ceil_thres : list of floats
+        Ceiling thresholds (km)
+    nprocs : integer, optional
+        Number of worker processes. Stations are read serially if nprocs = 1
+    cache_dir : string, optional
+        Directory containing the columnar cache files. Set to None to read the raw IEM files
+
+    Returns
+    -------
+    real_stations : list of dictionaries
+        Real obs for each request (see extract_real_obs)
+
+    """
+
+    if cache_dir is None:
+        return [extract_real_obs(r['station_ids'], r['years'], r['real_obs_dir'], r['startdate'],
+                                 r['enddate'], r['analysis_days'], r['analysis_times'], 
+                                 real_varnames, max_time_allowed, ceil_thres, nprocs=nprocs)
+                for r in requests]
+
+    # Requests that include each station
+    station_ids = list(dict.fromkeys([ID for r in requests for ID in r['station_ids']]))
+    station_requests = {ID:[i for i, r in enumerate(requests) if ID in r['station_ids']] 
+                        for ID in station_ids}
+    compact = [{'years':r['years'], 'real_obs_dir':r['real_obs_dir'], 'startdate':r['startdate'],
+                'enddate':r['enddate'], 'analysis_year':r['analysis_days'][0].year,
+                'analysis_times_tot':analysis_times_to_seconds(r['analysis_days'], 
+                                                               r['analysis_times'])}
+               for r in requests]
+
+    read_fct = functools.partial(extract_iem_station_requests, cache_dir=cache_dir, 
+                                 real_varnames=real_varnames, max_time_allowed=max_time_allowed,
+                                 ceil_thres=ceil_thres)
+    tasks = [[compact[i] for i in station_requests[ID]] for ID in station_ids]
+    if nprocs > 1:
+        print('Extracting real obs using %d processes' % nprocs)
+        with cf.ProcessPoolExecutor(max_workers=nprocs, mp_context=mp.get_context('fork')) as pool:
+            results = list(pool.map(read_fct, station_ids, tasks))
+    else:
+        results = []
+        for ID, task in zip(station_ids, tasks):
+            print('Extracting real obs at %s (%d windows)' % (ID, len(task)))
+            results.append(read_fct(ID, task))
+    results = dict(zip(station_ids, results))
+
+    # Assemble output for each request
+    real_stations = []
+    for i, r in enumerate(requests):
+        req_results = [out for ID in r['station_ids']
+                       for out in results[ID][station_requests[ID].index(i)]]
+        real_stations.append(assemble_real_obs(req_results, r['station_ids'], r['years'],
+                                               len(r['analysis_days']), len(r['analysis_times']),
+                                               real_varnames, ceil_thres))
+
+    return real_stations
+
+
+def assemble_real_obs(results, station_ids, years, ndays, ntimes, real_varnames, ceil_thres):
+    """
+    Assemble the compact arrays returned by match_iem_obs into the real_stations dictionary
+
+    Parameters
+    ----------
+    results : list of dictionaries
+        Output from match_iem_obs for each station and year (years vary fastest). None if there is
+        no data for that station and year
+    station_ids : list of strings
+        Station IDs
+    years : np.array
+        Years
+    ndays, ntimes : integer
+        Number of analysis days and analysis times
+    real_varnames : list of strings
+        Variables to extract
+    ceil_thres : list of floats
+        Ceiling thresholds (km)
+
+    Returns
+    -------
+    real_stations : dictionary
+        Real obs (see extract_real_obs)
+
+    """
+
+    real_stations = {}
+    for i, ID in enumerate(station_ids):
+        real_stations[ID] = {}
+        for v in real_varnames:
+            real_stations[ID][v] = np.ones([len(years) * ndays, ntimes]) * np.nan
+        real_stations[ID]['ceil'] = np.ones([len(years), ntimes * ndays]) * np.nan
+        real_stations[ID]['n_skyl'] = np.zeros(len(years))
+        real_stations[ID]['ceil_nobs'] = np.zeros(len(years))
+        real_stations[ID]['frac_ceil'] = np.zeros(len(years)) * np.nan
+        real_stations[ID]['frac_ceil_thres'] = np.zeros([len(ceil_thres), len(years)]) * np.nan
+        for j in range(len(years)):
+            out = results[i*len(years) + j]
+            if out is None:
+                continue
+            for n, v in enumerate(real_varnames):
+                real_stations[ID][v][(j*ndays):((j+1)*ndays), :] = out['vals'][n]
+            real_stations[ID]['ceil'][j, :] = out['ceil']
+            real_stations[ID]['n_skyl'][j] = out['n_skyl']
+            real_stations[ID]['ceil_nobs'][j] = out['ceil_nobs']
+            real_stations[ID]['frac_ceil'][j] = out['frac_ceil']
+            real_stations[ID]['frac_ceil_thres'][:, j] = out['frac_ceil_thres']
+
+    return real_stations
+
+
+def convert_real_obs(real_stations):
+    """
+    Convert real obs to the same units/variables as the fake obs
+
+    Note that the surface stations report the altimeter setting rather than station-level pressure.
+    The difference between these two is discussed here:
+    https://www.weather.gov/bou/pressure_definitions
+
+    Conversions use the plain NumPy versions of the MetPy formulas in met_conversions.py (see
+    met_conversions.verify for a comparison against MetPy).
+
+    Parameters
+    ----------
+    real_stations : dictionary
+        Real obs (see extract_real_obs). Modified in place
+
+    Returns
+    -------
+    real_stations : dictionary
+        Real obs with POB, TOB, QOB, UOB, VOB, WSPD, and WDIR added
+
+    """
+
+    for ID in real_stations:
+        real = real_stations[ID]
+        real['POB'] = metconv.altimeter_to_station_pressure(real['alti'], real['elevation'])
+        real['TOB'] = metconv.degF_to_degC(real['tmpf'])
+        real['QOB'] = metconv.specific_humidity_from_dewpoint(real['POB'], 
+                                                              metconv.degF_to_degC(real['dwpf'])) * 1e6
+        real['WSPD'] = real['sknt'] * metconv.kt_to_ms
+        real['UOB'], real['VOB'] = metconv.wind_components(real['WSPD'], real['drct'])
+        real['WDIR'] = real['drct']
+        real['lon'] = real['lon'] + 360.
+
+    return real_stations
+
+
+def insert_real_obs(real_stations, subset, year_idx, day_idx, hour_idx, ndays, ntimes,
+                    partial=False):
+    """
+    Insert real obs extracted for a subset of the years, analysis days, and analysis times into
+    real_stations
+
+    Parameters
+    ----------
+    real_stations : dictionary
+        Real obs for all years, analysis days, and analysis times. Modified in place. Stations in
+        subset that are not in real_stations are added (in which case subset must cover all years,
+        analysis days, and analysis times)
+    subset : dictionary
+        Real obs for the subset (see extract_real_obs)
+    year_idx, day_idx, hour_idx : np.array
+        Indices of the years, analysis days, and analysis times in subset
+    ndays, ntimes : integer
+        Number of analysis days and analysis times in real_stations
+    partial : boolean, optional
+        Set to True if subset only includes some of the analysis days and times for each year. The
+        ceiling statistics from subset are then combined with the existing statistics (using the
+        number of obs with sky cover information) rather than replacing them
+
+    Returns
+    -------
+    real_stations : dictionary
+        Updated real obs
+
+    """
+
+    sub_shape = [len(year_idx), len(day_idx), len(hour_idx)]
+    idx = np.ix_(year_idx, day_idx, hour_idx)
+
+    for ID, sub in subset.items():
+        if ID not in real_stations:
+            real_stations[ID] = sub
+            continue
+        full = real_stations[ID]
+        for v in sub:
+            if v not in station_summary_keys:
+                full[v].reshape(-1, ndays, ntimes)[idx] = sub[v].reshape(sub_shape)
+
+        if partial:
+            nobs = full['ceil_nobs'][year_idx] + sub['ceil_nobs']
+            for key in ['frac_ceil', 'frac_ceil_thres']:
+                counts = (np.round(np.nan_to_num(full[key][..., year_idx] * full['ceil_nobs'][year_idx])) +
+                          np.round(np.nan_to_num(sub[key] * sub['ceil_nobs'])))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    full[key][..., year_idx] = np.where(nobs > 0, counts / nobs, np.nan)
+            full['n_skyl'][year_idx] = full['n_skyl'][year_idx] + sub['n_skyl']
+            full['ceil_nobs'][year_idx] = nobs
+        else:
+            for key in station_summary_keys:
+                full[key][..., year_idx] = sub[key]
+
+    return real_stations
+
+
+def prefetch(fct, args, depth=0):
+    """
+    Apply a function to each item in args, evaluating up to depth items ahead on a thread pool
+
+    Results are yielded in the same order as args. At most depth + 1 results are held in memory at
+    once, so depth bounds the memory used by the prefetched items.
+
+    Parameters
+    ----------
+    fct : function
+        Function that takes a single argument
+    args : list
+        Arguments passed to fct
+    depth : integer, optional
+        Number of items evaluated ahead of the item currently being processed. Set to 0 to
+        evaluate fct serially
+
+    Returns
+    -------
+    generator yielding fct(a) for a in args
+
+    """
+
+    if depth < 1:
+        for a in args:
+            yield fct(a)
+        return
+
+    args = iter(args)
+    with cf.ThreadPoolExecutor(max_workers=depth) as pool:
+        queue = collections.deque()
+        for a in args:
+            queue.append(pool.submit(fct, a))
+            if len(queue) >= depth:
+                break
+        while len(queue) > 0:
+            result = queue.popleft().result()
+            for a in args:
+                queue.append(pool.submit(fct, a))
+                break
+            yield result
+
+
+def read_fake_obs_file(fname):
+    """
+    Read a prepbufr CSV file and add wind speed and direction. Returns None if fname does not exist
+    """
+
+    try:
+        bufr_csv = bufr.bufrCSV(fname)
+    except FileNotFoundError:
+        return None
+    bufr_csv.df = bufr.compute_wspd_wdir(bufr_csv.df)
+
+    return bufr_csv
+
+
+def extract_fake_obs(bufr_df, station_ids, fake_varnames, max_time_allowed):
+    """
+    Extract the simulated ob closest to the analysis time for each station from one prepbufr CSV
+
+    The prepbufr DataFrame is grouped by SID once, and the ob with the minimum |DHR| for each
+    station is found using a vectorized groupby/idxmin (ties are resolved in favor of the first ob
+    in the file), so the cost scales with the size of the file rather than the size of the file
+    times the number of stations.
+
+    Parameters
+    ----------
+    bufr_df : pd.DataFrame
+        Prepbufr CSV DataFrame (station IDs in the SID column are surrounded by single quotes)
+    station_ids : list of strings
+        Station IDs
+    fake_varnames : list of strings
+        Variables to extract
+    max_time_allowed : float
+        Maximum time allowed between the analysis time and the simulated ob (s)
+
+    Returns
+    -------
+    vals : np.array
+        Simulated obs. Dimensions are (nstations, nvars). NaN if there is no simulated ob within
+        max_time_allowed
+    found : np.array
+        Boolean array that is True if there is at least one simulated ob for a station
+
+    """
+
+    station_pos = pd.Series(np.arange(len(station_ids)), index=["'%s'" % ID for ID in station_ids])
+
+    red_df = bufr_df.loc[bufr_df['SID'].isin(station_pos.index)]
+    closest_idx = np.abs(red_df['DHR']).groupby(red_df['SID'], sort=False).idxmin()
+    closest_df = red_df.loc[closest_idx.values]
+
+    found = np.zeros(len(station_ids), dtype=bool)
+    found[station_pos[closest_df['SID']].values] = True
+
+    closest_df = closest_df.loc[(3600*np.abs(closest_df['DHR'])) < max_time_allowed]
+    vals = np.ones([len(station_ids), len(fake_varnames)]) * np.nan
+    vals[station_pos[closest_df['SID']].values, :] = closest_df[fake_varnames].values
+
+    return vals, found
+
+
+def station_cube(stations, station_ids, v, nyears=1):
+    """
+    Arrange a variable from the real_stations or fake_stations dictionaries into a single array
+
+    Parameters
+    ----------
+    stations : dictionary
+        real_stations or fake_stations. stations[ID][v] has dimensions (nyears * ndays, ntimes)
+    station_ids : list of strings
+        Station IDs
+    v : string
+        Variable
+    nyears : integer, optional
+        Number of years (use 1 for fake_stations)
+
+    Returns
+    -------
+    cube : np.array
+        Dimensions are (nstations, ndays, ntimes, nyears) if nyears > 1, otherwise (nstations,
+        ndays, ntimes)
+
+    """
+
+    cube = np.stack([stations[ID][v].reshape(nyears, -1, stations[ID][v].shape[-1]) 
+                     for ID in station_ids])
+    if nyears > 1:
+        cube = np.moveaxis(cube, 1, -1)
+    else:
+        cube = cube[:, 0, :, :]
+
+    return cube
+
+
+def nanmedian_last(x):
+    """
+    Median along the last axis, ignoring NaNs
+
+    The median is found using a single sort along the last axis (NaNs are sorted to the end), so
+    the cost does not depend on the number or location of NaNs
+
+    Parameters
+    ----------
+    x : np.array
+        Input array. Any dimensions
+
+    Returns
+    -------
+    med : np.array
+        Median. NaN if all values are NaN. Dimensions are the same as x, excluding the last
+    n : np.array
+        Number of non-NaN values
+
+    """
+
+    srt = np.sort(x, axis=-1)
+    n = np.sum(~np.isnan(x), axis=-1, keepdims=True)
+    lo = np.take_along_axis(srt, np.maximum((n - 1) // 2, 0), axis=-1)
+    hi = np.take_along_axis(srt, n // 2, axis=-1)
+    med = 0.5 * (lo + hi)
+
+    return med[..., 0], n[..., 0]
+
+
+def climo_summary(real):
+    """
+    Summarize the real obs climatology along the year axis
+
+    The summary contains everything needed to score fake obs against the climatology (z-scores, 
+    modified z-scores, and fractional ranks) without rescanning the climatology, so it can be stored
+    in the climatology store (see build_climo_store)
+
+    Parameters
+    ----------
+    real : np.array
+        Real obs climatology. Trailing dimension is year
+
+    Returns
+    -------
+    summary : dictionary
+        'count' (number of non-NaN values), 'mean', 'std', 'median', 'mad' (median absolute 
+        deviation, unscaled), and 'sorted' (values sorted along the trailing dimension, with NaNs
+        last). All except 'sorted' have the same dimensions as real, excluding the trailing 
+        dimension
+
+    """
+
+    summary = {}
+    summary['median'], summary['count'] = nanmedian_last(real)
+    summary['mad'] = nanmedian_last(np.abs(real - summary['median'][..., np.newaxis]))[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['mean'] = np.sum(np.where(np.isnan(real), 0, real), axis=-1) / summary['count']
+        dev = np.where(np.isnan(real), 0, real - summary['mean'][..., np.newaxis])
+        summary['std'] = np.sqrt(np.sum(dev**2, axis=-1) / summary['count'])
+    summary['sorted'] = np.sort(real, axis=-1)
+
+    return summary
+
+
+def rolling_day_sum(x, ndays_pool):
+    """
+    Sum over a window of +/- ndays_pool days along the day axis (axis 1). The window is truncated at
+    the first and last days
+
+    The sums for all days are computed from a single cumulative sum, so the cost does not depend on
+    the window length
+
+    Parameters
+    ----------
+    x : np.array
+        Input array. Dimensions are (nstations, ndays, ...)
+    ndays_pool : integer
+        Half-width of the window (days)
+
+    Returns
+    -------
+    xsum : np.array
+        Rolling sums. Same dimensions as x
+
+    """
+
+    ndays = x.shape[1]
+    csum = np.concatenate([np.zeros_like(x[:, :1]), np.cumsum(x, axis=1)], axis=1)
+    lo = np.maximum(np.arange(ndays) - ndays_pool, 0)
+    hi = np.minimum(np.arange(ndays) + ndays_pool + 1, ndays)
+
+    return csum[:, hi] - csum[:, lo]
+
+
+def pooled_climo_summary(real, ndays_pool):
+    """
+    Summarize the real obs climatology using all years and all days within +/- ndays_pool days of
+    each analysis day (the window is truncated at the first and last analysis days)
+
+    The counts, means, and standard deviations are computed from rolling sums and sums of squares 
+    along the day axis. The order statistics (median, median absolute deviation, and sorted values)
+    are computed from a sliding window view along the day axis, so the data are not sliced for each
+    day.
+
+    Parameters
+    ----------
+    real : np.array
+        Real obs climatology. Dimensions are (nstations, ndays, ntimes, nyears) (see station_cube)
+    ndays_pool : integer
+        Half-width of the pooling window (days)
+
+    Returns
+    -------
+    summary : dictionary
+        See climo_summary. The dimensions are (nstations, ndays, ntimes), and the trailing 
+        dimension of 'sorted' is nyears * (2 * ndays_pool + 1)
+
+    """
+
+    valid = ~np.isnan(real)
+
+    # Remove the mean for each station and time before accumulating to limit roundoff in the sums of
+    # squares
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = (np.sum(np.where(valid, real, 0), axis=(1, 3), keepdims=True) / 
+                 np.sum(valid, axis=(1, 3), keepdims=True))
+    shift[np.isnan(shift)] = 0
+    dev = np.where(valid, real - shift, 0)
+
+    n = rolling_day_sum(np.sum(valid, axis=-1), ndays_pool)
+    s1 = rolling_day_sum(np.sum(dev, axis=-1), ndays_pool)
+    s2 = rolling_day_sum(np.sum(dev**2, axis=-1), ndays_pool)
+
+    summary = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['mean'] = s1 / n
+        summary['std'] = np.sqrt(np.maximum(s2 / n - summary['mean']**2, 0))
+    summary['mean'] = summary['mean'] + shift[..., 0]
+
+    # Pooled samples: (nstations, ndays, ntimes, nyears * (2 * ndays_pool + 1))
+    padded = np.pad(real, ((0, 0), (ndays_pool, ndays_pool), (0, 0), (0, 0)), 
+                    constant_values=np.nan)
+    samples = np.lib.stride_tricks.sliding_window_view(padded, 2*ndays_pool + 1, axis=1)
+    samples = samples.reshape(samples.shape[:3] + (-1,))
+    summary['median'], summary['count'] = nanmedian_last(samples)
+    summary['mad'] = nanmedian_last(np.abs(samples - summary['median'][..., np.newaxis]))[0]
+    summary['sorted'] = np.sort(samples, axis=-1)
+
+    return summary
+
+
+def searchsorted_rows(srt, x, n):
+    """
+    Vectorized np.searchsorted (side='left') for each row of an array sorted along the last axis
+
+    All rows are searched at once using a binary search, so the cost scales with the logarithm of
+    the row length
+
+    Parameters
+    ----------
+    srt : np.array
+        Values sorted along the last axis. Only the first n values in each row are searched (e.g.,
+        NaNs sorted to the end are ignored)
+    x : np.array
+        Values to search for. Dimensions are the same as srt, excluding the last
+    n : np.array
+        Number of values to search in each row
+
+    Returns
+    -------
+    idx : np.array
+        Number of values in each row that are less than x (0 if x is NaN)
+
+    """
+
+    lo = np.zeros(x.shape, dtype=int)
+    hi = np.array(n, dtype=int)
+    nmax = srt.shape[-1]
+    active = lo < hi
+    while np.any(active):
+        mid = (lo + hi) // 2
+        val = np.take_along_axis(srt, np.minimum(mid, nmax - 1)[..., np.newaxis], axis=-1)[..., 0]
+        below = val < x
+        lo = np.where(active & below, mid + 1, lo)
+        hi = np.where(active & ~below, mid, hi)
+        active = lo < hi
+
+    return lo
+
+
+def climo_stats(real, min_pts, zscore='regular', summary=None):
+    """
+    Compute the center and spread of the real obs climatology used for z-scores
+
+    Both types of z-scores are computed using reductions along the year axis for all stations, days,
+    and times at once. The median absolute deviation for modified z-scores is computed using 
+    nanmedian_last rather than scipy.stats.median_abs_deviation, which handles NaNs one slice at a 
+    time.
+
+    Parameters
+    ----------
+    real : np.array
+        Real obs climatology. Trailing dimension is year
+    min_pts : integer
+        Minimum number of non-NaN climatology values required to compute the z-score
+    zscore : string, optional
+        Type of z-score ('regular' or 'modified')
+    summary : dictionary, optional
+        Output from climo_summary for real (e.g., from the climatology store). If provided, real is
+        not used
+
+    Returns
+    -------
+    ctr : np.array
+        Mean ('regular') or median ('modified')
+    spd : np.array
+        Standard deviation ('regular') or scaled median absolute deviation ('modified'). NaN if the
+        spread is close to 0 or there are fewer than min_pts climatology values
+
+    """
+
+    if summary is not None:
+        n = summary['count']
+        if zscore == 'regular':
+            ctr = summary['mean'].copy()
+            spd = summary['std'].copy()
+        elif zscore == 'modified':
+            ctr = summary['median'].copy()
+            spd = 1.4826 * summary['mad']
+    elif zscore == 'regular':
+        n = np.sum(~np.isnan(real), axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ctr = np.sum(np.where(np.isnan(real), 0, real), axis=-1) / n
+            dev = np.where(np.isnan(real), 0, real - ctr[..., np.newaxis])
+            spd = np.sqrt(np.sum(dev**2, axis=-1) / n)
+    elif zscore == 'modified':
+        ctr, n = nanmedian_last(real)
+        spd = 1.4826 * nanmedian_last(np.abs(real - ctr[..., np.newaxis]))[0]
+
+    spd[(n < min_pts) | np.isclose(spd, 0)] = np.nan
+
+    return ctr, spd
+
+
+def compute_zscore(fake, real, min_pts, zscore='regular', climo=None):
+    """
+    Compute the z-score of the fake obs relative to the real obs climatology
+
+    For modified z-scores explanation, see here:
+    https://medium.com/analytics-vidhya/anomaly-detection-by-modified-z-score-f8ad6be62bac
+
+    Parameters
+    ----------
+    fake : np.array
+        Fake obs. Any dimensions
+    real : np.array
+        Real obs climatology. Dimensions are the same as fake, plus a trailing year dimension
+    min_pts : integer
+        Minimum number of non-NaN climatology values required to compute the z-score
+    zscore : string, optional
+        Type of z-score ('regular' or 'modified')
+    climo : tuple, optional
+        Output from climo_stats for real. Used to share the climatology statistics between several
+        sets of fake obs. Computed from real if None
+
+    Returns
+    -------
+    z : np.array
+        Z-scores. NaN if the spread is close to 0 or there are fewer than min_pts climatology values
+
+    """
+
+    if climo is None:
+        climo = climo_stats(real, min_pts, zscore=zscore)
+    ctr, spd = climo
+
+    return (fake - ctr) / spd
+
+
+def compute_rank(fake, real, min_pts, summary=None):
+    """
+    Compute the fractional rank of the fake obs relative to the real obs climatology
+
+    The rank is the number of non-NaN climatology values that are less than the fake ob, divided by
+    the number of non-NaN climatology values. Climatology values equal to the fake ob are counted as
+    above it, so the fake ob is always placed before any ties. Note that this is a different tie 
+    convention than the original rank, which took the position of the fake ob in an unstable argsort
+    of the combined fake and climatology values (so the fake ob was placed at an arbitrary position
+    among ties). Ranks therefore differ from the original ranks wherever the fake ob is tied with 
+    climatology values (e.g., for obs reported with coarse precision).
+
+    Parameters
+    ----------
+    fake : np.array
+        Fake obs. Any dimensions
+    real : np.array
+        Real obs climatology. Dimensions are the same as fake, plus a trailing year dimension
+    min_pts : integer
+        Minimum number of non-NaN climatology values required to compute the rank
+    summary : dictionary, optional
+        Output from climo_summary for real. If provided, the number of climatology values below the
+        fake ob is found by searching the sorted climatology (see searchsorted_rows) and real is not
+        used
+
+    Returns
+    -------
+    rank : np.array
+        Fractional rank. NaN if the fake ob is NaN or there are fewer than min_pts climatology values
+    nobs : np.array
+        Number of non-NaN climatology values used to compute the rank (0 if the rank is NaN)
+
+    """
+
+    if summary is None:
+        nvalid = np.sum(~np.isnan(real), axis=-1)
+        nbelow = np.sum(real < fake[..., np.newaxis], axis=-1)
+    else:
+        nvalid = summary['count']
+        nbelow = searchsorted_rows(summary['sorted'], fake, nvalid)
+    use = ~np.isnan(fake) & (nvalid >= min_pts)
+
+    rank = np.ones(fake.shape) * np.nan
+    rank[use] = nbelow[use] / nvalid[use]
+    nobs = np.where(use, nvalid, 0)
+
+    return rank, nobs
+
+
+def bootstrap_null(fake, real, min_pts, zscore='regular'):
+    """
+    Compute the leave-one-year-out null distribution of the z-score
+
+    For each year, that year is removed from the climatology and replaced by the fake ob, then the
+    z-score of the removed year is computed relative to the resulting sample. For regular z-scores,
+    the sample means and standard deviations are derived from running sums and sums of squares
+    across years (so no samples are copied). For modified z-scores, all samples are evaluated at
+    once along an additional dimension.
+
+    Parameters
+    ----------
+    fake : np.array
+        Fake obs. Any dimensions
+    real : np.array
+        Real obs climatology. Dimensions are the same as fake, plus a trailing year dimension
+    min_pts : integer
+        Minimum number of non-NaN values required in a sample to compute the z-score
+    zscore : string, optional
+        Type of z-score ('regular' or 'modified')
+
+    Returns
+    -------
+    null : np.array
+        Null distribution. Same dimensions as real
+
+    """
+
+    real_valid = ~np.isnan(real)
+    fake_valid = ~np.isnan(fake)[..., np.newaxis]
+
+    if zscore == 'regular':
+
+        # Remove the climatological mean before accumulating to limit roundoff in the sums of
+        # squares (this shift does not change the z-scores)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shift = (np.sum(np.where(real_valid, real, 0), axis=-1, keepdims=True) / 
+                     np.sum(real_valid, axis=-1, keepdims=True))
+        shift[np.isnan(shift)] = 0
+        dreal = np.where(real_valid, real - shift, 0)
+        dfake = np.where(fake_valid, fake[..., np.newaxis] - shift, 0)
+
+        # Sample sizes and sums for each leave-one-year-out sample
+        n = np.sum(real_valid, axis=-1, keepdims=True) - real_valid + fake_valid
+        s1 = np.sum(dreal, axis=-1, keepdims=True) - dreal + dfake
+        s2 = np.sum(dreal**2, axis=-1, keepdims=True) - dreal**2 + dfake**2
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ctr = s1 / n
+            spd = np.sqrt(np.maximum(s2 / n - ctr**2, 0))
+        ctr = ctr + shift
+
+    elif zscore == 'modified':
+
+        nyears = real.shape[-1]
+        samples = np.repeat(real[..., np.newaxis, :], nyears, axis=-2)
+        samples[..., np.arange(nyears), np.arange(nyears)] = fake[..., np.newaxis]
+        ctr, n = nanmedian_last(samples)
+        spd = 1.4826 * nanmedian_last(np.abs(samples - ctr[..., np.newaxis]))[0]
+
+    spd[n < min_pts] = np.nan
+    spd[np.isclose(spd, 0)] = np.nan
+    null = (real - ctr) / spd
+
+    return null
+
+
+def bootstrap_percentile(null, z):
+    """
+    Compute the fraction of the null distribution that is less than z
+
+    Parameters
+    ----------
+    null : np.array
+        Null distribution (see bootstrap_null). Trailing dimension is year
+    z : np.array
+        Z-scores. Dimensions are the same as null, excluding the trailing dimension
+
+    Returns
+    -------
+    pct : np.array
+        Percentile of z within the null distribution. NaN if all values in the null distribution
+        are NaN
+
+    """
+
+    npts = np.sum(~np.isnan(null), axis=-1)
+    nbelow = np.sum(null < z[..., np.newaxis], axis=-1)
+
+    pct = np.ones(z.shape) * np.nan
+    pct[npts > 0] = nbelow[npts > 0] / npts[npts > 0]
+
+    return pct
+
+
+def station_chunk_size(max_gb, nyears, ndays, ntimes, nreal, nfake, zscore='regular'):
+    """
+    Number of stations that can be processed at once within a memory budget
+
+    The memory usage per station is estimated from the arrays with a year dimension, which dominate
+    the memory usage: the real obs (raw and converted variables), the bootstrap null distribution,
+    and the climatology cubes and store used to compute the statistics. For modified z-scores, the
+    leave-one-year-out samples used for the bootstrap null add another year dimension.
+
+    Parameters
+    ----------
+    max_gb : float
+        Memory budget (GB)
+    nyears, ndays, ntimes : integer
+        Number of years, analysis days, and analysis times
+    nreal, nfake : integer
+        Number of real obs variables extracted from the IEM files and number of fake obs variables
+    zscore : string, optional
+        Type of z-score ('regular' or 'modified')
+
+    Returns
+    -------
+    nstations : integer
+        Number of stations in each chunk (at least 1)
+
+    """
+
+    per_var = 8 * nyears * ndays * ntimes
+    per_station = per_var * (nreal + 5 * nfake)
+    if zscore == 'modified':
+        per_station = per_station + per_var * nyears
+
+    return max(1, int(max_gb * 1e9 // per_station))
+
+
+def assemble_station_chunks(fnames):
+    """
+    Assemble the output that does not have a year dimension (fake obs, z-scores, percentiles, and
+    ranks) from station data cubes written for separate chunks of stations
+
+    The chunks are opened lazily as a single multi-file dataset, and the real obs and bootstrap null
+    distribution are dropped before the chunks are combined. Nothing is read until the assembled 
+    output is written or its values are accessed, so the memory usage is small compared to 
+    processing a chunk.
+
+    Parameters
+    ----------
+    fnames : list of strings
+        Station data cube for each chunk (see stations_to_dataset)
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Assembled output for all stations (backed by dask arrays). The chunk files are kept open
+        until ds is closed
+
+    """
+
+    def drop_year_vars(ds):
+        return ds[[v for v in ds.data_vars if ('year' not in ds[v].dims)]]
+
+    return xr.open_mfdataset(fnames, combine='nested', concat_dim='station', 
+                             preprocess=drop_year_vars, data_vars='minimal', coords='minimal',
+                             compat='override', combine_attrs='override')
+
+
+def build_climo_store(real_stations, station_ids, varnames, years, analysis_days, analysis_times,
+                      ndays_pool=0):
+    """
+    Build the climatology store: a summary of the real obs climatology (see climo_summary) for each
+    station, variable, analysis day, and analysis time
+
+    Parameters
+    ----------
+    real_stations : dictionary
+        Real obs (see extract_real_obs)
+    station_ids : list of strings
+        Station IDs
+    varnames : list of strings
+        Variables to summarize
+    years : list of integers
+        Years in the real obs climatology
+    analysis_days : list of dt.datetime objects
+        Analysis days
+    analysis_times : list of dt.timedelta objects
+        Analysis times relative to 0000 UTC
+    ndays_pool : integer, optional
+        Half-width of the window of days pooled into the climatology (see pooled_climo_summary). 
+        Only the same day is used if 0
+
+    Returns
+    -------
+    store : xr.Dataset
+        Climatology store. Stored in float64 so that scores computed from the store are identical 
+        to scores computed from real_stations
+
+    """
+
+    summaries = []
+    for v in varnames:
+        real = station_cube(real_stations, station_ids, v, len(years))
+        if ndays_pool > 0:
+            summaries.append(pooled_climo_summary(real, ndays_pool))
+        else:
+            summaries.append(climo_summary(real))
+
+    dims = ('station', 'variable', 'day', 'hour')
+    data_vars = {}
+    for key in ['count', 'mean', 'std', 'median', 'mad']:
+        data_vars[key] = (dims, np.stack([sm[key] for sm in summaries], axis=1))
+    data_vars['sorted'] = (dims + ('sample',), np.stack([sm['sorted'] for sm in summaries], axis=1))
+
+    coords = {'station':station_ids,
+              'variable':varnames,
+              'day':np.array(analysis_days, dtype='datetime64[ns]'),
+              'hour':np.array(analysis_times, dtype='timedelta64[ns]')}
+
+    return xr.Dataset(data_vars=data_vars, coords=coords)
+
+
+def climo_store_summary(store, v, mask=None):
+    """
+    Extract the climatology summary for one variable from the climatology store
+
+    Parameters
+    ----------
+    store : xr.Dataset
+        Climatology store (see build_climo_store)
+    v : string
+        Variable
+    mask : np.array, optional
+        Boolean array with dimensions (station, day, hour). Only the entries where mask is True are
+        returned
+
+    Returns
+    -------
+    summary : dictionary
+        See climo_summary
+
+    """
+
+    summary = {}
+    for key in ['count', 'mean', 'std', 'median', 'mad', 'sorted']:
+        summary[key] = store[key].sel(variable=v).values
+        if mask is not None:
+            summary[key] = summary[key][mask]
+
+    return summary
+
+
+def stations_to_dataset(all_data, years, analysis_days, var_units=None):
+    """
+    Arrange the output from compare_NR_real_sfc_stations_perfect_matching.py into a labeled cube
+
+    Variables defined at each analysis time are stored along a single variable dimension with
+    dimensions (station, variable, [year,] day, hour). Variables that are undefined for a
+    particular array (e.g., ELV for the real obs) are NaN. All floating-point data are stored as
+    float32.
+
+    Parameters
+    ----------
+    all_data : dictionary
+        Output dictionary (fake_stations, real_stations, fake_stations_z, etc.). The optional
+        bootstrap (bootstrap_null, fake_stations_z_pct) and rank (fake_station_rank,
+        all_rank_nobs) entries are included if present
+    years : list of integers
+        Years in the real obs climatology
+    analysis_days : list of dt.datetime objects
+        Analysis days
+    var_units : dictionary, optional
+        Units for each variable
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Station data cube
+
+    """
+
+    if var_units is None:
+        var_units = {}
+
+    fake_stations = all_data['fake_stations']
+    real_stations = all_data['real_stations']
+    station_ids = list(fake_stations.keys())
+    nstations = len(station_ids)
+    nyears = len(years)
+    ndays = len(analysis_days)
+    ntimes = len(all_data['analysis_times'])
+    ID0 = station_ids[0]
+
+    # Variables are ordered so that the variables with z-scores come first
+    fake_vars = [v for v in fake_stations[ID0] if v not in station_summary_keys]
+    real_vars = [v for v in real_stations[ID0] if v not in station_summary_keys]
+    z_vars = list(all_data['fake_stations_z'][ID0].keys())
+    varnames = z_vars + [v for v in fake_vars if v not in z_vars]
+    varnames = varnames + [v for v in real_vars if v not in varnames]
+
+    def time_cube(stations, fill_vars, shape):
+        cube = np.ones([nstations, len(varnames)] + shape, dtype=np.float32) * np.nan
+        for i, ID in enumerate(station_ids):
+            for v in fill_vars:
+                cube[i, varnames.index(v)] = np.reshape(stations[ID][v], shape)
+        return cube
+
+    dims = ('station', 'variable', 'day', 'hour')
+    dims_yr = ('station', 'variable', 'year', 'day', 'hour')
+    data_vars = {}
+    data_vars['real'] = (dims_yr, time_cube(real_stations, real_vars, [nyears, ndays, ntimes]), 
+                         {'variables':' '.join(real_vars)})
+    data_vars['fake'] = (dims, time_cube(fake_stations, fake_vars, [ndays, ntimes]),
+                         {'variables':' '.join(fake_vars)})
+    data_vars['zscore'] = (dims, time_cube(all_data['fake_stations_z'], z_vars, [ndays, ntimes]),
+                           {'variables':' '.join(z_vars)})
+
+    # Ceiling statistics
+    data_vars['real_n_skyl'] = (('station', 'year'), 
+                                np.array([real_stations[ID]['n_skyl'] for ID in station_ids], 
+                                         dtype=np.float32))
+    data_vars['real_ceil_nobs'] = (('station', 'year'), 
+                                   np.array([real_stations[ID]['ceil_nobs'] for ID in station_ids], 
+                                            dtype=np.float32))
+    data_vars['real_frac_ceil'] = (('station', 'year'), 
+                                   np.array([real_stations[ID]['frac_ceil'] for ID in station_ids], 
+                                            dtype=np.float32))
+    data_vars['real_frac_ceil_thres'] = (('station', 'ceil_thres', 'year'), 
+                                         np.array([real_stations[ID]['frac_ceil_thres'] 
+                                                   for ID in station_ids], dtype=np.float32))
+    data_vars['fake_frac_ceil'] = (('station',), 
+                                   np.array([fake_stations[ID]['frac_ceil'] for ID in station_ids], 
+                                            dtype=np.float32))
+    data_vars['fake_frac_ceil_thres'] = (('station', 'ceil_thres'), 
+                                         np.array([fake_stations[ID]['frac_ceil_thres'] 
+                                                   for ID in station_ids], dtype=np.float32))
+
+    # Optional output
+    if 'bootstrap_null' in all_data:
+        null = time_cube(all_data['bootstrap_null'], z_vars, [ndays, ntimes, nyears])
+        data_vars['bootstrap_null'] = (dims_yr, np.moveaxis(null, -1, 2))
+        data_vars['z_pct'] = (dims, time_cube(all_data['fake_stations_z_pct'], z_vars,
+                                             [ndays, ntimes]))
+    if 'fake_station_rank' in all_data:
+        data_vars['rank'] = (dims, time_cube(all_data['fake_station_rank'], z_vars, 
+                                             [ndays, ntimes]))
+        nobs = {ID:{} for ID in station_ids}
+        for v in z_vars:
+            for i, ID in enumerate(station_ids):
+                nobs[ID][v] = all_data['all_rank_nobs'][v][(i*ndays):((i+1)*ndays), :]
+        data_vars['rank_nobs'] = (dims, time_cube(nobs, z_vars, [ndays, ntimes]))
+        data_vars['ceil_rank'] = (('station', 'ceil_thres'), 
+                                  np.array([all_data['fake_station_rank'][ID]['ceil'] 
+                                            for ID in station_ids], dtype=np.float32))
+
+    coords = {'station':station_ids,
+              'variable':varnames,
+              'year':np.array(years),
+              'day':np.array(analysis_days, dtype='datetime64[ns]'),
+              'hour':np.array(all_data['analysis_times'], dtype='timedelta64[ns]'),
+              'ceil_thres':('ceil_thres', np.array(all_data['ceil_thres']), {'units':'km'}),
+              'units':('variable', [var_units.get(v, '') for v in varnames])}
+    attrs = {}
+    for key in dataset_attr_keys:
+        if key in all_data:
+            attrs[key] = int(all_data[key]) if type(all_data[key]) == bool else all_data[key]
+
+    return xr.Dataset(data_vars=data_vars, coords=coords, attrs=attrs)
+
+
+def write_station_dataset(ds, fname, complevel=4):
+    """
+    Write the station data cube to a compressed netCDF file chunked by station and variable
+
+    Each chunk holds a single station and variable, so readers that only select a few stations or
+    variables (e.g., the fig_code/plot_sfc_station_* scripts) only decompress those chunks
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Station data cube (see stations_to_dataset)
+    fname : string
+        Output netCDF file name
+    complevel : integer, optional
+        zlib compression level
+
+    Returns
+    -------
+    None
+
+    """
+
+    encoding = {}
+    for name, da in ds.data_vars.items():
+        chunks = tuple(1 if d in ['station', 'variable', 'experiment'] else ds.sizes[d] 
+                       for d in da.dims)
+        encoding[name] = {'zlib':True, 'complevel':complevel, 'chunksizes':chunks}
+    ds.to_netcdf(fname, encoding=encoding)
+
+
+def combine_experiments(dss, experiments, fake_obs_dirs):
+    """
+    Combine station data cubes from several NR obs experiments that share the same real obs 
+    climatology
+
+    Parameters
+    ----------
+    dss : list of xr.Dataset
+        Station data cubes for each experiment (see stations_to_dataset). All cubes must have the 
+        same stations, years, days, and hours
+    experiments : list of strings
+        Experiment names
+    fake_obs_dirs : list of strings
+        Fake obs directory for each experiment
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Combined station data cube. Variables that depend on the fake obs have an additional 
+        experiment dimension. The real obs variables are taken from the first cube
+
+    """
+
+    real_vars = [v for v in dss[0].data_vars if v.startswith('real')]
+    exp_vars = [v for v in dss[0].data_vars if v not in real_vars]
+
+    fake = xr.concat([ds[exp_vars] for ds in dss], dim=pd.Index(experiments, name='experiment'),
+                     coords='minimal', compat='override', combine_attrs='override')
+    ds = xr.merge([dss[0][real_vars], fake], compat='override', combine_attrs='override')
+    ds = ds.assign_coords(fake_obs_dir=('experiment', list(fake_obs_dirs)))
+
+    return ds
+
+
+def dataset_to_stations(ds):
+    """
+    Convert the station data cube back into the dictionaries used by 
+    compare_NR_real_sfc_stations_perfect_matching.py
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Station data cube (see stations_to_dataset)
+
+    Returns
+    -------
+    all_data : dictionary
+        Output dictionary. Same keys as the input to stations_to_dataset, plus var_units
+
+    """
+
+    ds = ds.load()
+    station_ids = list(ds['station'].values)
+    nyears = ds.sizes['year']
+    ndays = ds.sizes['day']
+    ntimes = ds.sizes['hour']
+    zvars = ds['zscore'].attrs['variables'].split()
+
+    def time_dict(da, varnames, shape):
+        out = {}
+        for ID in station_ids:
+            out[ID] = {}
+            for v in varnames:
+                out[ID][v] = np.float64(da.sel(station=ID, variable=v).values).reshape(shape)
+        return out
+
+    def all_stations(da, varnames):
+        return {v:np.float64(da.sel(variable=v).values).reshape(-1, ntimes) for v in varnames}
+
+    all_data = {}
+    all_data['real_stations'] = time_dict(ds['real'], ds['real'].attrs['variables'].split(),
+                                          [nyears*ndays, ntimes])
+    all_data['fake_stations'] = time_dict(ds['fake'], ds['fake'].attrs['variables'].split(),
+                                          [ndays, ntimes])
+    all_data['fake_stations_z'] = time_dict(ds['zscore'], zvars, [ndays, ntimes])
+    all_data['all_zscores'] = all_stations(ds['zscore'], zvars)
+    for i, ID in enumerate(station_ids):
+        real = all_data['real_stations'][ID]
+        if 'ceil' in real:
+            real['ceil'] = real['ceil'].reshape(nyears, ndays*ntimes)
+        real['n_skyl'] = np.float64(ds['real_n_skyl'].values[i, :])
+        if 'real_ceil_nobs' in ds:
+            real['ceil_nobs'] = np.float64(ds['real_ceil_nobs'].values[i, :])
+        real['frac_ceil'] = np.float64(ds['real_frac_ceil'].values[i, :])
+        real['frac_ceil_thres'] = np.float64(ds['real_frac_ceil_thres'].values[i, :, :])
+        fake = all_data['fake_stations'][ID]
+        fake['frac_ceil'] = np.float64(ds['fake_frac_ceil'].values[i])
+        fake['frac_ceil_thres'] = np.float64(ds['fake_frac_ceil_thres'].values[i, :])
+    all_data['analysis_times'] = list(pd.to_timedelta(ds['hour'].values).to_pytimedelta())
+    for key in dataset_attr_keys:
+        if key in ds.attrs:
+            all_data[key] = ds.attrs[key]
+    all_data['elv_adjust_prs'] = bool(ds.attrs['elv_adjust_prs'])
+    all_data['elv_adjust_T'] = bool(ds.attrs['elv_adjust_T'])
+    all_data['ceil_thres'] = list(ds['ceil_thres'].values)
+    all_data['var_units'] = dict(zip(ds['variable'].values, ds['units'].values))
+
+    if 'bootstrap_null' in ds:
+        null = ds['bootstrap_null'].transpose('station', 'variable', 'day', 'hour', 'year')
+        all_data['bootstrap_null'] = time_dict(null, zvars, [ndays, ntimes, nyears])
+        all_data['fake_stations_z_pct'] = time_dict(ds['z_pct'], zvars, [ndays, ntimes])
+        all_data['all_z_pct'] = all_stations(ds['z_pct'], zvars)
+    if 'rank' in ds:
+        all_data['fake_station_rank'] = time_dict(ds['rank'], zvars, [ndays, ntimes])
+        all_data['all_rank'] = all_stations(ds['rank'], zvars)
+        all_data['all_rank_nobs'] = all_stations(ds['rank_nobs'], zvars)
+        for i, ID in enumerate(station_ids):
+            all_data['fake_station_rank'][ID]['ceil'] = np.float64(ds['ceil_rank'].values[i, :])
+        all_data['all_rank']['ceil'] = np.float64(ds['ceil_rank'].values)
+
+    return all_data
+
+
+def plan_station_update(ds, station_ids, years, analysis_days, analysis_times, settings,
+                        ceil_thres, varnames):
+    """
+    Determine which stations, years, analysis days, and analysis times are missing from a saved
+    station data cube
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Saved station data cube (see stations_to_dataset)
+    station_ids : list of strings
+        Requested station IDs
+    years : np.array
+        Requested years
+    analysis_days : list of dt.datetime objects
+        Requested analysis days
+    analysis_times : list of dt.timedelta objects
+        Requested analysis times relative to 0000 UTC
+    settings : dictionary
+        Current values of the settings in dataset_attr_keys
+    ceil_thres : list of floats
+        Ceiling thresholds (km)
+    varnames : list of strings
+        Variables that z-scores are computed for
+
+    Returns
+    -------
+    new : dictionary
+        Boolean arrays that are True for the requested stations, years, days, and hours that are
+        missing from ds. None if ds cannot be updated incrementally (i.e., the ingest settings,
+        ceiling thresholds, or variables differ, or analysis days or times were removed, which
+        changes the ceiling statistics)
+    restats : boolean
+        True if all z-scores and ranks must be recomputed (i.e., the years in the climatology or
+        the statistics settings differ)
+
+    """
+
+    def differs(key):
+        return (key not in ds.attrs) or np.any(np.asarray(ds.attrs[key]) != np.asarray(settings[key]))
+
+    days = np.array(analysis_days, dtype='datetime64[ns]')
+    hours = np.array(analysis_times, dtype='timedelta64[ns]')
+
+    for key in ingest_attr_keys:
+        if differs(key):
+            print('%s differs from the saved output' % key)
+            return None, True
+    if ((ds.sizes['ceil_thres'] != len(ceil_thres)) or
+        not np.allclose(ds['ceil_thres'].values, ceil_thres)):
+        print('ceil_thres differs from the saved output')
+        return None, True
+    if not np.all(np.isin(varnames, ds['zscore'].attrs['variables'].split())):
+        print('variables differ from the saved output')
+        return None, True
+    if not (np.all(np.isin(ds['day'].values, days)) and np.all(np.isin(ds['hour'].values, hours))):
+        print('analysis days or times were removed from the saved output')
+        return None, True
+
+    new = {'station':~np.isin(np.array(station_ids, dtype=object), ds['station'].values),
+           'year':~np.isin(years, ds['year'].values),
+           'day':~np.isin(days, ds['day'].values),
+           'hour':~np.isin(hours, ds['hour'].values)}
+    restats = (np.any(new['year']) or not np.all(np.isin(ds['year'].values, years)) or
+               np.any([differs(key) for key in stats_attr_keys]))
+
+    return new, restats
+
+
+def reindex_station_dataset(ds, station_ids, years, analysis_days, analysis_times):
+    """
+    Reindex a station data cube to the requested stations, years, analysis days, and analysis
+    times. Entries that are missing from ds are set to NaN
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Station data cube (see stations_to_dataset)
+    Other parameters : See plan_station_update
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Reindexed station data cube
+
+    """
+
+    return ds.reindex(station=station_ids, year=years,
+                      day=np.array(analysis_days, dtype='datetime64[ns]'),
+                      hour=np.array(analysis_times, dtype='timedelta64[ns]'))
+
+
+"""
+End sfc_station_fcts.py
+"""
@@ -0,0 +1,262 @@
+"""
+Plotting Functions for the Real vs. Simulated Surface Station Comparison
+
+Figures are drawn using the non-interactive Agg backend, so they can be rendered by a pool of worker
+processes.
+
+These functions are used by compare_NR_real_sfc_stations_perfect_matching.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import multiprocessing as mp
+import concurrent.futures as cf
+import functools
+
+
+#---------------------------------------------------------------------------------------------------
+# Constants
+#---------------------------------------------------------------------------------------------------
+
+# Percentiles used for the climatology bands: min, 10, 25, 50, 75, 90, max
+band_pcts = [0, 10, 25, 50, 75, 90, 100]
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def plot_pct_bands(ax, x, data, c):
+    """
+    Plot the median, 25-75 and 10-90 percentile bands, and min/max of data
+
+    All percentiles are computed using a single call to np.nanpercentile along axis 0
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes to plot on
+    x : np.array
+        X-axis values
+    data : np.array
+        Data. Dimensions are (nsamples, len(x))
+    c : string
+        Color
+
+    Returns
+    -------
+    None
+
+    """
+
+    p = np.nanpercentile(data, band_pcts, axis=0)
+
+    ax.plot(x, p[3], '-', c=c, lw=2)
+    ax.fill_between(x, p[2], p[4], color=c, alpha=0.4)
+    ax.fill_between(x, p[1], p[5], color=c, alpha=0.2)
+    ax.plot(x, p[0], '-', c=c, lw=0.5)
+    ax.plot(x, p[6], '-', c=c, lw=0.5)
+
+
+def plot_station(ID, fake, fake_z, real, real_ceil_cdf, fake_ceil_cdf, fake_varnames=None,
+                 var_units=None, plot_hr=None, ceil_ctrs=None, zcutoff=2, zscore='regular',
+                 ceil_plot='hgt', out_fname='%s.png'):
+    """
+    Plot the NR and real obs climatology (and the NR z-scores) for a single station
+
+    Two figures are saved: one with the NR values and the real obs climatology ([ID]) and one with
+    the NR z-scores ([ID]_z[zscore])
+
+    Parameters
+    ----------
+    ID : string
+        Station ID
+    fake : dictionary
+        Fake obs for this station (fake_stations[ID])
+    fake_z : dictionary
+        Fake obs z-scores for this station (fake_stations_z[ID])
+    real : dictionary
+        Real obs for this station (real_stations[ID])
+    real_ceil_cdf : np.array
+        Ceiling CDF for each year. Dimensions are (nyears, len(ceil_ctrs)). Only used if
+        ceil_plot = 'hgt'
+    fake_ceil_cdf : np.array
+        NR ceiling CDF. Only used if ceil_plot = 'hgt'
+    fake_varnames : list of strings, optional
+        Variables to plot (up to 7)
+    var_units : dictionary, optional
+        Units for each variable
+    plot_hr : np.array, optional
+        Analysis times (hours)
+    ceil_ctrs : np.array, optional
+        Ceiling bin centers (km)
+    zcutoff : float, optional
+        Z-score that denotes outliers
+    zscore : string, optional
+        Type of z-score (only used for labels)
+    ceil_plot : string, optional
+        Option to plot ceiling obs as a binary histogram ('binary') or CDF of ceiling height ('hgt')
+    out_fname : string, optional
+        Output file name (include %s placeholder for station ID)
+
+    Returns
+    -------
+    None
+
+    """
+
+    if fake_varnames is None:
+        fake_varnames = []
+    if var_units is None:
+        var_units = {}
+
+    ncols = 4
+    fig, axes = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
+    plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
+    fig_z, axes_z = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
+    plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
+    for j, v in enumerate(fake_varnames):
+        ax = axes[int(j/ncols), j%ncols]
+        ax_z = axes_z[int(j/ncols), j%ncols]
+
+        # Plot fake station data (one line per day)
+        ax.plot(plot_hr, fake[v].T, 'k-', lw=0.75)
+        ax_z.plot(plot_hr, fake_z[v].T, 'k-', lw=0.75)
+
+        ax_z.axhline(zcutoff, c='r', ls='-', lw=1.5)
+        ax_z.axhline(-zcutoff, c='r', ls='-', lw=1.5)
+
+        # Plot real station data percentiles
+        plot_pct_bands(ax, plot_hr, real[v], 'r')
+
+        ax.set_ylabel('%s (%s)' % (v, var_units.get(v, '')), size=14)
+        ax_z.set_ylabel('%s z-score' % v, size=14)
+        for a in [ax, ax_z]:
+            a.grid()
+            a.set_xlim([plot_hr.min(), plot_hr.max()])
+    for j in range(ncols):
+        if j != 3:
+            axes[-1, j].set_xlabel('hour', size=14)
+            axes_z[-1, j].set_xlabel('hour', size=14)
+        axes[0, 3].set_xlabel('hour', size=14)
+        axes_z[0, 3].set_xlabel('hour', size=14)
+
+    # Add fraction of time with a ceiling in the final subplot
+    ax = axes[1, 3]
+    if ceil_plot == 'binary':
+        ax.hist(real['frac_ceil'], color='red')
+        ax.axvline(fake['frac_ceil'], c='k', lw=2)
+        ax.set_xlabel('fraction of time with ceiling', size=10)
+        ax.set_ylabel('number of years', size=14)
+        ax.set_xlim([0, 1])
+    elif ceil_plot == 'hgt':
+        plot_pct_bands(ax, ceil_ctrs, real_ceil_cdf, 'r')
+        ax.plot(ceil_ctrs, fake_ceil_cdf, 'k-')
+        ax.set_xlabel('cloud ceiling (km)', size=14)
+        ax.set_ylabel('cumulative fraction of days', size=14)
+        ax.set_xlim([0, 12])
+        ax.set_ylim([0, 1])
+
+    ax.grid()
+
+    for f, tag, ttl in zip([fig, fig_z], [ID, '%s_z%s' % (ID, zscore)],
+                           [ID, '%s: %s z-score' % (ID, zscore)]):
+        f.suptitle(ttl, size=18)
+        f.savefig(out_fname % tag)
+        plt.close(f)
+
+
+def plot_all_stations(station_ids, fake_stations, fake_stations_z, real_stations, real_ceil_cdf,
+                      fake_ceil_cdf, nprocs=1, **kwargs):
+    """
+    Plot the figures for each station (see plot_station)
+
+    Parameters
+    ----------
+    station_ids : list of strings
+        Station IDs
+    fake_stations, fake_stations_z, real_stations : dictionary
+        Fake obs, fake obs z-scores, and real obs. Keys are station IDs
+    real_ceil_cdf, fake_ceil_cdf : np.array or None
+        Ceiling CDFs. The first dimension is station
+    nprocs : integer, optional
+        Number of worker processes. Figures are plotted serially if nprocs = 1
+    kwargs : optional
+        Other keyword arguments passed to plot_station
+
+    Returns
+    -------
+    None
+
+    """
+
+    if real_ceil_cdf is None:
+        real_ceil_cdf = [None] * len(station_ids)
+        fake_ceil_cdf = [None] * len(station_ids)
+
+    plot_fct = functools.partial(plot_station, **kwargs)
+    args = [station_ids,
+            [fake_stations[ID] for ID in station_ids],
+            [fake_stations_z[ID] for ID in station_ids],
+            [real_stations[ID] for ID in station_ids],
+            real_ceil_cdf,
+            fake_ceil_cdf]
+
+    if nprocs > 1:
+        print('Plotting stations using %d processes' % nprocs)
+        with cf.ProcessPoolExecutor(max_workers=nprocs, mp_context=mp.get_context('fork')) as pool:
+            list(pool.map(plot_fct, *args))
+    else:
+        for station_args in zip(*args):
+            plot_fct(*station_args)
+
+
+def plot_zscore_summary(all_zscores, fake_varnames, plot_hr, zcutoff=2, zscore='regular',
+                        out_fname='%s.png'):
+    """
+    Plot the distribution of z-scores across all stations and days
+
+    Parameters
+    ----------
+    all_zscores : dictionary
+        Z-scores for each variable. Dimensions are (nstations * ndays, ntimes)
+    Other parameters : See plot_station
+
+    Returns
+    -------
+    None
+
+    """
+
+    ncols = 4
+    fig, axes = plt.subplots(nrows=2, ncols=ncols, figsize=(12, 8))
+    plt.subplots_adjust(left=0.06, bottom=0.08, right=0.99, top=0.9, wspace=0.4)
+    for i, v in enumerate(fake_varnames):
+        ax = axes[int(i/ncols), i%ncols]
+        plot_pct_bands(ax, plot_hr, all_zscores[v], 'k')
+        ax.grid()
+        ax.axhline(zcutoff, c='r', ls='-', lw=1.5)
+        ax.axhline(-zcutoff, c='r', ls='-', lw=1.5)
+        ax.set_ylabel('%s z-score' % v, size=14)
+        ax.set_xlim([plot_hr.min(), plot_hr.max()])
+    for i in range(ncols):
+        if i != 3:
+            axes[-1, i].set_xlabel('hour', size=14)
+        axes[0, 3].set_xlabel('hour', size=14)
+    fig.suptitle('all stations: %s z-score' % zscore, size=18)
+    fig.savefig(out_fname % ('all_z_%s' % zscore))
+    plt.close(fig)
+
+
+"""
+End sfc_station_plots.py
+"""
@@ -0,0 +1,248 @@
+"""
+Field Significance Tests for Surface Station Anomalies
+
+The mean NR z-score (standardized anomaly) across all stations is tested against 0 for each hour
+using resampling tests that are evaluated for all stations and hours at once:
+
+    signflip: Permutation test that randomly flips the sign of each station's (day-averaged)
+        anomalies. The sign of each station's full record is flipped together, so the temporal
+        correlation within each station is retained.
+    loyo: Leave-one-year-out test. The null distribution is created by drawing one year for each
+        station from the leave-one-year-out null distribution saved by
+        compare_NR_real_sfc_stations_perfect_matching.py (bootstrap_null).
+
+In both cases, the resampling for a block of permutations is a single 2D array (permutations,
+stations) applied to the station cube. The resulting p-values are adjusted for multiple testing
+across all variables and hours using the false discovery rate (FDR) procedure of Benjamini and
+Hochberg (1995) (see Wilks 2016, BAMS, for a discussion of field significance).
+
+These functions are used by plot_sfc_station_NR_obs_comparison_timeseries.py
+
+agent@local
+Date Created: 16 October 2026
+"""
+
+#---------------------------------------------------------------------------------------------------
+# Import Modules
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+import xarray as xr
+
+
+#---------------------------------------------------------------------------------------------------
+# Functions
+#---------------------------------------------------------------------------------------------------
+
+def station_means(cube):
+    """
+    Average a station cube over the day dimension (axis -2), ignoring NaNs
+
+    Parameters
+    ----------
+    cube : np.array
+        Station cube. Dimensions are (nstations, [nyears,] ndays, nhours)
+
+    Returns
+    -------
+    means : np.array
+        Means. Dimensions are (nstations, [nyears,] nhours). NaN if there is no valid data
+
+    """
+
+    valid = ~np.isnan(cube)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.sum(np.where(valid, cube, 0), axis=-2) / np.sum(valid, axis=-2)
+
+    return means
+
+
+def _pvalue(obs, null_stats):
+    """
+    Two-sided p-value of obs given a list of null statistics (one array per block of permutations)
+    """
+
+    null_stats = np.concatenate(null_stats, axis=0)
+    nexceed = np.sum(np.abs(null_stats) >= np.abs(obs), axis=0)
+
+    return (1. + nexceed) / (1. + null_stats.shape[0])
+
+
+def signflip_test(z, nperm=10000, seed=0, block=1000):
+    """
+    Sign-flip permutation test of the mean station anomaly for each hour
+
+    Parameters
+    ----------
+    z : np.array
+        Day-averaged anomalies for each station (see station_means). Dimensions are (nstations,
+        nhours)
+    nperm : integer, optional
+        Number of permutations
+    seed : integer, optional
+        Seed for the random number generator
+    block : integer, optional
+        Number of permutations evaluated at once (limits memory usage)
+
+    Returns
+    -------
+    pvals : np.array
+        Two-sided p-values. Dimensions are (nhours)
+
+    """
+
+    rng = np.random.default_rng(seed)
+    valid = ~np.isnan(z)
+    z0 = np.where(valid, z, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.sum(valid, axis=0)
+        obs = np.sum(z0, axis=0) / n
+
+        null_stats = []
+        for start in range(0, nperm, block):
+            signs = rng.choice([-1., 1.], size=(min(block, nperm - start), z.shape[0]))
+            null_stats.append((signs @ z0) / n)
+
+    return _pvalue(obs, null_stats)
+
+
+def loyo_test(z, null, nperm=10000, seed=0, block=1000):
+    """
+    Leave-one-year-out resampling test of the mean station anomaly for each hour
+
+    Parameters
+    ----------
+    z : np.array
+        Day-averaged anomalies for each station (see station_means). Dimensions are (nstations,
+        nhours)
+    null : np.array
+        Day-averaged leave-one-year-out null distribution for each station (see station_means).
+        Dimensions are (nstations, nyears, nhours)
+    nperm : integer, optional
+        Number of resamples
+    seed : integer, optional
+        Seed for the random number generator
+    block : integer, optional
+        Number of resamples evaluated at once (limits memory usage)
+
+    Returns
+    -------
+    pvals : np.array
+        Two-sided p-values. Dimensions are (nhours)
+
+    """
+
+    rng = np.random.default_rng(seed)
+    nstations, nyears, _ = null.shape
+    station_idx = np.arange(nstations)[np.newaxis, :]
+
+    def mean_over_stations(x):
+        valid = ~np.isnan(x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sum(np.where(valid, x, 0), axis=-2) / np.sum(valid, axis=-2)
+
+    obs = mean_over_stations(z)
+    null_stats = []
+    for start in range(0, nperm, block):
+        year_idx = rng.integers(nyears, size=(min(block, nperm - start), nstations))
+        null_stats.append(mean_over_stations(null[station_idx, year_idx]))
+
+    return _pvalue(obs, null_stats)
+
+
+def fdr_bh(pvals, alpha=0.05):
+    """
+    Benjamini-Hochberg false discovery rate control across all p-values
+
+    Parameters
+    ----------
+    pvals : np.array
+        p-values. Any dimensions. NaNs are ignored
+    alpha : float, optional
+        False discovery rate
+
+    Returns
+    -------
+    qvals : np.array
+        FDR-adjusted p-values. Same dimensions as pvals
+    reject : np.array
+        True where the null hypothesis is rejected. Same dimensions as pvals
+
+    """
+
+    flat = pvals.ravel()
+    use = np.where(~np.isnan(flat))[0]
+    order = use[np.argsort(flat[use], kind='stable')]
+    ntests = order.size
+
+    # Adjusted p-values are the running minimum of p * ntests / rank, starting from the largest p
+    adj = flat[order] * ntests / np.arange(1, ntests + 1)
+    adj = np.minimum(np.minimum.accumulate(adj[::-1])[::-1], 1)
+
+    qvals = np.ones(flat.shape) * np.nan
+    qvals[order] = adj
+    qvals = qvals.reshape(pvals.shape)
+    with np.errstate(invalid='ignore'):
+        reject = qvals <= alpha
+
+    return qvals, reject
+
+
+def field_significance(ds, varnames, method='signflip', nperm=10000, alpha=0.05, seed=0,
+                       block=1000):
+    """
+    Test the mean anomaly across all stations for each variable and hour, with FDR control across
+    all variables and hours
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Station data cube created by compare_NR_real_sfc_stations_perfect_matching.py. Must contain
+        bootstrap_null if method = 'loyo'
+    varnames : list of strings
+        Variables to test
+    method : string, optional
+        Resampling test ('signflip' or 'loyo')
+    nperm : integer, optional
+        Number of permutations or resamples
+    alpha : float, optional
+        False discovery rate
+    seed : integer, optional
+        Seed for the random number generator
+    block : integer, optional
+        Number of permutations evaluated at once
+
+    Returns
+    -------
+    out : xr.Dataset
+        pval, qval (FDR-adjusted p-values), and reject, each with dimensions (variable, hour). The
+        field_significant attribute is 1 if any test is rejected after FDR control
+
+    """
+
+    pvals = np.zeros([len(varnames), ds.sizes['hour']])
+    for i, v in enumerate(varnames):
+        z = station_means(ds['zscore'].sel(variable=v).transpose('station', 'day', 'hour').values)
+        if method == 'signflip':
+            pvals[i] = signflip_test(z, nperm=nperm, seed=seed, block=block)
+        elif method == 'loyo':
+            null = ds['bootstrap_null'].sel(variable=v).transpose('station', 'year', 'day', 'hour')
+            pvals[i] = loyo_test(z, station_means(null.values), nperm=nperm, seed=seed,
+                                 block=block)
+        else:
+            raise ValueError('method %s is not supported' % method)
+
+    qvals, reject = fdr_bh(pvals, alpha=alpha)
+
+    dims = ('variable', 'hour')
+    out = xr.Dataset(data_vars={'pval':(dims, pvals), 'qval':(dims, qvals), 'reject':(dims, reject)},
+                     coords={'variable':varnames, 'hour':ds['hour'].values},
+                     attrs={'method':method, 'nperm':nperm, 'alpha':alpha,
+                            'field_significant':int(np.any(reject))})
+
+    return out
+
+
+"""
+End field_significance.py
+"""
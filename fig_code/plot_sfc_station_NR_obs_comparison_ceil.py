@@ -7,7 +7,7 @@ https://mesonet.agron.iastate.edu/request/download.phtml
 This script uses "perfect" station matching. This means that the NR output WAS intentionally
 interpolated to the real surface stations used for comparison here.
 
-This script uses a pickle file generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
+This script uses netCDF files generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
 
 shawn.s.murdzek@noaa.gov
 Date Created: 11 April 2023
@@ -22,7 +22,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime as dt
 import scipy.stats as ss
-import pickle
+import xarray as xr
 import cartopy.feature as cfeature
 import cartopy.crs as ccrs
 
@@ -31,10 +31,10 @@ import cartopy.crs as ccrs
 # Input Parameters
 #---------------------------------------------------------------------------------------------------
 
-# Input pickle files
+# Input netCDF files
 parent_dir = '../analysis_code/NR_eval'
-pickle_winter_fname = parent_dir + '/sfc_station_ceil_exp2_compare_winter.pkl'
-pickle_spring_fname = parent_dir + '/sfc_station_ceil_exp2_compare_spring.pkl'
+winter_fname = parent_dir + '/sfc_station_ceil_exp2_compare_winter.nc'
+spring_fname = parent_dir + '/sfc_station_ceil_exp2_compare_spring.nc'
 
 # Surface station information
 with open('station_list.txt', 'r') as fptr:
@@ -51,11 +51,10 @@ out_fname = '../figs/SfcStationComparisonCeil.pdf'
 # Read Data
 #---------------------------------------------------------------------------------------------------
 
-# Read in pickled data
+# Open station data cubes. Data are only read from disk once they are selected
 all_data = {}
-for season, pkl in zip(['Winter', 'Spring'], [pickle_winter_fname, pickle_spring_fname]):
-    with open(pkl, 'rb') as handle:
-        all_data[season] = pickle.load(handle)
+for season, fname in zip(['Winter', 'Spring'], [winter_fname, spring_fname]):
+    all_data[season] = xr.open_dataset(fname, chunks={})
 
 # Read in surface station locations
 station_lat = {}
@@ -65,7 +64,7 @@ for i, s in enumerate(station_ids):
     station_lat[s] = df['lat'].loc[0]
     station_lon[s] = df['lon'].loc[0]
 
-ceil_thres = [0.1524, 0.3048, 0.9144] # DO NOT CHANGE! This is unique to the pickle file
+ceil_thres = all_data['Winter']['ceil_thres'].values
 ceil_thres_ft = [500, 1000, 3000]
 nthres = len(ceil_thres)
 
@@ -84,8 +83,9 @@ for i, season in enumerate(['Winter', 'Spring']):
         ax_num = 1+j+3*i
         print(ax_num)
         ax = fig.add_subplot(2, nthres, ax_num, projection=ccrs.LambertConformal())
-        for SID in station_ids:
-            rank = all_data[season]['fake_station_rank'][SID]['ceil'][j]
+        ceil_rank = all_data[season]['ceil_rank'].sel(station=station_ids).values
+        for k, SID in enumerate(station_ids):
+            rank = ceil_rank[k, j]
             if (rank == 1) or (rank == 0):
                 m = '*'
             else:
@@ -7,7 +7,7 @@ https://mesonet.agron.iastate.edu/request/download.phtml
 This script uses "perfect" station matching. This means that the NR output WAS intentionally
 interpolated to the real surface stations used for comparison here.
 
-This script uses a pickle file generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
+This script uses netCDF files generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
 
 shawn.s.murdzek@noaa.gov
 Date Created: 11 April 2023
@@ -22,7 +22,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime as dt
 import scipy.stats as ss
-import pickle
+import xarray as xr
 import cartopy.feature as cfeature
 import cartopy.crs as ccrs
 
@@ -31,10 +31,10 @@ import cartopy.crs as ccrs
 # Input Parameters
 #---------------------------------------------------------------------------------------------------
 
-# Input pickle files
+# Input netCDF files
 parent_dir = '../analysis_code/NR_eval'
-pickle_winter_fname = parent_dir + '/sfc_station_compare_winter.pkl'
-pickle_spring_fname = parent_dir + '/sfc_station_compare_spring.pkl'
+winter_fname = parent_dir + '/sfc_station_compare_winter.nc'
+spring_fname = parent_dir + '/sfc_station_compare_spring.nc'
 
 # Surface station information
 with open('station_list.txt', 'r') as fptr:
@@ -54,11 +54,10 @@ out_fname = '../figs/SfcStationComparisonMap%s.pdf'
 # Read Data
 #---------------------------------------------------------------------------------------------------
 
-# Read in pickled data
+# Open station data cubes. Data are only read from disk once they are selected
 all_data = {}
-for season, pkl in zip(['Winter', 'Spring'], [pickle_winter_fname, pickle_spring_fname]):
-    with open(pkl, 'rb') as handle:
-        all_data[season] = pickle.load(handle)
+for season, fname in zip(['Winter', 'Spring'], [winter_fname, spring_fname]):
+    all_data[season] = xr.open_dataset(fname, chunks={})
 
 # Read in surface station locations
 station_lat = np.zeros(len(station_ids))
@@ -90,11 +89,9 @@ for season in ['Winter', 'Spring']:
         station_adj_var = np.zeros(len(station_ids))
         station_t = np.zeros(len(station_ids))
         station_pvalue = np.zeros(len(station_ids))
+        zscores = all_data[season]['zscore'].sel(station=station_ids, variable=v).values
         for j, SID in enumerate(station_ids):
-            zscore1d = np.zeros(all_data[season]['fake_stations_z'][SID][v].size)
-            ndays = all_data[season]['fake_stations_z'][SID][v].shape[0]
-            for k in range(ndays):
-                zscore1d[(k*24):((k+1)*24)] = all_data[season]['fake_stations_z'][SID][v][k, :]
+            zscore1d = zscores[j, :, :].ravel()
             zscore1d = zscore1d[~np.isnan(zscore1d)]
             station_mean_z[j] = np.mean(zscore1d)
             station_autocorr_z[j] = np.corrcoef(zscore1d[1:], zscore1d[:-1])[0, 1]
@@ -7,7 +7,7 @@ https://mesonet.agron.iastate.edu/request/download.phtml
 This script uses "perfect" station matching. This means that the NR output WAS intentionally
 interpolated to the real surface stations used for comparison here.
 
-This script uses a pickle file generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
+This script uses netCDF files generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
 
 shawn.s.murdzek@noaa.gov
 Date Created: 11 April 2023
@@ -22,7 +22,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime as dt
 import scipy.stats as ss
-import pickle
+import xarray as xr
 import seaborn as sns
 
 
@@ -30,10 +30,10 @@ import seaborn as sns
 # Input Parameters
 #---------------------------------------------------------------------------------------------------
 
-# Input pickle files
+# Input netCDF files
 parent_dir = '../analysis_code/NR_eval'
-pickle_winter_fname = parent_dir + '/sfc_station_compare_winter.pkl'
-pickle_spring_fname = parent_dir + '/sfc_station_compare_spring.pkl'
+winter_fname = parent_dir + '/sfc_station_compare_winter.nc'
+spring_fname = parent_dir + '/sfc_station_compare_spring.nc'
 
 # Parameters for real obs
 with open('station_list.txt', 'r') as fptr:
@@ -54,11 +54,10 @@ out_fname = '../figs/SfcStationComparisonRank%s.pdf'
 # Read Data
 #---------------------------------------------------------------------------------------------------
 
-# Read in pickled data
+# Open station data cubes. Data are only read from disk once they are selected
 all_data = {}
-for season, pkl in zip(['Winter', 'Spring'], [pickle_winter_fname, pickle_spring_fname]):
-    with open(pkl, 'rb') as handle:
-        all_data[season] = pickle.load(handle)
+for season, fname in zip(['Winter', 'Spring'], [winter_fname, spring_fname]):
+    all_data[season] = xr.open_dataset(fname, chunks={})
 
 zcutoff = 2
 
@@ -73,8 +72,8 @@ var_names = {'TOB':'Temperature', 'QOB':'Specific Humidity', 'POB':'Pressure',
 
 for season in ['Winter', 'Spring']:
 
-    plot_hr = np.array([t.total_seconds() / 3600. for t in all_data[season]['analysis_times']])
-    ntimes = len(all_data[season]['analysis_times'])
+    plot_hr = all_data[season]['hour'].values / np.timedelta64(1, 'h')
+    ntimes = all_data[season].sizes['hour']
     fig, axes = plt.subplots(nrows=2, ncols=3, figsize=(10, 6))
     plt.subplots_adjust(left=0.06, bottom=0.08, right=1.07, top=0.88, wspace=0.29, hspace=0.37)
     ttest_pvalues = {}
@@ -86,6 +85,8 @@ for season in ['Winter', 'Spring']:
             ax.sharex(axes[0, 0])
             ax.sharey(axes[0, 0])
         
+        var_rank = all_data[season]['rank'].sel(variable=v).values.reshape(-1, ntimes)
+
         # Plot rank using percentiles
         #pcts = [0, 2, 25, 50, 75, 98, 100, 'mean']
         #var_percentiles = {}
@@ -93,10 +94,10 @@ for season in ['Winter', 'Spring']:
         #    var_percentiles[p] = np.zeros(ntimes)
         #    if p == 'mean':
         #        for l in range(ntimes):
-        #            var_percentiles[p][l] = np.nanmean(all_data[season]['all_rank'][v][:, l]) 
+        #            var_percentiles[p][l] = np.nanmean(var_rank[:, l]) 
         #    else:
         #        for l in range(ntimes):
-        #            var_percentiles[p][l] = np.nanpercentile(all_data[season]['all_rank'][v][:, l], p) 
+        #            var_percentiles[p][l] = np.nanpercentile(var_rank[:, l], p) 
         #
         #ax.plot(plot_hr, var_percentiles['mean'], 'r-', lw=2)
         #ax.fill_between(plot_hr, var_percentiles[25], var_percentiles[75], color='r', alpha=0.4)
@@ -120,10 +121,10 @@ for season in ['Winter', 'Spring']:
         bin_ctr = bins[:-1] + bin_hwidth
         vmax = 140
 
-        nhist = all_data[season]['all_rank'][v].shape[-1]
+        nhist = var_rank.shape[-1]
         zscore_hist = np.zeros([nhist, len(bins) - 1])
         for j in range(nhist):
-            zscore_hist[j, :] = np.histogram(all_data[season]['all_rank'][v][:, j], bins=bins)[0] 
+            zscore_hist[j, :] = np.histogram(var_rank[:, j], bins=bins)[0] 
         bin_ctr_2d, plot_hr_2d = np.meshgrid(bin_ctr, plot_hr)
         cax = ax.pcolormesh(plot_hr_2d, bin_ctr_2d, zscore_hist, cmap='Reds', vmin=0, vmax=vmax)
         print(np.nanmax(zscore_hist))
@@ -135,7 +136,7 @@ for season in ['Winter', 'Spring']:
 
         # Save ranks for the final subplot
         for j in range(nhist):
-            all_ranks = all_ranks + list(all_data[season]['all_rank'][v][:, j])
+            all_ranks = all_ranks + list(var_rank[:, j])
 
     for i in range(2):
         axes[-1, i].set_xlabel('hour', size=12)
@@ -7,7 +7,7 @@ https://mesonet.agron.iastate.edu/request/download.phtml
 This script uses "perfect" station matching. This means that the NR output WAS intentionally
 interpolated to the real surface stations used for comparison here.
 
-This script uses a pickle file generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
+This script uses netCDF files generated by ../analysis_code/NR_eval/compare_NR_real_sfc_stations_perfect_matching.py
 
 shawn.s.murdzek@noaa.gov
 Date Created: 11 April 2023
@@ -22,18 +22,20 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime as dt
 import scipy.stats as ss
-import pickle
+import xarray as xr
 import seaborn as sns
 
+import field_significance as fs
+
 
 #---------------------------------------------------------------------------------------------------
 # Input Parameters
 #---------------------------------------------------------------------------------------------------
 
-# Input pickle files
+# Input netCDF files
 parent_dir = '../analysis_code/NR_eval'
-pickle_winter_fname = parent_dir + '/sfc_station_compare_winter.pkl'
-pickle_spring_fname = parent_dir + '/sfc_station_compare_spring.pkl'
+winter_fname = parent_dir + '/sfc_station_compare_winter.nc'
+spring_fname = parent_dir + '/sfc_station_compare_spring.nc'
 
 # Parameters for real obs
 with open('station_list.txt', 'r') as fptr:
@@ -46,6 +48,18 @@ years = np.arange(1993, 2023)
 # analysis_times are dt.timedelta objects relative to 0000
 analysis_times = [dt.timedelta(hours=i) for i in range(24)]
 
+# Significance test shown in the p-value heatmap:
+#     'ttest': t test for each hour (each station and day is treated as independent). This is the
+#              test used in the paper figure
+#     'signflip': Sign-flip permutation test across all stations and hours (see field_significance.py)
+#     'loyo': Leave-one-year-out resampling test (requires bootstrap_null in the netCDF files)
+# For 'signflip' and 'loyo', nperm resamples are used and the heatmap shows p-values adjusted to
+# control the false discovery rate across all variables and hours (if use_fdr = True)
+sig_test = 'ttest'
+nperm = 10000
+use_fdr = True
+fdr_alpha = 0.05
+
 # Output file name (include %s placeholder for season)
 out_fname = '../figs/SfcStationComparison%s.pdf'
 
@@ -54,11 +68,10 @@ out_fname = '../figs/SfcStationComparison%s.pdf'
 # Read Data
 #---------------------------------------------------------------------------------------------------
 
-# Read in pickled data
+# Open station data cubes. Data are only read from disk once they are selected
 all_data = {}
-for season, pkl in zip(['Winter', 'Spring'], [pickle_winter_fname, pickle_spring_fname]):
-    with open(pkl, 'rb') as handle:
-        all_data[season] = pickle.load(handle)
+for season, fname in zip(['Winter', 'Spring'], [winter_fname, spring_fname]):
+    all_data[season] = xr.open_dataset(fname, chunks={})
 
 zcutoff = 2
 
@@ -73,19 +86,33 @@ var_names = {'TOB':'Temperature', 'QOB':'Specific Humidity', 'POB':'Pressure',
 
 for season in ['Winter', 'Spring']:
 
-    plot_hr = np.array([t.total_seconds() / 3600. for t in all_data[season]['analysis_times']])
-    ntimes = len(all_data[season]['analysis_times'])
+    plot_hr = all_data[season]['hour'].values / np.timedelta64(1, 'h')
+    ntimes = all_data[season].sizes['hour']
     fig, axes = plt.subplots(nrows=2, ncols=3, figsize=(10, 6))
     #plt.subplots_adjust(left=0.06, bottom=0.08, right=1.08, top=0.88, wspace=0.22, hspace=0.3)
     plt.subplots_adjust(left=0.06, bottom=0.09, right=0.98, top=0.88, wspace=0.2, hspace=0.3)
     ttest_pvalues = {}
+    plot_vars = ['TOB', 'QOB', 'POB', 'UOB', 'VOB']
+
+    # Field significance test for all variables and hours at once
+    if sig_test != 'ttest':
+        sig = fs.field_significance(all_data[season], plot_vars, method=sig_test, nperm=nperm, 
+                                    alpha=fdr_alpha)
+        print('%s: field significant = %d' % (season, sig.attrs['field_significant']))
+        for v in plot_vars:
+            if use_fdr:
+                ttest_pvalues[v[0]] = sig['qval'].sel(variable=v).values
+            else:
+                ttest_pvalues[v[0]] = sig['pval'].sel(variable=v).values
 
-    for i, v in enumerate(['TOB', 'QOB', 'POB', 'UOB', 'VOB']):
+    for i, v in enumerate(plot_vars):
         ax = axes[int(i/3), i%3]
         if i > 0:
             ax.sharex(axes[0, 0])
             ax.sharey(axes[0, 0])
         
+        all_zscores = all_data[season]['zscore'].sel(variable=v).values.reshape(-1, ntimes)
+
         # Plot standardized anomalies using percentiles
         pcts = [0, 2, 25, 50, 75, 98, 100, 'mean']
         var_percentiles = {}
@@ -93,10 +120,10 @@ for season in ['Winter', 'Spring']:
             var_percentiles[p] = np.zeros(ntimes)
             if p == 'mean':
                 for l in range(ntimes):
-                    var_percentiles[p][l] = np.nanmean(all_data[season]['all_zscores'][v][:, l]) 
+                    var_percentiles[p][l] = np.nanmean(all_zscores[:, l]) 
             else:
                 for l in range(ntimes):
-                    var_percentiles[p][l] = np.nanpercentile(all_data[season]['all_zscores'][v][:, l], p) 
+                    var_percentiles[p][l] = np.nanpercentile(all_zscores[:, l], p) 
         
         ax.plot(plot_hr, var_percentiles['mean'], 'r-', lw=2)
         ax.fill_between(plot_hr, var_percentiles[25], var_percentiles[75], color='r', alpha=0.4)
@@ -107,18 +134,16 @@ for season in ['Winter', 'Spring']:
         # Plot standardized anomalies using histograms
         #bins = np.arange(-3, 3.01, 0.2)
         #bin_ctr = (bins[:-1] + bins[1:]) / 2
-        #nhist = all_data[season]['all_zscores'][v].shape[-1]
+        #nhist = all_zscores.shape[-1]
         #zscore_hist = np.zeros([nhist, len(bins) - 1])
         #for j in range(nhist):
-        #    zscore_hist[j, :] = np.histogram(all_data[season]['all_zscores'][v][:, j], bins=bins)[0] 
+        #    zscore_hist[j, :] = np.histogram(all_zscores[:, j], bins=bins)[0] 
         #bin_ctr_2d, plot_hr_2d = np.meshgrid(bin_ctr, plot_hr)
         #cax = ax.pcolormesh(plot_hr_2d, bin_ctr_2d, zscore_hist, cmap='Reds', vmin=0, vmax=60)
 
         # Perform t test
-        ttest_pvalues[v[0]] = np.zeros(len(plot_hr))
-        for j in range(len(plot_hr)):
-            ttest_pvalues[v[0]][j] = ss.ttest_1samp(all_data[season]['all_zscores'][v][:, j], 0,
-                                                    nan_policy='omit')[1]
+        if sig_test == 'ttest':
+            ttest_pvalues[v[0]] = ss.ttest_1samp(all_zscores, 0, axis=0, nan_policy='omit')[1]
 
         ax.grid()
         #ax.axhline(zcutoff, c='r', ls='-', lw=1.5)
@@ -139,7 +164,12 @@ for season in ['Winter', 'Spring']:
     ttest_df = pd.DataFrame(ttest_pvalues)
     sns.heatmap(ttest_df.T, cbar=True, ax=ax, vmin=0, vmax=0.1, cmap='Blues_r', linecolor='k', 
                 linewidths=0.1, cbar_kws={'orientation':'vertical', 'pad':0.02})
-    ax.set_title('f) $t$ test $p$-values', size=16)
+    if sig_test == 'ttest':
+        ax.set_title('f) $t$ test $p$-values', size=16)
+    elif use_fdr:
+        ax.set_title('f) FDR-adjusted $p$-values', size=16)
+    else:
+        ax.set_title('f) %s test $p$-values' % sig_test, size=16)
     ax.set_xlabel('hour', size=14)
     ax.set_ylabel('variable', size=14)
     ax.set_xticks(np.arange(0.5, 24, 5), labels=['%d' % i for i in range(0, 24, 5)])